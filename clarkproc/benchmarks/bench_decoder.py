@@ -0,0 +1,148 @@
+"""
+Benchmark the "fast" FHIR decoder against the "strict" one.
+
+Generates a synthetic bundle, parses it with both decoders and reports the
+time taken by each.  The parse results are compared to make sure that the
+fast decoder produces the same models and messages.
+
+Usage (from the clarkproc directory, with requirements.txt installed):
+
+    python benchmarks/bench_decoder.py [--patients N] [--repeat N]
+"""
+import argparse
+from base64 import b64encode
+import json
+import os
+import random
+import tempfile
+import time
+
+from clarkproc.engine import ingest
+from clarkproc.fhir.errors import Message
+
+CATEGORY_SYSTEM = 'http://hl7.org/fhir/observation-category'
+OBSERVATION_CODES = [
+    ('laboratory', '2160-0', 'Creatinine', 'mg/dL'),
+    ('laboratory', '718-7', 'Hemoglobin', 'g/dL'),
+    ('vital-signs', '8867-4', 'Heart rate', '/min'),
+    ('vital-signs', '8310-5', 'Body temperature', 'Cel'),
+]
+
+
+def make_bundle(num_patients, observations_per_patient, seed=0):
+    rng = random.Random(seed)
+    entries = []
+
+    for p in range(num_patients):
+        patient_id = f'p{p}'
+        reference = {'reference': f'Patient/{patient_id}'}
+
+        entries.append({'resource': {
+            'resourceType': 'Patient',
+            'id': patient_id,
+            'gender': rng.choice(['male', 'female']),
+            'birthDate': f'19{rng.randint(30, 99)}-01-01',
+            'maritalStatus': {'coding': [{
+                'system': 'http://hl7.org/fhir/v3/MaritalStatus',
+                'code': 'M', 'display': 'Married'}]},
+        }})
+
+        for o in range(observations_per_patient):
+            category, code, display, unit = rng.choice(OBSERVATION_CODES)
+            entries.append({'resource': {
+                'resourceType': 'Observation',
+                'id': f'o{p}_{o}',
+                'status': rng.choice(['final'] * 9 + ['preliminary']),
+                'category': [{'coding': [{'system': CATEGORY_SYSTEM,
+                                          'code': category}]}],
+                'code': {'coding': [{'system': 'http://loinc.org',
+                                     'code': code, 'display': display}]},
+                'subject': reference,
+                'effectiveDateTime': '20{:02d}-{:02d}-01T08:00:00Z'.format(
+                    rng.randint(0, 19), rng.randint(1, 12)),
+                'valueQuantity': {'value': round(rng.uniform(0, 100), 2),
+                                  'unit': unit},
+            }})
+
+        entries.append({'resource': {
+            'resourceType': 'MedicationRequest',
+            'id': f'm{p}',
+            'status': 'active',
+            'intent': 'order',
+            'subject': reference,
+            'authoredOn': '2015-01-01',
+            'medicationCodeableConcept': {'coding': [{
+                'system': 'http://www.nlm.nih.gov/research/umls/rxnorm',
+                'code': '1049630', 'display': 'Aspirin'}]},
+        }})
+
+        entries.append({'resource': {
+            'resourceType': 'DocumentReference',
+            'id': f'n{p}',
+            'status': 'current',
+            'subject': reference,
+            'type': {'coding': [{'system': 'http://loinc.org',
+                                 'code': '11506-3'}]},
+            'content': [{'attachment': {
+                'contentType': 'text/plain',
+                'data': b64encode(b'Patient reports cough. ' * 20).decode(),
+            }}],
+        }})
+
+    return {'resourceType': 'Bundle', 'type': 'collection', 'entry': entries}
+
+
+def describe(result):
+    """Comparable representation of a parse result."""
+    items, labels = result
+    return [
+        str(item) if isinstance(item, Message)
+        else (type(item).__name__, item.to_dict())
+        for item in items
+    ], labels
+
+
+def time_decoder(path, decoder, repeat):
+    best = float('inf')
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = ingest._parse_file(path, decoder)
+        best = min(best, time.perf_counter() - start)
+
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--patients', type=int, default=2000)
+    parser.add_argument('--observations', type=int, default=20,
+                        help='Observations per patient.')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, 'bundle.json')
+        bundle = make_bundle(args.patients, args.observations)
+
+        with open(path, 'w') as f:
+            json.dump(bundle, f)
+
+        num_resources = len(bundle['entry'])
+        print(f'{num_resources} resources, '
+              f'{os.path.getsize(path) / 1e6:.1f} MB')
+
+        strict_time, strict = time_decoder(path, 'strict', args.repeat)
+        fast_time, fast = time_decoder(path, 'fast', args.repeat)
+
+    for name, t in (('strict', strict_time), ('fast', fast_time)):
+        print(f'{name:>8}: {t:8.3f} s  ({num_resources / t:10.0f} resources/s)')
+
+    print(f' speedup: {strict_time / fast_time:8.1f}x')
+
+    if describe(fast) != describe(strict):
+        raise SystemExit('ERROR: Decoders produced different results.')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,164 @@
+"""
+Benchmark counting feature regex matches in notes with a NotePool.
+
+Generates a synthetic corpus of notes, moves their text to a note store as the
+server does, and reports the time taken to count the matches of a set of
+regexes in this process and with a pool of worker processes.  The pool is
+timed both on its first call, which includes starting the workers, and on
+later calls, which reuse them.  The bytes pickled to send the shards to the
+workers are reported too, against what sending the note text would cost.
+
+The speedup depends on the number of CPUs: with a single one, the pool can
+only add overhead.
+
+Usage (from the clarkproc directory, with requirements.txt installed):
+
+    python benchmarks/bench_featurize.py [--patients N] [--workers N]
+"""
+import argparse
+from base64 import b64encode
+import json
+import os
+import pickle
+import random
+import tempfile
+import time
+
+from clarkproc.blueprint_ml import note_feature_matrix
+from clarkproc.engine import featurize, ingest
+from clarkproc.engine.featurize import NotePool
+from clarkproc.fhir.notestore import NoteStore
+
+WORDS = ['cough', 'fever', 'denies fever', 'chest pain', 'shortness of breath',
+         'nausea', 'headache', 'no acute distress', 'follow up in 2 weeks',
+         'history of diabetes', 'hypertension', 'normal exam']
+
+PLAN = {
+    'sections': {
+        'section_break': r'\n\n',
+        'tags': [{'name': 'history', 'regex': r'(?i)history'}],
+    },
+    'features': [{'regex': regex} for regex in (
+        r'(?i)\bcough', r'(?i)(?<!denies )fever', r'(?i)chest\s+pain',
+        r'(?i)short(ness)?\s+of\s+breath', r'(?i)diabet\w*',
+        r'(?i)hypertens\w*', r'\b\d+\s+weeks?\b', r'(?i)n(au|ua)sea')],
+}
+
+
+def make_bundle(num_patients, notes_per_patient, seed=0):
+    rng = random.Random(seed)
+    entries = []
+
+    for p in range(num_patients):
+        entries.append({'resource': {'resourceType': 'Patient',
+                                     'id': f'p{p}'}})
+
+        for n in range(notes_per_patient):
+            text = '\n\n'.join(
+                '. '.join(rng.choice(WORDS) for _ in range(rng.randint(5, 20)))
+                for _ in range(rng.randint(2, 6)))
+            entries.append({'resource': {
+                'resourceType': 'DocumentReference',
+                'id': f'n{p}_{n}',
+                'status': 'current',
+                'subject': {'reference': f'Patient/p{p}'},
+                'type': {'coding': [{'system': 'http://loinc.org',
+                                     'code': '11506-3'}]},
+                'content': [{'attachment': {
+                    'contentType': 'text/plain',
+                    'data': b64encode(text.encode()).decode(),
+                }}],
+            }})
+
+    return {'resourceType': 'Bundle', 'type': 'collection', 'entry': entries}
+
+
+def time_call(fn, repeat=1):
+    best = float('inf')
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+
+    return best, result
+
+
+def sent_bytes(pool, patients, regexes, store):
+    """
+    :return: Bytes pickled for the shards of a call, and for the same shards
+        carrying the note text.
+    """
+    notes = [(row, (p.id, note_id), note.location[1:], note.data)
+             for row, p in enumerate(patients.values())
+             for note_id, note in p.notes.items()]
+    by_location = by_text = 0
+
+    for shard in pool._shards([(row, key, loc) for row, key, loc, _ in notes]):
+        rows = {row for row, _, _ in shard}
+        args = (PLAN['sections'], regexes, store.path)
+        by_location += len(pickle.dumps(args + (shard,)))
+        by_text += len(pickle.dumps(args + (
+            [(row, key, text) for row, key, _, text in notes if row in rows],)))
+
+    return by_location, by_text
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--patients', type=int, default=2000)
+    parser.add_argument('--notes', type=int, default=5,
+                        help='Notes per patient.')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    # Shard even when the workers can't run in parallel, to measure them.
+    workers = max(args.workers, 2)
+    featurize.MIN_PARALLEL_NOTES = 0
+    regexes = [feature['regex'] for feature in PLAN['features']]
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, 'bundle.json')
+
+        with open(path, 'w') as f:
+            json.dump(make_bundle(args.patients, args.notes), f)
+
+        store = NoteStore(os.path.join(tmp_dir, 'notes'))
+        _, patients, *_ = ingest.ingest_fhir([path], note_store=store)
+        num_notes = sum(len(p.notes) for p in patients.values())
+        print(f'{num_notes} notes, {store.size / 1e6:.1f} MB of text, '
+              f'{workers} workers on {os.cpu_count()} CPUs')
+
+        serial_time, expected = time_call(
+            lambda: note_feature_matrix(patients, PLAN, regexes), args.repeat)
+
+        pool = NotePool(workers)
+
+        try:
+            cold_time, cold = time_call(
+                lambda: note_feature_matrix(patients, PLAN, regexes,
+                                            pool=pool))
+            warm_time, warm = time_call(
+                lambda: note_feature_matrix(patients, PLAN, regexes,
+                                            pool=pool), args.repeat)
+            by_location, by_text = sent_bytes(pool, patients, regexes,
+                                                 store)
+        finally:
+            pool.shutdown()
+
+        store.close()
+
+    for name, t in (('serial', serial_time), ('pool (start)', cold_time),
+                    ('pool', warm_time)):
+        print(f'{name:>12}: {t:8.3f} s  (speedup {serial_time / t:5.2f}x)')
+
+    print(f'  shards: {by_location / 1e6:8.2f} MB pickled per call '
+          f'({by_text / 1e6:.2f} MB with the text)')
+
+    if not (cold == expected).all() or not (warm == expected).all():
+        raise SystemExit('ERROR: Pool produced different counts.')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,155 @@
+"""
+Benchmark the memory held by a loaded corpus.
+
+Generates a synthetic bundle (see bench_decoder.py), ingests it and reports
+the memory that remains allocated for the loaded patients, resources and
+lookup tables, per observation.  The intent is to track the footprint of the
+models and containers, so notes are kept in memory (no note store) and the
+measurement uses tracemalloc, which only counts Python allocations.
+
+The same measurement is run against the clarkproc package of a baseline git
+revision (by default the last one before models and containers used
+``__slots__`` and CodeValues were interned), in a separate process, so that
+the two layouts are compared on the same corpus.
+
+Usage (from the clarkproc directory, with requirements.txt installed):
+
+    python benchmarks/bench_memory.py [--patients N] [--observations N]
+                                      [--baseline REVISION | --no-baseline]
+"""
+import argparse
+import gc
+import io
+import json
+import os
+import subprocess
+import sys
+import tarfile
+import tempfile
+import tracemalloc
+
+from bench_decoder import make_bundle
+from clarkproc.engine import ingest
+
+# Last revision with the previous layout of the models and containers.
+BASELINE = '16f5f97~1'
+
+
+def measure(path, decoder):
+    """
+    :return: Tuple of the bytes still allocated after ingest and the loaded
+        patients.
+    """
+    gc.collect()
+    tracemalloc.start()
+
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        result = ingest.ingest_fhir([path], decoder=decoder)
+        gc.collect()
+        retained = tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+
+    return retained, result[1]
+
+
+def report(path, decoder):
+    """
+    :return: Memory retained by the corpus at ``path``, with the number of
+        patients, observations and bytes of note text.
+    :rtype: dict
+    """
+    retained, patients = measure(path, decoder)
+
+    return {
+        'patients': len(patients),
+        'observations': sum(p.labs.total_count + p.vitals.total_count
+                            for p in patients.values()),
+        'notes_bytes': sum(len(n.data) for p in patients.values()
+                           for n in p.notes.values()),
+        'retained': retained,
+    }
+
+
+def report_revision(revision, path, decoder):
+    """
+    Run :func:`report` in a new process, on the clarkproc package of a git
+    revision.
+
+    :rtype: dict
+    """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    archive = subprocess.run(['git', 'archive', revision, './clarkproc'],
+                             cwd=root, stdout=subprocess.PIPE, check=True)
+
+    with tempfile.TemporaryDirectory() as tree:
+        with tarfile.open(fileobj=io.BytesIO(archive.stdout)) as tar:
+            tar.extractall(tree)
+
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(
+            [tree] + [p for p in [os.environ.get('PYTHONPATH')] if p]))
+        out = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), '--report', path,
+             '--decoder', decoder],
+            env=env, stdout=subprocess.PIPE, check=True)
+
+    return json.loads(out.stdout)
+
+
+def print_report(name, d):
+    per_observation = (d['retained'] - d['notes_bytes']) / d['observations']
+
+    print(f'{name}:')
+    print(f'  retained:        {d["retained"] / 1e6:10.2f} MB')
+    print(f'    of which notes: {d["notes_bytes"] / 1e6:9.2f} MB (text only)')
+    print(f'  per observation: {per_observation:10.0f} bytes '
+          f'(excluding note text)')
+
+    return per_observation
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--patients', type=int, default=2000)
+    parser.add_argument('--observations', type=int, default=20,
+                        help='Observations per patient.')
+    parser.add_argument('--decoder', default='fast',
+                        choices=ingest.DECODERS)
+    parser.add_argument('--baseline', default=BASELINE,
+                        help='Git revision to compare with.')
+    parser.add_argument('--no-baseline', dest='baseline',
+                        action='store_const', const=None,
+                        help='Only measure the working tree.')
+    # Used to measure a baseline revision in a separate process.
+    parser.add_argument('--report', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.report is not None:
+        print(json.dumps(report(args.report, args.decoder)))
+        return
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, 'bundle.json')
+        bundle = make_bundle(args.patients, args.observations)
+
+        with open(path, 'w') as f:
+            json.dump(bundle, f)
+
+        del bundle
+        current = report(path, args.decoder)
+        baseline = (report_revision(args.baseline, path, args.decoder)
+                    if args.baseline is not None else None)
+
+    print(f'{current["patients"]} patients, '
+          f'{current["observations"]} observations')
+    new = print_report('working tree', current)
+
+    if baseline is not None:
+        old = print_report(f'baseline ({args.baseline})', baseline)
+        print(f'per observation: {old:.0f} -> {new:.0f} bytes '
+              f'({new / old - 1:+.0%})')
+
+
+if __name__ == '__main__':
+    main()
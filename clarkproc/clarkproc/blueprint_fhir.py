@@ -1,17 +1,33 @@
 """Blueprint for FHIR endpoints."""
-from collections import defaultdict
+import base64
 from functools import wraps
+import json
 import logging
+import os
 
-from flask import Blueprint, jsonify, request
+from flask import Blueprint, current_app, jsonify, request
+import numpy as np
 
-from clarkproc.engine import ingest
+from clarkproc.engine import cohort, ingest, jobs
+from clarkproc.engine.cache import DEFAULT_MAX_BYTES, IngestCache
+from clarkproc.engine.coverage import MatchCountCache
+from clarkproc.engine.messages import DEFAULT_MAX_EXAMPLES, MessageCollector
+from clarkproc.engine.sections import SectionCache
+from clarkproc.engine.timing import IngestTiming
 import clarkproc.state as s
+from clarkproc.fhir.containers import PatientCollection
 from clarkproc.fhir.models import CodeValue
+from clarkproc.fhir.notestore import NoteStore
 
 bp_fhir = Blueprint('fhir', __name__)
 
 TEST_DATA_INDICATOR = 'is_test_data'
+
+# Patients per page of /patient_list, unless PATIENT_LIST_PAGE_SIZE is set.
+DEFAULT_PAGE_SIZE = 100
+
+# Query parameters of /patient_list, besides filters on summary fields.
+PATIENT_LIST_OPTIONS = ('cursor', 'limit', 'fields', 'sort', 'order')
 LOGGER = logging.getLogger(__name__)
 
 
@@ -30,6 +46,231 @@ def require_fhir(f):
     return decorated_function
 
 
+def get_state(kwargs):
+    """
+    :param dict kwargs: Keyword arguments of the view function.
+    :return: Tuple of the state to use (train or test) and its name.
+    :rtype: tuple(AttributeDict, str)
+    """
+    if kwargs.get(TEST_DATA_INDICATOR, False):
+        return s.test, 'test'
+
+    return s.train, 'train'
+
+
+def get_job(job_id, kwargs):
+    """
+    :return: Load job with the identifier, provided that it is loading the
+        state the request is for.
+    :rtype: clarkproc.engine.jobs.IngestJob
+    """
+    job = jobs.get(job_id)
+
+    if job is None or job.target != get_state(kwargs)[1]:
+        return None
+
+    return job
+
+
+def get_ingest_cache():
+    """
+    Build the ingest cache from the application configuration.
+
+    :return: Ingest cache, or ``None`` if ``INGEST_CACHE_DIR`` isn't set.
+    :rtype: IngestCache
+    """
+    directory = current_app.config.get('INGEST_CACHE_DIR')
+
+    if directory is None:
+        return None
+
+    return IngestCache(
+        directory,
+        max_bytes=current_app.config.get('INGEST_CACHE_MAX_BYTES',
+                                         DEFAULT_MAX_BYTES),
+        use_hash=current_app.config.get('INGEST_CACHE_USE_HASH', False),
+    )
+
+
+def get_note_store(state, append):
+    """
+    Get the store to move note text to from the application configuration.
+
+    :param AttributeDict state: State the data is being loaded into.
+    :param bool append: Whether the data is being added to the loaded data,
+        in which case the existing store keeps being used.
+    :return: Note store, or ``None`` if ``NOTE_STORE_DIR`` isn't set and notes
+        are kept in memory.
+    :rtype: NoteStore
+    """
+    if append and state.note_store is not None:
+        return state.note_store
+
+    directory = current_app.config.get('NOTE_STORE_DIR')
+
+    if directory is None:
+        return None
+
+    return NoteStore(directory)
+
+
+def parse_load_options(state):
+    """
+    Read the options of a load request.
+
+    :param AttributeDict state: State the data is being loaded into.
+    :return: Tuple of keyword arguments for :func:`ingest.ingest_fhir` and an
+        error response.  Only one of the two is not ``None``.
+    :rtype: tuple
+    """
+    num_workers = request.json.get('num_workers', 1)
+
+    # bool is a subclass of int, but JSON true/false aren't worker counts.
+    if num_workers is not None and (
+            not isinstance(num_workers, int) or isinstance(num_workers, bool)
+            or num_workers < 1):
+        return None, (
+            '"num_workers" must be a positive integer or null.',
+            400,
+            {'Content-Type': 'text/plain'}
+        )
+
+    decoder = request.json.get('decoder', 'strict')
+
+    if decoder not in ingest.DECODERS:
+        return None, (
+            f'Unsupported decoder "{decoder}".  '
+            f'Allowed options are {list(ingest.DECODERS)}.',
+            400,
+            {'Content-Type': 'text/plain'}
+        )
+
+    max_messages = request.json.get(
+        'max_messages',
+        current_app.config.get('INGEST_MAX_MESSAGES', DEFAULT_MAX_EXAMPLES))
+
+    if (not isinstance(max_messages, int) or isinstance(max_messages, bool)
+            or max_messages < 0):
+        return None, (
+            '"max_messages" must be a non-negative integer.',
+            400,
+            {'Content-Type': 'text/plain'}
+        )
+
+    message_log = request.json.get('message_log')
+
+    if message_log is not None and (
+            not isinstance(message_log, str) or not message_log):
+        return None, (
+            '"message_log" must be a file path or null.',
+            400,
+            {'Content-Type': 'text/plain'}
+        )
+
+    if message_log is not None:
+        # The log is only created once there is a message to write, so check
+        # that it could be without creating it.
+        directory = os.path.dirname(os.path.abspath(message_log))
+
+        if (not os.path.isdir(directory) or not os.access(directory, os.W_OK)
+                or os.path.isdir(message_log)
+                or (os.path.exists(message_log)
+                    and not os.access(message_log, os.W_OK))):
+            return None, (
+                f'Unable to write message log "{message_log}".',
+                400,
+                {'Content-Type': 'text/plain'}
+            )
+
+    append_to = None
+    if request.json.get('append', False) and state.patients is not None:
+        append_to = (state.patients, state.labs, state.vitals,
+                     state.medications)
+
+    return {
+        'paths': request.json.get('paths'),
+        'num_workers': num_workers,
+        'cache': get_ingest_cache() if request.json.get('use_cache', True) else None,
+        'decoder': decoder,
+        'append_to': append_to,
+        'note_store': get_note_store(state, append_to is not None),
+        'timing_report': IngestTiming(),
+        'collector': MessageCollector(max_messages, message_log),
+    }, None
+
+
+def run_load(options):
+    """
+    Run an ingest.
+
+    :param dict options: Options returned by :func:`parse_load_options`.
+    :return: Value returned by :func:`ingest.ingest_fhir`.
+    :rtype: tuple
+    """
+    try:
+        return ingest.ingest_fhir(**options)
+    finally:
+        options['collector'].close()
+
+
+def apply_load(state, result, options):
+    """
+    Store the results of an ingest in application state.
+
+    :param AttributeDict state: State the data was loaded into.
+    :param tuple result: Value returned by :func:`ingest.ingest_fhir`.
+    :param dict options: Options the ingest was run with.
+    :return: Tuple of the response data and status code.
+    :rtype: tuple(dict, int)
+    """
+    messages, patients, labs, vitals, medications = result
+
+    # Swap everything in at once so that requests never see a mix of old and
+    # new data.  A failed append leaves the previously loaded data in place.
+    # Sections and match counts of the previous notes are computed again, as
+    # appended notes may replace them.
+    if patients is not None or options['append_to'] is None:
+        state.update(patients=patients, labs=labs, vitals=vitals,
+                     medications=medications,
+                     note_store=options['note_store'],
+                     section_cache=SectionCache(),
+                     coverage_cache=MatchCountCache())
+
+    if patients is None:
+        patient_ids = []
+        code = 428
+    else:
+        patient_ids = list(patients.keys())
+        code = 200
+
+    d = {
+        'messages': messages,
+        'message_summary': options['collector'].summary(),
+        'patient_ids': patient_ids,
+        'timing': options['timing_report'].to_dict(),
+    }
+
+    return d, code
+
+
+def load_job(state, options):
+    """
+    :param AttributeDict state: State to load the data into.
+    :param dict options: Options returned by :func:`parse_load_options`.
+    :return: Function running the ingest as a job and applying its results,
+        returning what :func:`apply_load` does.
+    """
+    def run(progress):
+        result = run_load(dict(options, progress=progress))
+
+        # Don't apply the results if the job was cancelled while linking, or
+        # is while they are applied.
+        return jobs.apply(progress,
+                          lambda: apply_load(state, result, options))
+
+    return run
+
+
 @bp_fhir.route('/load', methods=['POST'])
 def load_fhir(**kwargs):
     """
@@ -45,19 +286,59 @@ def load_fhir(**kwargs):
                     type: object
                     properties:
                         paths:
-                            description: "Paths to FHIR files"
+                            description: "Paths to FHIR files.  Files ending in .ndjson or .jsonl are read as newline delimited resources (FHIR Bulk Data), all others as Bundles.  gzip, bz2, xz and zstd compressed files are decompressed while reading."
                             type: array
                             items:
                                 description: "/path/to/fhir/file"
                                 type: string
+                        num_workers:
+                            description: "Number of worker processes used to parse the files (null for one per CPU)"
+                            type: integer
+                            nullable: true
+                            minimum: 1
+                            default: 1
+                        decoder:
+                            description: "How resources are decoded.  \"fast\" skips fhir.resources validation and object construction."
+                            type: string
+                            enum: [strict, fast]
+                            default: strict
+                        append:
+                            description: "Add the files to the data that is already loaded instead of replacing it"
+                            type: boolean
+                            default: false
+                        use_cache:
+                            description: "Reuse and update cached parse results for files that haven't changed"
+                            type: boolean
+                            default: true
+                        max_messages:
+                            description: "Number of example messages returned for each kind of problem (grouped by file, category and code).  The rest are only counted in \"message_summary\"."
+                            type: integer
+                            minimum: 0
+                            default: 10
+                        message_log:
+                            description: "Path of a file to append every message to"
+                            type: string
+                            nullable: true
                     required: ["paths"]
     responses:
         200:
-            description: "FHIR data loaded"
+            description: "FHIR data loaded.  Besides the messages and patient IDs, the response includes a \"message_summary\" with message counts by kind and a \"timing\" report with the wall time, resource count and bytes of each ingest phase (cache, io, json, fhir, models and linking) and the slowest files."
             content:
                 application/json:
                     schema:
                         type: object
+        400:
+            description: "Invalid request"
+            content:
+                text/plain:
+                    schema:
+                        type: string
+        409:
+            description: "A load is already in progress, or the load was cancelled (e.g. by /reset)"
+            content:
+                text/plain:
+                    schema:
+                        type: string
         428:
             description: "No patients loaded"
             content:
@@ -65,31 +346,183 @@ def load_fhir(**kwargs):
                     schema:
                         type: object
     """
-    if kwargs.get(TEST_DATA_INDICATOR, False):
-        state = s.test
-    else:
-        state = s.train
+    state, target = get_state(kwargs)
 
-    paths = request.json.get('paths')
+    options, error = parse_load_options(state)
 
-    messages, state.patients, state.labs, state.vitals, state.medications = \
-        ingest.ingest_fhir(paths)
+    if error is not None:
+        return error
 
-    if state.patients is None:
-        patient_ids = []
-        code = 428
-    else:
-        patient_ids = list(state.patients.keys())
-        code = 200
+    job = jobs.run(target, load_job(state, options))
 
-    d = {
-        'messages': messages,
-        'patient_ids': patient_ids
-    }
+    if job is None:
+        return (
+            'A load is already in progress.', 409, {'Content-Type': 'text/plain'}
+        )
+
+    if job.status == jobs.CANCELLED:
+        return 'The load was cancelled.', 409, {'Content-Type': 'text/plain'}
+
+    d, code = job.result
 
     return jsonify(d), code
 
 
+@bp_fhir.route('/load_jobs', methods=['POST'])
+def start_load_job(**kwargs):
+    """
+    Start loading FHIR data in the background.
+
+    The data is only swapped into application state once the job completes.
+
+    ---
+    tags: ["FHIR"]
+    requestBody:
+        description: "Same options as /load"
+        content:
+            application/json:
+                schema:
+                    type: object
+    responses:
+        202:
+            description: "Job started, status returned"
+            content:
+                application/json:
+                    schema:
+                        type: object
+        400:
+            description: "Invalid request"
+            content:
+                text/plain:
+                    schema:
+                        type: string
+        409:
+            description: "A load is already in progress"
+            content:
+                text/plain:
+                    schema:
+                        type: string
+    """
+    state, target = get_state(kwargs)
+
+    options, error = parse_load_options(state)
+
+    if error is not None:
+        return error
+
+    run_job = load_job(state, options)
+
+    def run(progress):
+        d, code = run_job(progress)
+        d['status_code'] = code
+
+        return d
+
+    job = jobs.start(target, run)
+
+    if job is None:
+        return (
+            'A load is already in progress.', 409, {'Content-Type': 'text/plain'}
+        )
+
+    return jsonify(job.to_dict()), 202
+
+
+@bp_fhir.route('/load_jobs/<string:job_id>', methods=['GET'])
+def get_load_job(job_id, **kwargs):
+    """
+    Return the status of a background load.
+
+    ---
+    tags: ["FHIR"]
+    parameters:
+        - name: job_id
+          in: path
+          description: ID of the job of interest
+          required: true
+          schema:
+            type: string
+    responses:
+        200:
+            description: "Job status returned.  Once completed, it includes the same results as /load."
+            content:
+                application/json:
+                    schema:
+                        type: object
+        404:
+            description: "No job exists with identifier"
+            content:
+                text/plain:
+                    schema:
+                        type: string
+    """
+    job = get_job(job_id, kwargs)
+
+    if job is None:
+        return (
+            f'No job exists with identifier "{job_id}".',
+            404,
+            {'Content-Type': 'text/plain'}
+        )
+
+    return jsonify(job.to_dict())
+
+
+@bp_fhir.route('/load_jobs/<string:job_id>/cancel', methods=['POST'])
+def cancel_load_job(job_id, **kwargs):
+    """
+    Cancel a background load.  Previously loaded data is left in place.
+
+    ---
+    tags: ["FHIR"]
+    parameters:
+        - name: job_id
+          in: path
+          description: ID of the job of interest
+          required: true
+          schema:
+            type: string
+    responses:
+        202:
+            description: "Cancellation requested, status returned"
+            content:
+                application/json:
+                    schema:
+                        type: object
+        404:
+            description: "No job exists with identifier"
+            content:
+                text/plain:
+                    schema:
+                        type: string
+        409:
+            description: "Job has already finished"
+            content:
+                text/plain:
+                    schema:
+                        type: string
+    """
+    job = get_job(job_id, kwargs)
+
+    if job is None:
+        return (
+            f'No job exists with identifier "{job_id}".',
+            404,
+            {'Content-Type': 'text/plain'}
+        )
+
+    if not job.running:
+        return (
+            f'Job "{job_id}" has already finished.',
+            409,
+            {'Content-Type': 'text/plain'}
+        )
+
+    job.cancel()
+
+    return jsonify(job.to_dict()), 202
+
+
 @bp_fhir.route('/patients', methods=['GET'])
 @require_fhir
 def get_patients_summary(state, *args, **kwargs):
@@ -114,68 +547,117 @@ def get_patients_summary(state, *args, **kwargs):
                     schema:
                         type: string
     """
-    count = len(state.patients)
+    return jsonify(state.patients.summary())
 
-    gender_hist = defaultdict(int)
-    marital_hist = defaultdict(int)
-    race_hist = defaultdict(int)
-    ethnicity_hist = defaultdict(int)
 
-    for p in state.patients.values():
-        gender_hist[p.gender] += 1
+def encode_patient_cursor(sort, descending, value, patient_idx):
+    """
+    :param str sort: Field the patient list is sorted by, or ``None``.
+    :param bool descending: Whether it is sorted in descending order.
+    :param value: Value of the field for the last patient of a page.
+    :param int patient_idx: Index of the last patient of a page.
+    :return: Opaque cursor of the page that follows.
+    :rtype: str
+    """
+    return base64.urlsafe_b64encode(json.dumps(
+        [sort, descending, value, patient_idx]).encode('utf-8')).decode('ascii')
 
-        try:
-            marital_hist[p.maritalStatus.display] += 1
-        except AttributeError:
-            pass
 
-        try:
-            race_hist[p.race.display] += 1
-        except AttributeError:
-            pass
+def parse_patient_list_options():
+    """
+    Read the paging, projection, sorting and filtering options of a patient
+    list request.  Other query parameters (e.g. cache busters) are ignored.
+
+    :return: Tuple of the options and an error response.  At most one of the
+        two is not ``None``; both are if no options were given.
+    :rtype: tuple
+    """
+    args = request.args
+    summary_fields = PatientCollection.SUMMARY_FIELDS
+
+    if not any(k in args for k in PATIENT_LIST_OPTIONS + summary_fields):
+        return None, None
+
+    def error(msg):
+        return None, (msg, 400, {'Content-Type': 'text/plain'})
 
+    try:
+        limit = int(args.get('limit', current_app.config.get(
+            'PATIENT_LIST_PAGE_SIZE', DEFAULT_PAGE_SIZE)))
+    except ValueError:
+        return error('"limit" must be an integer.')
+
+    if limit < 1:
+        return error('"limit" must be positive.')
+
+    fields = args.get('fields')
+
+    if fields is not None:
+        fields = fields.split(',')
+
+        for field in fields:
+            if field not in summary_fields:
+                return error(f'Unknown field "{field}".  Allowed options are '
+                             f'{list(summary_fields)}.')
+
+    sort = args.get('sort')
+
+    if sort is not None and sort not in summary_fields:
+        return error(f'Unknown sort field "{sort}".  Allowed options are '
+                     f'{list(summary_fields)}.')
+
+    order = args.get('order', 'asc')
+
+    if order not in ('asc', 'desc'):
+        return error('"order" must be "asc" or "desc".')
+
+    descending = order == 'desc'
+
+    # The cursor holds the sort value and index of the last patient returned,
+    # so that pages don't shift when patients are added between requests.
+    cursor = args.get('cursor')
+
+    if cursor is not None:
         try:
-            ethnicity_hist[p.ethnicity.display] += 1
-        except AttributeError:
-            pass
+            cursor_sort, cursor_descending, value, patient_idx = json.loads(
+                base64.urlsafe_b64decode(cursor.encode('ascii')))
+        except (TypeError, ValueError):
+            return error('"cursor" is invalid.')
 
-    gender_hist.pop(None, None)
+        if (type(patient_idx) is not int or patient_idx < 0
+                or not isinstance(value, (str, int, type(None)))):
+            return error('"cursor" is invalid.')
 
-    d = {
-        'count': count,
-        'properties': {
-            'gender': {
-                'display': 'Gender',
-                'type': 'categorical',
-                'percentDefined': sum(gender_hist.values()) / count * 100.0,
-                'num_categories': len(gender_hist),
-                'histogram': gender_hist
-            },
-            'marital_status': {
-                'display': 'Marital Status',
-                'type': 'categorical',
-                'percentDefined': sum(marital_hist.values()) / count * 100.0,
-                'num_categories': len(marital_hist),
-                'histogram': marital_hist
-            },
-            'race': {
-                'display': 'Race',
-                'type': 'categorical',
-                'percentDefined': sum(race_hist.values()) / count * 100.0,
-                'num_categories': len(race_hist),
-                'histogram': race_hist
-            },
-            'ethnicity': {
-                'display': 'Ethnicity',
-                'type': 'categorical',
-                'percentDefined': sum(ethnicity_hist.values()) / count * 100.0,
-                'num_categories': len(ethnicity_hist),
-                'histogram': ethnicity_hist
-            }
-        }
-    }
+        if (cursor_sort, cursor_descending) != (sort, descending):
+            return error('"cursor" belongs to a list with another sort order.')
 
-    return jsonify(d)
+        cursor = (value, patient_idx)
+
+    # Parameters named after summary fields filter on their values.
+    filters = {}
+
+    for field in summary_fields:
+        if field not in args:
+            continue
+
+        value = args[field]
+
+        if field.startswith('num_'):
+            try:
+                value = int(value)
+            except ValueError:
+                return error(f'Filter on "{field}" must be an integer.')
+
+        filters[field] = value
+
+    return {
+        'cursor': cursor,
+        'limit': limit,
+        'fields': fields,
+        'sort': sort,
+        'descending': descending,
+        'filters': filters,
+    }, None
 
 
 @bp_fhir.route('/patient_list', methods=['GET'])
@@ -184,17 +666,78 @@ def get_patient_list(state, *args, **kwargs):
     """
     Return a list of all patients.
 
+    Without any of the query parameters below all patient summaries are
+    returned as an array.  With any of them, a page of summaries is returned
+    instead.  Other query parameters are ignored.
+
     ---
     tags: ["FHIR"]
+    parameters:
+        - name: cursor
+          in: query
+          description: "Cursor returned with the previous page as next_cursor.  Pages don't shift when data is appended between requests."
+          schema:
+            type: string
+        - name: limit
+          in: query
+          description: "Number of patients per page (default 100)."
+          schema:
+            type: integer
+            minimum: 1
+        - name: fields
+          in: query
+          description: "Comma separated summary fields to return, e.g. id,gender,num_notes."
+          schema:
+            type: string
+        - name: sort
+          in: query
+          description: "Summary field to sort on.  Missing values come last."
+          schema:
+            type: string
+        - name: order
+          in: query
+          schema:
+            type: string
+            enum:
+              - asc
+              - desc
+            default: asc
+        - name: filters
+          in: query
+          description: "Any other parameter named after a summary field (e.g. gender=female) only keeps patients with that value."
+          style: form
+          explode: true
+          schema:
+            type: object
+            additionalProperties:
+                type: string
     responses:
         200:
-            description: "Patient list returned"
+            description: "Patient list, or page of it, returned"
             content:
                 application/json:
                     schema:
-                        type: array
-                        items:
-                            type: object
+                        oneOf:
+                          - type: array
+                            items:
+                                type: object
+                          - type: object
+                            properties:
+                                data:
+                                    type: array
+                                    items:
+                                        type: object
+                                next_cursor:
+                                    type: string
+                                    nullable: true
+                                total:
+                                    type: integer
+        400:
+            description: "Invalid parameters"
+            content:
+                text/plain:
+                    schema:
+                        type: string
         428:
             description: "No FHIR data currently in application state"
             content:
@@ -202,8 +745,63 @@ def get_patient_list(state, *args, **kwargs):
                     schema:
                         type: string
     """
+    patients = state.patients
+    options, error = parse_patient_list_options()
+
+    if error is not None:
+        return error
+
+    if options is None:
+        # Patients cache their serialized summaries, so the list is served by
+        # joining them.
+        return current_app.response_class(
+            b'[' + b','.join(p.to_json_summary() for p in patients.values())
+            + b']',
+            mimetype='application/json')
+
+    if options['sort'] is not None:
+        order = patients.sort_index(options['sort'], options['descending'])
+    else:
+        order = np.arange(len(patients))
+
+    for field, value in options['filters'].items():
+        order = order[patients.summary_column(field)[order] == value]
+
+    if options['cursor'] is not None:
+        start = patients.position_after(order, options['sort'],
+                                        options['descending'],
+                                        *options['cursor'])
+    else:
+        start = 0
+
+    end = start + options['limit']
+    page = order[start:end].tolist()
+
+    if options['fields'] is None:
+        rows = [patients[patients.ids[i]].to_json_summary() for i in page]
+    else:
+        columns = [(f, patients.summary_column(f)) for f in options['fields']]
+        rows = [
+            json.dumps({f: column[i] for f, column in columns},
+                       sort_keys=True, separators=(',', ':')).encode('utf-8')
+            for i in page
+        ]
+
+    if end < len(order):
+        last = page[-1]
+        next_cursor = json.dumps(encode_patient_cursor(
+            options['sort'], options['descending'],
+            (patients.summary_column(options['sort'])[last]
+             if options['sort'] is not None else None),
+            last))
+    else:
+        next_cursor = 'null'
 
-    return jsonify([state.patients.get(patient).to_dict_summary() for patient in state.patients])
+    return current_app.response_class(
+        b'{"data":[' + b','.join(rows) + b'],"next_cursor":'
+        + next_cursor.encode('utf-8') + b',"total":'
+        + str(len(order)).encode('utf-8') + b'}',
+        mimetype='application/json')
 
 
 @bp_fhir.route('/patient/<string:patient_id>', methods=['GET'])
@@ -252,7 +850,9 @@ def get_patient_summary(state, patient_id, *args, **kwargs):
             {'Content-Type': 'text/plain'}
         )
 
-    return jsonify(p.to_dict())
+    return current_app.response_class(
+        p.to_json(state.labs.store, state.vitals.store),
+        mimetype='application/json')
 
 
 @bp_fhir.route('/patient/<string:patient_id>/details/<string:detail_type>',
@@ -341,13 +941,13 @@ def get_patient_details(state, patient_id, detail_type, *args, **kwargs):
         )
 
     lut = {
-        'lab': p.labs,
-        'vital': p.vitals,
-        'medication': p.medications
+        'lab': (p.labs, state.labs.store),
+        'vital': (p.vitals, state.vitals.store),
+        'medication': (p.medications, None)
     }
 
     try:
-        data = lut[detail_type.lower()].data
+        container, store = lut[detail_type.lower()]
     except KeyError:
         return (
             f'Unsupported detail type "{detail_type}".  '
@@ -356,9 +956,13 @@ def get_patient_details(state, patient_id, detail_type, *args, **kwargs):
             {'Content-Type': 'text/plain'}
         )
 
-    try:
-        entries = data.get(CodeValue(code, system)).data
-    except AttributeError:
+    if store is not None:
+        entries = store.details(p.index, CodeValue(code, system))
+    else:
+        aggregator = container.data.get(CodeValue(code, system))
+        entries = aggregator.data if aggregator is not None else None
+
+    if entries is None:
         return (
             f'No {detail_type} exists with system/code: ({system}, {code}).',
             404,
@@ -515,3 +1119,67 @@ def get_medications_summary(state, *args, **kwargs):
                         type: string
     """
     return jsonify(state.medications.to_dict())
+
+
+@bp_fhir.route('/cohort', methods=['POST'])
+@require_fhir
+def get_cohort(state, *args, **kwargs):
+    """
+    Find the patients matching a combination of codes.
+
+    ---
+    tags: ["FHIR"]
+    requestBody:
+        description: "Cohort query"
+        content:
+            application/json:
+                schema:
+                    type: object
+                    properties:
+                        query:
+                            type: object
+                            description: "Either {\"and\": [query, ...]}, {\"or\": [query, ...]}, {\"not\": query} or a code: {\"type\": \"labs\" | \"vitals\" | \"medications\", \"system\": string, \"code\": string}."
+                    required:
+                      - query
+    responses:
+        200:
+            description: "Matching patients returned"
+            content:
+                application/json:
+                    schema:
+                        type: object
+                        properties:
+                            count:
+                                type: integer
+                            patient_ids:
+                                type: array
+                                items:
+                                    type: string
+        400:
+            description: "Invalid query"
+            content:
+                text/plain:
+                    schema:
+                        type: string
+        428:
+            description: "No FHIR data currently in application state"
+            content:
+                text/plain:
+                    schema:
+                        type: string
+    """
+    luts = {
+        'labs': state.labs,
+        'vitals': state.vitals,
+        'medications': state.medications,
+    }
+
+    try:
+        bitmap = cohort.evaluate((request.json or {}).get('query'), luts,
+                                 len(state.patients.ids))
+    except ValueError as e:
+        return str(e), 400, {'Content-Type': 'text/plain'}
+
+    patient_ids = [state.patients.ids[i] for i in cohort.indices(bitmap)]
+
+    return jsonify({'count': len(patient_ids), 'patient_ids': patient_ids})
@@ -4,12 +4,18 @@ import datetime
 import logging
 import re
 
-from flask import Blueprint, jsonify, request
+from flask import Blueprint, current_app, jsonify, request
 import numpy as np
 import pandas as pd
 import sklearn
 
 from clarkproc.engine import classification, onehot
+from clarkproc.engine.featurize import NotePool, count_matches
+from clarkproc.engine.regexscan import (DEFAULT_CACHE_SIZE, RegexCache,
+                                        RegexScanner)
+from clarkproc.engine.sections import SectionSplitter
+from clarkproc.fhir.store import (WINDOW_FEATURES, ObservationStore,
+                                  to_timestamp)
 import clarkproc.state as state
 
 LOGGER = logging.getLogger(__name__)
@@ -33,6 +39,15 @@ other_age_categories = {
     # '<18': (0, 18),
 }
 
+# Features that can be computed over a time window, by kind of resource.
+window_features = {
+    'labs': WINDOW_FEATURES,
+    'vitals': WINDOW_FEATURES,
+    'meds': ('count', 'boolean'),
+}
+
+DAY = 24 * 60 * 60 * 10**6  # in microseconds, see fhir.store.to_timestamp
+
 @bp_ml.route('/classifiers')
 def get_classifiers():
     """
@@ -54,19 +69,6 @@ def get_classifiers():
     return jsonify(classifiers)
 
 
-def default_lab():
-    """Generate default lab features.
-
-    Used in case a patient has a missing lab.
-    """
-    return {
-        'min': None,
-        'max': None,
-        'newest': None,
-        'oldest': None,
-    }
-
-
 def default_medication():
     """Generate default medication features.
 
@@ -87,70 +89,357 @@ def num_matches(pattern, string):
         return 0
 
 
-def notes_to_features(notes, plan):
-    """Extract regex features from note."""
+def get_regex_cache():
+    """
+    :return: The application's cache of compiled regexes, sized by
+        ``REGEX_CACHE_SIZE``.
+    :rtype: RegexCache
+    """
+    cache = current_app.extensions.get('regex_cache')
+
+    if cache is None:
+        cache = current_app.extensions['regex_cache'] = RegexCache(
+            current_app.config.get('REGEX_CACHE_SIZE', DEFAULT_CACHE_SIZE))
+
+    return cache
+
+
+def get_note_pool():
+    """
+    :return: The application's pool of processes to extract note features
+        with, of ``NOTE_WORKERS`` processes (``None`` for one per CPU), or
+        ``None`` to extract them in this process.
+    :rtype: NotePool
+    """
+    num_workers = current_app.config.get('NOTE_WORKERS', 1)
+
+    if num_workers is not None and num_workers < 2:
+        return None
+
+    pool = current_app.extensions.get('note_pool')
+
+    if pool is None:
+        pool = current_app.extensions.setdefault('note_pool',
+                                                 NotePool(num_workers))
+
+    return pool
+
+
+def check_regexes(plan, regex_cache):
+    """
+    Compile all regexes of the unstructured part of a feature plan, so that
+    invalid ones are reported before any features are extracted.
+
+    :param dict plan: Unstructured part of the feature plan.
+    :param RegexCache regex_cache: Cache to compile the regexes into.
+    :raises ValueError: If a regex is invalid.
+    """
+    sections_plan = plan.get('sections', {})
+    regexes = [('section_break', sections_plan.get('section_break'))]
+    regexes += [('section tag', tag.get('regex'))
+                for tag in sections_plan.get('tags', [])]
+    regexes += [('feature', feature.get('regex'))
+                for feature in plan.get('features', [])]
+
+    for what, regex in regexes:
+        if regex is None and what == 'section_break':
+            continue
+
+        try:
+            regex_cache.compile(regex)
+        except (re.error, TypeError) as e:
+            raise ValueError(
+                f'Invalid {what} regular expression {regex!r} ({e}).')
+
+
+def section_splitter(plan, regex_cache=None, section_cache=None):
+    """
+    :param dict plan: Unstructured part of the feature plan.
+    :param RegexCache regex_cache: Cache to compile the section regexes
+        through.
+    :param SectionCache section_cache: Cache of the corpus' note sections.
+    :return: Splitter of notes into the plan's sections.
+    :rtype: SectionSplitter
+    """
     sections_plan = plan.get('sections', {})
-    tags = sections_plan.get('tags', [])
-    section_break = sections_plan.get('section_break', None)
-    ignore_header = sections_plan.get('ignore_header', False)
-    ignore_untagged = sections_plan.get('ignore_untagged', False)
+    compile_regex = regex_cache.compile if regex_cache is not None else re.compile
+    cache = section_cache.get(sections_plan) if section_cache is not None else None
+
+    return SectionSplitter(sections_plan, compile_regex, cache)
+
+
+def notes_to_features(notes, plan, scanner=None, regex_cache=None,
+                      splitter=None, note_keys=None):
+    """
+    Extract regex features from note.
+
+    :param list notes: Text of the notes.
+    :param dict plan: Unstructured part of the feature plan.
+    :param RegexScanner scanner: Scanner of the plan's feature regexes, which
+        should be built once when extracting features from many patients.
+    :param RegexCache regex_cache: Cache to compile the section regexes
+        through.
+    :param SectionSplitter splitter: Splitter of notes into the plan's
+        sections, see :func:`section_splitter`.
+    :param list note_keys: Keys of the notes in the splitter's cache.
+    """
+    if splitter is None:
+        splitter = section_splitter(plan, regex_cache)
+    if note_keys is None:
+        note_keys = [None] * len(notes)
     features = plan.get('features', [])
+    if scanner is None:
+        scanner = RegexScanner((feature['regex'] for feature in features),
+                               regex_cache)
     occurrences = {
         feature['regex']: 0
         for feature in features
     }
-    for note in notes:
-        if section_break is not None:
-            breaks = [match.span() for match in re.finditer(section_break, note)]
-        else:
-            breaks = []
-        if breaks:
-            header = note[:breaks[0][0]]
-            sections = dict(
-                (note[breaks[i][0]:breaks[i][1]], note[breaks[i][0]:breaks[i + 1][0]])
-                if i < len(breaks) - 1
-                else (note[breaks[i][0]:breaks[i][1]], note[breaks[i][0]:])
-                for i in range(len(breaks))
-            )
-        else:
-            header = note
-            sections = dict()
-        # tag sections
-        sections = {
-            tuple(
-                tag.get('ignore', False)
-                for tag in tags
-                if re.match(tag['regex'], key)
-            ): value
-            for key, value in sections.items()
-        }
-        # filter sections
-        sections = [
-            value
-            for key, value in sections.items()
-            if not any(key) and (key or not ignore_untagged)
-        ]
-        if not ignore_header:
-            sections.append(header)
-        for section in sections:
-            for feature in features:
-                occurrences[feature['regex']] += len(re.findall(feature['regex'], section))
+    for note, key in zip(notes, note_keys):
+        for section in splitter.sections(note, key):
+            for regex, count in scanner.count(section).items():
+                occurrences[regex] += count
     return occurrences
 
 
-def fhir_to_dataframe(patients, plan):
-    """Convert FHIR data to Pandas DataFrame according to features specified."""
+def note_feature_matrix(patients, plan, regexes, regex_cache=None,
+                        section_cache=None, pool=None):
+    """
+    Count the matches of regexes in the notes of every patient.
+
+    :param PatientCollection patients: Patients to extract features from.
+    :param dict plan: Unstructured part of the feature plan.  Only its
+        sections are used.
+    :param list regexes: Regular expressions to count the matches of, without
+        duplicates.
+    :param RegexCache regex_cache: Cache to compile the regexes through.
+    :param SectionCache section_cache: Cache of the patients' note sections.
+    :param NotePool pool: Worker processes to spread the work over, if any.
+    :return: Counts with a row per patient, in the collection's order, and a
+        column per regex.
+    :rtype: numpy.ndarray
+    """
+    splitter = section_splitter(plan, regex_cache, section_cache)
+
+    if pool is not None:
+        # The workers read notes from the note store themselves, so only send
+        # them the location of the text of the notes that are in it.
+        notes = []
+        note_store = None
+
+        for row, patient in enumerate(patients.values()):
+            for note_id, note in patient.notes.items():
+                location = note.location
+
+                if location is not None and note_store is None:
+                    note_store = location[0]
+
+                if location is not None and location[0] is note_store:
+                    text = location[1:]
+                else:
+                    text = note.data
+
+                notes.append((row, (patient.id, note_id), text))
+
+        return pool.feature_matrix(splitter, regexes, notes, len(patients),
+                                   regex_cache, note_store)
+
+    notes = [
+        (row, (patient.id, note_id), note.data)
+        for row, patient in enumerate(patients.values())
+        for note_id, note in patient.notes.items()
+    ]
+
+    return count_matches(splitter, RegexScanner(regexes, regex_cache), notes,
+                         len(patients))
+
+
+def cached_note_feature_matrix(patients, plan, regexes, regex_cache=None,
+                               section_cache=None, pool=None,
+                               coverage_cache=None):
+    """
+    Same as :func:`note_feature_matrix`, but the matches of regexes that are
+    in ``coverage_cache`` aren't counted again, and the others are added to
+    it.
+
+    :param MatchCountCache coverage_cache: Cache of the patients' match
+        counts.
+    """
+    sections_plan = plan.get('sections', {})
+    counts = (coverage_cache.get(sections_plan, regexes)
+              if coverage_cache is not None else {})
+    missing = [regex for regex in regexes if regex not in counts]
+
+    if missing:
+        matrix = note_feature_matrix(patients, plan, missing, regex_cache,
+                                     section_cache, pool)
+
+        if coverage_cache is not None:
+            coverage_cache.put(sections_plan, {
+                regex: matrix[:, i] for i, regex in enumerate(missing)})
+
+        if len(missing) == len(regexes):
+            return matrix
+
+        counts.update((regex, matrix[:, i]) for i, regex in enumerate(missing))
+
+    matrix = np.zeros((len(patients), len(regexes)), dtype=np.int32)
+
+    for i, regex in enumerate(regexes):
+        matrix[:, i] = counts[regex]
+
+    return matrix
+
+
+def observation_features(store, requested, reference=None, windows=()):
+    """
+    Compute the requested lab or vital features of every patient at once.
+
+    :param ObservationStore store: Columnar store of the corpus' labs or
+        vitals.
+    :param dict requested: Lab or vital part of the feature plan.
+    :param int reference: Reference time of the windows, see
+        :func:`reference_time`.
+    :param list windows: (code label, days, feature) of the windowed features,
+        see :func:`parse_windows`.
+    :return: Mapping of feature name to the feature values by patient index.
+    :rtype: dict
+    """
+    columns = {
+        f'{requested_id} {key}': store.feature(requested_id, key)
+        for requested_id, requested_obs in requested.items()
+        for key in requested_obs.get('features', [])
+    }
+    columns.update({
+        f'{label} {feature} {days}d': store.window_feature(
+            label, feature, reference - days * DAY + 1, reference)
+        for label, days, feature in windows
+    })
+
+    return columns
+
+
+def reference_time(reference_date_string):
+    """
+    :param str reference_date_string: ISO 8601 date or date/time.
+    :return: Timestamp (see :func:`clarkproc.fhir.store.to_timestamp`) of the
+        reference date/time.  A date refers to the end of that day.
+    :rtype: int
+    """
+    if 'T' not in reference_date_string:
+        day = datetime.date.fromisoformat(reference_date_string)
+        return to_timestamp(day + datetime.timedelta(days=1)) - 1
+
+    return to_timestamp(datetime.datetime.fromisoformat(
+        reference_date_string.replace('Z', '+00:00')))
+
+
+def parse_windows(structured_plan):
+    """
+    Validate the time windows requested in the structured part of a feature
+    plan.
+
+    A window of ``days`` covers the time from ``days`` days before the
+    reference date (exclusive) to the reference date (inclusive), so a 90 day
+    window relative to a date covers that day and the 89 days before it.  The
+    reference date is ``reference_date`` if given, otherwise the one used for
+    ages.
+
+    :param dict structured_plan: ``structured_data`` part of the feature plan.
+    :return: Reference time (``None`` if no windows were requested) and a
+        mapping of resource kind to list of (code label, days, feature).
+    :rtype: tuple
+    :raises ValueError: If the windows or reference date are invalid.
+    """
+    windows = {kind: [] for kind in window_features}
+
+    for kind, allowed in window_features.items():
+        for label, requested in structured_plan.get(kind, {}).items():
+            for window in requested.get('windows', []):
+                days = window.get('days')
+
+                if isinstance(days, bool) or not isinstance(days, int) or days <= 0:
+                    raise ValueError(f'Window days of {label} must be a '
+                                     f'positive integer, not {days!r}.')
+
+                for feature in window.get('features', []):
+                    if feature not in allowed:
+                        raise ValueError(f'Feature "{feature}" of {label} is '
+                                         f'not available over a window.')
+
+                    windows[kind].append((label, days, feature))
+
+    if not any(windows.values()):
+        return None, windows
+
+    reference_date_string = structured_plan.get(
+        'reference_date',
+        structured_plan.get('patient', {}).get('age', {}).get('reference_date'))
+
+    if reference_date_string is None:
+        raise ValueError('A reference_date is required for windowed features.')
+
+    try:
+        return reference_time(reference_date_string), windows
+    except (TypeError, ValueError):
+        raise ValueError(f'Invalid reference_date "{reference_date_string}".')
+
+
+def fhir_to_dataframe(patients, plan, lab_store=None, vital_store=None,
+                      regex_cache=None, section_cache=None, pool=None,
+                      coverage_cache=None):
+    """
+    Convert FHIR data to Pandas DataFrame according to features specified.
+
+    :param PatientCollection patients: Patients to convert.
+    :param dict plan: Feature plan.
+    :param ObservationStore lab_store: Columnar store of the patients' labs.
+        Built from the patients if needed and not given.
+    :param ObservationStore vital_store: Columnar store of the patients'
+        vitals.  Built from the patients if needed and not given.
+    :param RegexCache regex_cache: Cache to compile the plan's regexes
+        through.
+    :param SectionCache section_cache: Cache of the patients' note sections.
+    :param NotePool pool: Worker processes to extract note features with, if
+        any.
+    :param MatchCountCache coverage_cache: Cache of the patients' note match
+        counts, shared with coverage requests.
+    :raises ValueError: If the plan's time windows are invalid.
+    """
     patient_plan = plan['structured_data'].get('patient', {})
-    requested_labs = plan['structured_data'].get('labs', [])
-    requested_meds = plan['structured_data'].get('meds', [])
+    requested_meds = plan['structured_data'].get('meds', {})
+    reference, windows = parse_windows(plan['structured_data'])
+
+    # Lab and vital features are computed for all patients at once, a column
+    # at a time.
+    observation_columns = {}
+    for kind, store in (('labs', lab_store), ('vitals', vital_store)):
+        requested = plan['structured_data'].get(kind, {})
+
+        if not requested:
+            continue
+
+        if store is None:
+            store = ObservationStore(patients, kind)
+
+        observation_columns.update(observation_features(
+            store, requested, reference, windows[kind]))
 
     # prepare reference date for age calculation
     if 'age' in patient_plan:
         reference_date_string = patient_plan['age']['reference_date']
         reference_date = datetime.date.fromisoformat(reference_date_string.split('T')[0])
 
+    # Note features are also computed for all patients at once.
+    regexes = list(dict.fromkeys(
+        feature['regex']
+        for feature in plan['unstructured_data'].get('features', [])))
+    note_matrix = cached_note_feature_matrix(
+        patients, plan['unstructured_data'], regexes, regex_cache,
+        section_cache, pool, coverage_cache)
+
     features = []
-    for patient_id in patients:
+    for row, patient_id in enumerate(patients):
         patient = patients.get(patient_id)
         patient_features = {
             'id': patient.id,
@@ -158,9 +447,7 @@ def fhir_to_dataframe(patients, plan):
         }
 
         # "notes" features
-        notes = [note.data for note_id, note in patient.notes.items()]
-        new_features = notes_to_features(notes, plan['unstructured_data'])
-        patient_features.update(new_features)
+        patient_features.update(zip(regexes, note_matrix[row].tolist()))
 
         # "patient" features
         if 'numeric' in patient_plan.get('age', {}).get('features', []):
@@ -195,16 +482,10 @@ def fhir_to_dataframe(patients, plan):
         if 'one-hot' in patient_plan.get('gender', {}).get('features', []):
             patient_features['gender'] = patient.gender
 
-        # "labs" features
-        patient_labs = defaultdict(default_lab)
-        patient_labs.update({
-            f'({k.system}, {k.code})': v.to_dict()
-            for k, v in patient.labs
-        })
+        # "labs" and "vitals" features
         patient_features.update({
-            f'{requested_lab_id} {key}': patient_labs[requested_lab_id][key]
-            for requested_lab_id, requested_lab in requested_labs.items()
-            for key in requested_lab['features']
+            name: column[patient.index]
+            for name, column in observation_columns.items()
         })
 
         # "meds" features
@@ -216,8 +497,19 @@ def fhir_to_dataframe(patients, plan):
         patient_features.update({
             f'{requested_med_id} {key}': patient_meds[requested_med_id][key]
             for requested_med_id, requested_med in requested_meds.items()
-            for key in requested_med['features']
+            for key in requested_med.get('features', [])
         })
+        if windows['meds']:
+            med_aggregators = {
+                f'({k.system}, {k.code})': v
+                for k, v in patient.medications
+            }
+            for label, days, feature in windows['meds']:
+                aggregator = med_aggregators.get(label)
+                count = 0 if aggregator is None else aggregator.count_between(
+                    reference - days * DAY + 1, reference)
+                patient_features[f'{label} {feature} {days}d'] = (
+                    count if feature == 'count' else count > 0)
 
         features.append(patient_features)
     df = pd.DataFrame(features)
@@ -270,6 +562,12 @@ def compute_coverage():
                 application/json:
                     schema:
                         type: object
+        400:
+            description: "Invalid regular expression"
+            content:
+                text/plain:
+                    schema:
+                        type: string
         428:
             description: "No corpus loaded"
             content:
@@ -280,16 +578,23 @@ def compute_coverage():
     if not state.train.patients:
         return 'No data loaded.', 428
 
-    occurrences = defaultdict(int)
-    for patient_id in state.train.patients:
-        patient = state.train.patients.get(patient_id)
+    regex_cache = get_regex_cache()
 
-        # "notes" features
-        notes = [note.data for note_id, note in patient.notes.items()]
-        new_features = notes_to_features(notes, request.json)
-        for feature in request.json['features']:
-            occurrences[feature['regex']] += 1 if new_features[feature['regex']] else 0
-    return occurrences
+    try:
+        check_regexes(request.json, regex_cache)
+    except ValueError as e:
+        return str(e), 400, {'Content-Type': 'text/plain'}
+
+    # Only regexes that aren't cached for the sections plan yet are run.
+    regexes = list(dict.fromkeys(
+        feature['regex'] for feature in request.json['features']))
+    matrix = cached_note_feature_matrix(
+        state.train.patients, request.json, regexes, regex_cache,
+        state.train.section_cache, get_note_pool(),
+        state.train.coverage_cache)
+
+    return {regex: int(np.count_nonzero(matrix[:, i]))
+            for i, regex in enumerate(regexes)}
 
 
 @bp_ml.route('/go', methods=['POST'])
@@ -372,6 +677,9 @@ def apply_ml():
                                                           - "one-hot"
                                             required:
                                               - features
+                                reference_date:
+                                    type: string
+                                    description: "Date (end of day) or date/time that windows end at.  Defaults to the age reference_date."
                                 labs:
                                     type: object
                                     additionalProperties:
@@ -386,6 +694,34 @@ def apply_ml():
                                                       - max
                                                       - newest
                                                       - oldest
+                                                      - mean
+                                                      - std
+                                                      - median
+                                                      - p90
+                                            windows:
+                                                type: array
+                                                description: "Features over the observations of the last days up to the reference date, named \"{code} {feature} {days}d\"."
+                                                items:
+                                                    type: object
+                                                    properties:
+                                                        days:
+                                                            type: integer
+                                                            minimum: 1
+                                                        features:
+                                                            type: array
+                                                            items:
+                                                                type: string
+                                                                enum:
+                                                                  - count
+                                                                  - boolean
+                                                                  - min
+                                                                  - max
+                                                                  - mean
+                                                                  - newest
+                                                                  - oldest
+                                                    required:
+                                                      - days
+                                                      - features
                                 meds:
                                     type: object
                                     additionalProperties:
@@ -398,6 +734,25 @@ def apply_ml():
                                                     enum:
                                                       - count
                                                       - boolean
+                                            windows:
+                                                type: array
+                                                description: "Features over the medications authored in the last days up to the reference date, named \"{code} {feature} {days}d\"."
+                                                items:
+                                                    type: object
+                                                    properties:
+                                                        days:
+                                                            type: integer
+                                                            minimum: 1
+                                                        features:
+                                                            type: array
+                                                            items:
+                                                                type: string
+                                                                enum:
+                                                                  - count
+                                                                  - boolean
+                                                    required:
+                                                      - days
+                                                      - features
                                 vitals:
                                     type: object
                                     additionalProperties:
@@ -412,6 +767,34 @@ def apply_ml():
                                                       - max
                                                       - newest
                                                       - oldest
+                                                      - mean
+                                                      - std
+                                                      - median
+                                                      - p90
+                                            windows:
+                                                type: array
+                                                description: "Features over the observations of the last days up to the reference date, named \"{code} {feature} {days}d\"."
+                                                items:
+                                                    type: object
+                                                    properties:
+                                                        days:
+                                                            type: integer
+                                                            minimum: 1
+                                                        features:
+                                                            type: array
+                                                            items:
+                                                                type: string
+                                                                enum:
+                                                                  - count
+                                                                  - boolean
+                                                                  - min
+                                                                  - max
+                                                                  - mean
+                                                                  - newest
+                                                                  - oldest
+                                                    required:
+                                                      - days
+                                                      - features
                         unstructured_data:
                             type: object
                             properties:
@@ -494,6 +877,12 @@ def apply_ml():
                 application/json:
                     schema:
                         type: object
+        400:
+            description: "Invalid time windows, reference date or regular expression"
+            content:
+                text/plain:
+                    schema:
+                        type: string
         428:
             description: "No corpus loaded"
             content:
@@ -504,12 +893,24 @@ def apply_ml():
     if not state.train.patients:
         return 'No data loaded.', 428
 
+    regex_cache = get_regex_cache()
+    note_pool = get_note_pool()
+
+    try:
+        parse_windows(request.json['structured_data'])
+        check_regexes(request.json['unstructured_data'], regex_cache)
+    except ValueError as e:
+        return str(e), 400, {'Content-Type': 'text/plain'}
+
     classifier_name = request.json['algo']['algo_type']
 
     # set_feature_expressions()
     clf = classification.build_classifier(classifier_name)
 
-    df_train = fhir_to_dataframe(state.train.patients, request.json)
+    df_train = fhir_to_dataframe(state.train.patients, request.json,
+                                 state.train.labs.store, state.train.vitals.store,
+                                 regex_cache, state.train.section_cache,
+                                 note_pool, state.train.coverage_cache)
 
     y_train = df_train['label']
 
@@ -586,7 +987,10 @@ def apply_ml():
         df_train = encoder.apply(df_train)
         ds_train = classification.DataSet(df_train.to_numpy().astype(float), list(y_train))
 
-        df_test = fhir_to_dataframe(state.test.patients, request.json)
+        df_test = fhir_to_dataframe(state.test.patients, request.json,
+                                    state.test.labs.store, state.test.vitals.store,
+                                    regex_cache, state.test.section_cache,
+                                    note_pool, state.test.coverage_cache)
         y_test = df_test['label']
         df_test = df_test.drop(columns='label')
         df_test = encoder.apply(df_test)
@@ -0,0 +1,200 @@
+"""
+Persistent cache of parsed FHIR files.
+
+Parsing is by far the slowest part of loading a corpus, and users frequently
+reload the same files (e.g. after restarting the application).  The result of
+parsing each file is therefore stored on disk, keyed by the file's path, and
+reused as long as the file hasn't changed.
+"""
+import hashlib
+import logging
+import os
+import pickle
+import tempfile
+import zlib
+
+LOGGER = logging.getLogger(__name__)
+
+# Bump whenever the models or the parse results change shape (including when a
+# pickled model gains or loses a slot) so that stale entries are discarded
+# rather than unpickled into the wrong structure.  test_ingest records the
+# shapes each version was written with.
+CACHE_VERSION = 3
+
+DEFAULT_MAX_BYTES = 2 * 1024 ** 3
+
+_ENTRY_SUFFIX = '.ingest'
+_HASH_BLOCK_SIZE = 1 << 20
+
+
+def file_hash(path):
+    """
+    :param str path: Path of the file to hash.
+    :return: Hex digest of the file contents.
+    :rtype: str
+    """
+    h = hashlib.blake2b(digest_size=20)
+
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(_HASH_BLOCK_SIZE), b''):
+            h.update(block)
+
+    return h.hexdigest()
+
+
+class IngestCache:
+    """
+    On-disk cache of parse results, one entry file per input file.
+
+    Each entry starts with a small pickled header describing the input file it
+    was made from, followed by the zlib compressed, pickled parse result.  The
+    header is checked before the (much larger) result is read.  An entry is
+    valid if the input file still has the same size and modification time or,
+    if content hashing is enabled, the same size and content hash.  The latter
+    survives files being copied or touched without being changed.
+
+    Entries are evicted least recently used first once the cache grows beyond
+    its size limit.
+    """
+
+    def __init__(self, directory, max_bytes=DEFAULT_MAX_BYTES, use_hash=False):
+        """
+        :param str directory: Directory to store cache entries in.  It is
+            created if needed.
+        :param int max_bytes: Size the cache is trimmed to by :meth:`evict`.
+        :param bool use_hash: Validate entries by content hash rather than by
+            modification time.
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.use_hash = use_hash
+
+        os.makedirs(directory, exist_ok=True)
+
+    def _entry_path(self, path, variant):
+        key = hashlib.sha1('{}\0{}'.format(
+            os.path.abspath(path), variant).encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, key + _ENTRY_SUFFIX)
+
+    def _describe(self, path, variant, with_hash):
+        st = os.stat(path)
+
+        return {
+            'version': CACHE_VERSION,
+            'path': os.path.abspath(path),
+            'variant': variant,
+            'size': st.st_size,
+            'mtime_ns': st.st_mtime_ns,
+            'hash': file_hash(path) if with_hash else None,
+        }
+
+    def _is_valid(self, header, path, variant):
+        current = self._describe(path, variant, with_hash=False)
+
+        if any(header.get(k) != current[k]
+               for k in ('version', 'path', 'variant', 'size')):
+            return False
+
+        if self.use_hash:
+            return (header.get('hash') is not None and
+                    header['hash'] == file_hash(path))
+
+        return header.get('mtime_ns') == current['mtime_ns']
+
+    def get(self, path, variant=None):
+        """
+        :param str path: Path of the input file.
+        :param str variant: Distinguishes results of parsing the same file in
+            different ways.
+        :return: Cached parse result for the file, or ``None`` if there is no
+            valid entry.
+        """
+        entry_path = self._entry_path(path, variant)
+
+        try:
+            with open(entry_path, 'rb') as f:
+                if not self._is_valid(pickle.load(f), path, variant):
+                    return None
+
+                result = pickle.loads(zlib.decompress(f.read()))
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            LOGGER.warning('Discarding unreadable ingest cache entry for '
+                           '"%s" (%s).', path, e)
+            self._remove(entry_path)
+            return None
+
+        # Mark the entry as recently used for eviction purposes.
+        try:
+            os.utime(entry_path)
+        except OSError:
+            pass
+
+        return result
+
+    def put(self, path, result, variant=None):
+        """
+        Store the parse result for an input file, replacing any existing entry.
+
+        :param str path: Path of the input file.
+        :param str variant: Distinguishes results of parsing the same file in
+            different ways.
+        :param result: Parse result to store.  Must be picklable.
+        """
+        try:
+            header = self._describe(path, variant, with_hash=self.use_hash)
+            payload = zlib.compress(
+                pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL), 1)
+
+            # Write to a temporary file first so that readers never see a
+            # partially written entry.
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory)
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    pickle.dump(header, f, protocol=pickle.HIGHEST_PROTOCOL)
+                    f.write(payload)
+                os.replace(tmp_path, self._entry_path(path, variant))
+            except BaseException:
+                self._remove(tmp_path)
+                raise
+        except Exception as e:
+            # Failing to cache must never fail the load itself.
+            LOGGER.warning('Failed to cache ingest results for "%s" (%s).',
+                           path, e)
+
+    def evict(self):
+        """Remove least recently used entries until the cache fits within
+        :attr:`max_bytes`."""
+        entries = []
+        total = 0
+
+        with os.scandir(self.directory) as it:
+            for e in it:
+                if e.name.endswith(_ENTRY_SUFFIX):
+                    st = e.stat()
+                    entries.append((st.st_mtime_ns, st.st_size, e.path))
+                    total += st.st_size
+
+        entries.sort()
+
+        for _, size, entry_path in entries:
+            if total <= self.max_bytes:
+                break
+
+            self._remove(entry_path)
+            total -= size
+
+    def clear(self):
+        """Remove all entries."""
+        with os.scandir(self.directory) as it:
+            for e in it:
+                if e.name.endswith(_ENTRY_SUFFIX):
+                    self._remove(e.path)
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
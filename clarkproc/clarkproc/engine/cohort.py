@@ -0,0 +1,88 @@
+"""
+Cohort queries over the codes of a loaded corpus.
+
+A query is a JSON expression combining codes with ``and``, ``or`` and
+``not``, for instance "patients with lab A and medication C but not lab B"::
+
+    {"and": [
+        {"type": "labs", "system": "http://loinc.org", "code": "A"},
+        {"type": "medications", "system": "...", "code": "C"},
+        {"not": {"type": "labs", "system": "http://loinc.org", "code": "B"}}
+    ]}
+
+It is answered with bitwise operations on the patient bitmaps of the lookup
+tables (see :attr:`clarkproc.fhir.containers.CodedResourceItem.patients`).
+"""
+import numpy as np
+
+from clarkproc.fhir.models import CodeValue
+
+TYPES = ('labs', 'vitals', 'medications')
+
+
+def evaluate(expression, luts, num_patients):
+    """
+    :param dict expression: Query to evaluate.
+    :param dict luts: Lookup table of each of :data:`TYPES`.
+    :param int num_patients: Number of patients in the corpus.
+    :return: Bitmap of the matching patients.
+    :rtype: int
+    :raises ValueError: If the expression is invalid.
+    """
+    if not isinstance(expression, dict):
+        raise ValueError(f'Invalid cohort expression {expression!r}.')
+
+    if 'and' in expression or 'or' in expression:
+        op = 'and' if 'and' in expression else 'or'
+        operands = expression[op]
+
+        if len(expression) != 1 or not isinstance(operands, list) or not operands:
+            raise ValueError(f'"{op}" must be the only key of its expression '
+                             f'and hold a non-empty list.')
+
+        bitmaps = [evaluate(e, luts, num_patients) for e in operands]
+        result = bitmaps[0]
+
+        for bitmap in bitmaps[1:]:
+            if op == 'and':
+                result &= bitmap
+            else:
+                result |= bitmap
+
+        return result
+
+    if 'not' in expression:
+        if len(expression) != 1:
+            raise ValueError('"not" must be the only key of its expression.')
+
+        everyone = (1 << num_patients) - 1
+
+        return everyone & ~evaluate(expression['not'], luts, num_patients)
+
+    resource_type = expression.get('type')
+
+    if resource_type not in TYPES:
+        raise ValueError(f'Unknown cohort expression type "{resource_type}".  '
+                         f'Allowed options are {list(TYPES)}.')
+
+    for key in ('system', 'code'):
+        if not isinstance(expression.get(key), str):
+            raise ValueError(f'"{key}" of a cohort expression must be a '
+                             f'string.')
+
+    code = CodeValue(expression['code'], expression['system'])
+
+    return luts[resource_type].patients(code)
+
+
+def indices(bitmap):
+    """
+    :param int bitmap: Bitmap of patients.
+    :return: Indices of the patients in the bitmap, in increasing order.
+    :rtype: list(int)
+    """
+    data = bitmap.to_bytes((bitmap.bit_length() + 7) // 8, 'little')
+    bits = np.unpackbits(np.frombuffer(data, dtype=np.uint8),
+                         bitorder='little')
+
+    return np.flatnonzero(bits).tolist()
@@ -0,0 +1,127 @@
+"""
+Transparent reading of compressed input files.
+
+Archived FHIR exports are usually stored compressed.  Rather than requiring
+them to be decompressed to disk first, files are decompressed on the fly as
+they are read.  The format is detected from the file extension, falling back
+to the file's magic number.  zstd support requires the optional ``zstandard``
+package.
+"""
+import bz2
+import gzip
+import io
+import lzma
+import os
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+GZIP = 'gzip'
+BZIP2 = 'bz2'
+XZ = 'xz'
+ZSTD = 'zstd'
+
+EXTENSIONS = {
+    '.gz': GZIP,
+    '.gzip': GZIP,
+    '.bz2': BZIP2,
+    '.xz': XZ,
+    '.lzma': XZ,
+    '.zst': ZSTD,
+    '.zstd': ZSTD,
+}
+
+_MAGIC_NUMBERS = [
+    (b'\x1f\x8b', GZIP),
+    (b'BZh', BZIP2),
+    (b'\xfd7zXZ\x00', XZ),
+    (b'\x28\xb5\x2f\xfd', ZSTD),
+]
+
+
+class UnsupportedCompression(OSError):
+    pass
+
+
+# Exceptions that may be raised while reading a (compressed) file.
+READ_ERRORS = (OSError, EOFError, lzma.LZMAError)
+if zstandard is not None:
+    READ_ERRORS += (zstandard.ZstdError,)
+
+
+def split_extension(path):
+    """
+    :param str path: File path.
+    :return: Tuple of the path without any compression extension and the
+        compression format indicated by the extension (or ``None``).
+    :rtype: tuple(str, str)
+    """
+    root, ext = os.path.splitext(path)
+    fmt = EXTENSIONS.get(ext.lower())
+
+    if fmt is None:
+        return path, None
+
+    return root, fmt
+
+
+def detect(path):
+    """
+    :param str path: File path.
+    :return: Compression format of the file, or ``None`` if it isn't
+        compressed.
+    :rtype: str
+    """
+    fmt = split_extension(path)[1]
+
+    if fmt is not None:
+        return fmt
+
+    with open(path, 'rb') as f:
+        head = f.read(6)
+
+    for magic, fmt in _MAGIC_NUMBERS:
+        if head.startswith(magic):
+            return fmt
+
+    return None
+
+
+def open_text(path, encoding='utf-8'):
+    """
+    Open a possibly compressed file for reading text.
+
+    :param str path: File path.
+    :param str encoding: Text encoding of the (decompressed) file contents.
+    :return: Text file object that decompresses as it is read.
+    :raises UnsupportedCompression: If decompressing the file requires a
+        package that isn't installed.
+    """
+    fmt = detect(path)
+
+    if fmt is None:
+        return open(path, 'r', encoding=encoding)
+
+    if fmt == GZIP:
+        return gzip.open(path, 'rt', encoding=encoding)
+
+    if fmt == BZIP2:
+        return bz2.open(path, 'rt', encoding=encoding)
+
+    if fmt == XZ:
+        return lzma.open(path, 'rt', encoding=encoding)
+
+    if zstandard is None:
+        raise UnsupportedCompression(
+            'Reading zstd compressed files requires the "zstandard" package.')
+
+    f = open(path, 'rb')
+    try:
+        reader = zstandard.ZstdDecompressor().stream_reader(f, closefd=True)
+    except BaseException:
+        f.close()
+        raise
+
+    return io.TextIOWrapper(reader, encoding=encoding)
@@ -0,0 +1,101 @@
+"""
+Match counts of feature regexes across a corpus.
+
+Coverage is recomputed every time a regex is edited in the UI, but only the
+edited regex changes.  A :class:`MatchCountCache` keeps the number of matches
+of each regex in each patient's notes, keyed by the regex and the sections
+plan (see :func:`clarkproc.engine.sections.plan_key`), so that only new
+regexes have to be run over the notes.
+"""
+from collections import OrderedDict
+import threading
+
+import numpy as np
+
+from clarkproc.engine.sections import plan_key
+
+# Bytes of match counts kept by a MatchCountCache by default.
+DEFAULT_MAX_BYTES = 64 * 1024 ** 2
+
+
+class MatchCountCache:
+    """
+    Least recently used cache of the match counts of regexes in every patient
+    of a corpus.  The cache must be dropped when the corpus changes.
+
+    Most regexes only match in the notes of a fraction of the patients, so
+    only the non-zero counts are kept, with the indices of their patients,
+    and the cache is bounded by the bytes they take.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        """
+        :param int max_bytes: Maximum size of the counts kept, in bytes.
+        """
+        self.max_bytes = max_bytes
+        # (number of patients, patient indices, counts) by (regex, plan key).
+        self._counts = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._counts)
+
+    @property
+    def nbytes(self):
+        """Size of the counts kept, in bytes."""
+        return self._bytes
+
+    def get(self, sections_plan, regexes):
+        """
+        :param dict sections_plan: Sections part of a feature plan.
+        :param regexes: Regular expressions to look up.
+        :type regexes: iterable(str)
+        :return: Counts of the regexes that are cached: an array with a value
+            per patient, by regex.
+        :rtype: dict
+        """
+        key = plan_key(sections_plan)
+        found = {}
+
+        with self._lock:
+            for regex in regexes:
+                entry = self._counts.get((regex, key))
+
+                if entry is not None:
+                    self._counts.move_to_end((regex, key))
+                    found[regex] = entry
+
+        for regex, (num_patients, patients, values) in found.items():
+            counts = np.zeros(num_patients, dtype=values.dtype)
+            counts[patients] = values
+            found[regex] = counts
+
+        return found
+
+    def put(self, sections_plan, counts):
+        """
+        :param dict sections_plan: Sections part of a feature plan.
+        :param dict counts: Array of the counts of each patient, by regex.
+        """
+        key = plan_key(sections_plan)
+        entries = {}
+
+        for regex, patient_counts in counts.items():
+            patients = np.flatnonzero(patient_counts).astype(np.int32)
+            entries[regex, key] = (len(patient_counts), patients,
+                                   patient_counts[patients])
+
+        with self._lock:
+            for k, entry in entries.items():
+                old = self._counts.pop(k, None)
+
+                if old is not None:
+                    self._bytes -= old[1].nbytes + old[2].nbytes
+
+                self._counts[k] = entry
+                self._bytes += entry[1].nbytes + entry[2].nbytes
+
+            while self._bytes > self.max_bytes:
+                _, (_, patients, values) = self._counts.popitem(last=False)
+                self._bytes -= patients.nbytes + values.nbytes
@@ -0,0 +1,250 @@
+"""
+Counting the matches of feature regexes in the notes of a corpus.
+
+The ``re`` module holds the GIL while matching, so a :class:`NotePool` spreads
+the work over worker processes instead of threads.  Patients are split into
+shards of about the same amount of text and the counts of a shard are sent
+back as an integer matrix.  Section spans the workers computed are added to
+the caller's section cache.
+
+The processes are started once and kept across requests; they are only
+restarted if one of them dies.  Each worker keeps the scanners of the latest
+sets of regexes it was given, so a scanner is built once per worker and set of
+regexes rather than once per shard.  Notes in a note store are sent to the
+workers by location: each worker opens the store's file when it is first
+given it and reads the text of the notes itself.
+"""
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import logging
+import os
+import threading
+
+import numpy as np
+
+from clarkproc.engine.regexscan import RegexCache, RegexScanner
+from clarkproc.engine.sections import SectionSplitter
+
+LOGGER = logging.getLogger(__name__)
+
+# Below this many notes, starting shards costs more than it saves.
+MIN_PARALLEL_NOTES = 1000
+
+# Number of shards given to each worker, so that they finish about together.
+SHARDS_PER_WORKER = 4
+
+# Scanners built by a worker process, by regexes.
+_WORKER_SCANNERS = 8
+_scanners = OrderedDict()
+_regex_cache = RegexCache()
+# Path and file of the note store a worker process last read from.
+_note_file = (None, None)
+
+
+def _note_size(text):
+    """
+    :param text: Text of a note, or its ``(offset, length)`` in a note store.
+    :return: Size of the note.
+    :rtype: int
+    """
+    return len(text) if isinstance(text, str) else text[1]
+
+
+def count_matches(splitter, scanner, notes, num_rows, read=None):
+    """
+    :param SectionSplitter splitter: Splitter of notes into sections.
+    :param RegexScanner scanner: Scanner of the regexes to count.
+    :param list notes: ``(row, key, text)`` of each note, where ``key`` is the
+        key of the note in the splitter's cache and ``text`` is either the
+        text or its ``(offset, length)`` in a note store.
+    :param int num_rows: Number of rows of the result.
+    :param read: Function returning the text of a note from its offset and
+        length, e.g. :meth:`~clarkproc.fhir.notestore.NoteStore.get`.
+    :return: Counts with a column per regex of the scanner.
+    :rtype: numpy.ndarray
+    """
+    columns = {regex: i for i, regex in enumerate(scanner.regexes)}
+    matrix = np.zeros((num_rows, len(columns)), dtype=np.int32)
+
+    for row, key, text in notes:
+        if not isinstance(text, str):
+            text = read(*text)
+
+        for section in splitter.sections(text, key):
+            for regex, count in scanner.count(section).items():
+                matrix[row, columns[regex]] += count
+
+    return matrix
+
+
+def _get_scanner(regexes):
+    """
+    :param list regexes: Regular expressions to count the matches of.
+    :return: Scanner of the regexes, built once per worker process.
+    :rtype: RegexScanner
+    """
+    key = tuple(regexes)
+    scanner = _scanners.get(key)
+
+    if scanner is None:
+        scanner = _scanners[key] = RegexScanner(regexes, _regex_cache)
+
+        while len(_scanners) > _WORKER_SCANNERS:
+            _scanners.popitem(last=False)
+    else:
+        _scanners.move_to_end(key)
+
+    return scanner
+
+
+def _note_reader(path):
+    """
+    :param str path: Path of a note store's file.
+    :return: Function reading the text of a note from the file, from its
+        offset and length.
+    """
+    global _note_file
+
+    open_path, f = _note_file
+
+    if open_path != path:
+        # Data was reloaded into a new store; stop holding on to the old one.
+        if f is not None:
+            f.close()
+
+        f = open(path, 'rb')
+        _note_file = (path, f)
+
+    def read(offset, length):
+        f.seek(offset)
+        return f.read(length).decode('utf-8')
+
+    return read
+
+
+def _count_shard(sections_plan, regexes, note_path, notes, num_rows, spans):
+    """
+    Count matches in a shard of patients, in a worker process.
+
+    :param str note_path: Path of the note store's file the notes given by
+        location are in.
+    :param dict spans: Known section spans of the shard's notes, by key.
+    :return: The counts and the section spans computed.
+    :rtype: tuple(numpy.ndarray, dict)
+    """
+    known = set(spans)
+    splitter = SectionSplitter(sections_plan, _regex_cache.compile, spans)
+    read = _note_reader(note_path) if note_path is not None else None
+    matrix = count_matches(splitter, _get_scanner(regexes), notes, num_rows,
+                           read)
+
+    return matrix, {k: v for k, v in spans.items() if k not in known}
+
+
+class NotePool:
+    """Pool of processes counting regex matches in notes."""
+
+    def __init__(self, num_workers=None):
+        """
+        :param int num_workers: Number of worker processes.  ``None`` uses one
+            per CPU.
+        """
+        self.num_workers = num_workers or os.cpu_count() or 1
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.num_workers)
+            return self._executor
+
+    def shutdown(self):
+        """Stop the worker processes.  They are restarted when needed."""
+        with self._lock:
+            executor, self._executor = self._executor, None
+
+        if executor is not None:
+            executor.shutdown()
+
+    def _shards(self, notes):
+        """
+        :param list notes: ``(row, key, text)`` of each note, by row.
+        :return: Lists of notes of consecutive rows, with about the same
+            amount of text each.
+        """
+        target = (sum(_note_size(text) for _, _, text in notes)
+                  / (self.num_workers * SHARDS_PER_WORKER))
+        shard = []
+        size = 0
+
+        for note in notes:
+            if shard and size >= target and note[0] != shard[-1][0]:
+                yield shard
+                shard = []
+                size = 0
+
+            shard.append(note)
+            size += _note_size(note[2])
+
+        if shard:
+            yield shard
+
+    def feature_matrix(self, splitter, regexes, notes, num_rows,
+                       regex_cache=None, note_store=None):
+        """
+        :param SectionSplitter splitter: Splitter of notes into sections.
+            Spans computed by the workers are added to its cache.
+        :param list regexes: Regular expressions to count the matches of,
+            without duplicates.
+        :param list notes: ``(row, key, text)`` of each note, by row, where
+            ``text`` is either the text or its ``(offset, length)`` in
+            ``note_store``.
+        :param int num_rows: Number of rows of the result.
+        :param RegexCache regex_cache: Cache to compile the regexes through
+            when the notes are too few to be worth sharding.
+        :param NoteStore note_store: Store holding the text of the notes given
+            by location.
+        :return: Counts with a column per regex.
+        :rtype: numpy.ndarray
+        """
+        read = note_store.get if note_store is not None else None
+
+        if self.num_workers < 2 or len(notes) < MIN_PARALLEL_NOTES:
+            return count_matches(splitter, RegexScanner(regexes, regex_cache),
+                                 notes, num_rows, read)
+
+        if note_store is not None:
+            note_store.flush()
+
+        cache = splitter.cache if splitter.cache is not None else {}
+        note_path = note_store.path if note_store is not None else None
+        executor = self._get_executor()
+        futures = []
+
+        for shard in self._shards(notes):
+            start, stop = shard[0][0], shard[-1][0] + 1
+            futures.append((start, stop, executor.submit(
+                _count_shard, splitter.plan, regexes, note_path,
+                [(row - start, key, text) for row, key, text in shard],
+                stop - start,
+                {key: cache[key] for _, key, _ in shard if key in cache})))
+
+        matrix = np.zeros((num_rows, len(regexes)), dtype=np.int32)
+
+        try:
+            for start, stop, future in futures:
+                counts, spans = future.result()
+                matrix[start:stop] = counts
+                cache.update(spans)
+        except BrokenProcessPool:
+            # A worker died (e.g. it was killed); start a new pool next time
+            # and count in this process.
+            LOGGER.warning('Note featurization pool broke, counting serially.')
+            self.shutdown()
+
+            return count_matches(splitter, RegexScanner(regexes, regex_cache),
+                                 notes, num_rows, read)
+
+        return matrix
@@ -1,45 +1,611 @@
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 import json
 import logging
+import os
 import re
+import threading
+import time
 from glob import glob
 
+from fhir.resources.fhirabstractbase import FHIRValidationError
 from fhir.resources.fhirelementfactory import FHIRElementFactory
 
-from clarkproc.fhir.containers import CodedResourceLUT
-from clarkproc.fhir.errors import FHIRError
+from clarkproc.engine import compression, jsonstream, timing
+from clarkproc.engine.messages import (FILES,
+                                       GENERAL,
+                                       LINKING,
+                                       MessageCollector)
+from clarkproc.engine.timing import IngestTiming, PhaseTimes, TimedReader
+from clarkproc.fhir import fast
+from clarkproc.fhir.containers import CodedResourceLUT, PatientCollection
+from clarkproc.fhir.errors import ERROR, WARN, FHIRError, Message
 from clarkproc.fhir.models import (DocumentReference,
                                    Lab,
                                    Patient,
                                    MedicationRequest,
                                    Resource,
                                    VitalSigns)
+from clarkproc.fhir.store import ObservationStore
 
 LOGGER = logging.getLogger(__name__)
 
+NDJSON_EXTENSIONS = ('.ndjson', '.jsonl')
+
+# Decoders for turning FHIR JSON into the resources our models are built from.
+# "strict" builds and validates full fhir.resources objects, while "fast" wraps
+# the raw JSON without validating it (see clarkproc.fhir.fast).
+DECODERS = ('strict', 'fast')
+
+# Categories of messages reporting that (part of) a file couldn't be read or
+# decoded.
+READ_FAILURES = ('unreadable_file', 'invalid_json')
+
+# Number of entries (or NDJSON lines) read between progress updates within a
+# file.
+PROGRESS_INTERVAL = 1000
+
+
+class IngestCancelled(Exception):
+    pass
+
+
+class IngestProgress:
+    """
+    Progress of an ingest, updated as files are parsed.  It may be read from
+    other threads, which can also request that the ingest be cancelled.
+
+    Files parsed in this process also report their progress every
+    :data:`PROGRESS_INTERVAL` entries, and are checked for cancellation then.
+    Files parsed by worker processes are only accounted for once done.
+    """
+
+    def __init__(self):
+        self.files_total = 0
+        self.files_done = 0
+        self.resources_parsed = 0
+        self.bytes_total = 0
+        self.bytes_read = 0
+        # Progress within the file being parsed in this process.
+        self.file_entries = 0
+        self.file_bytes = 0
+        self._cancel_event = threading.Event()
+
+    def cancel(self):
+        """Request that the ingest stop as soon as possible."""
+        self._cancel_event.set()
+
+    @property
+    def cancelled(self):
+        return self._cancel_event.is_set()
+
+    def check_cancelled(self):
+        """
+        :raises IngestCancelled: If cancellation has been requested.
+        """
+        if self.cancelled:
+            raise IngestCancelled('Ingest was cancelled.')
+
+    def update_file(self, num_entries, num_bytes):
+        """
+        Report progress within the file being parsed.
+
+        :param int num_entries: Number of entries read from the file so far.
+        :param int num_bytes: Number of bytes read from the file so far, if
+            known.
+        :raises IngestCancelled: If cancellation has been requested.
+        """
+        self.file_entries = num_entries
+        self.file_bytes = num_bytes
+        self.check_cancelled()
+
+    def finish_file(self, num_resources, num_bytes):
+        """
+        Report that a file was parsed.
+
+        :param int num_resources: Number of resources in the file.
+        :param int num_bytes: Size of the file.
+        """
+        self.resources_parsed += num_resources
+        self.bytes_read += num_bytes
+        self.files_done += 1
+        self.file_entries = 0
+        self.file_bytes = 0
+
+    def to_dict(self):
+        return {
+            'files_total': self.files_total,
+            'files_done': self.files_done,
+            'resources_parsed': self.resources_parsed + self.file_entries,
+            'bytes_total': self.bytes_total,
+            'bytes_read': self.bytes_read + self.file_bytes,
+        }
+
+
+def _entry_error(e, idx):
+    """Report a bundle entry error with the path bundle validation would use."""
+    if isinstance(e, FHIRValidationError):
+        return e.prefixed(str(idx)).prefixed('entry')
+
+    return FHIRValidationError([e], f'entry.{idx}')
+
+
+def _add_resource(resource, items, times):
+    """
+    Convert a FHIR resource into one of our defined models and append it to
+    ``items``.  Problems are appended to ``items`` as messages instead.
+    """
+    start = time.perf_counter()
+
+    try:
+        r = Resource.factory(resource, items)
+    except FHIRError as e:
+        items.append(Message(WARN, e.category, str(e)))
+        r = None
+
+    if r is not None:
+        # Unsupported resource types are skipped over.
+        items.append(r)
+
+    times.add(timing.MODELS, time.perf_counter() - start, 1)
+
+
+def _instantiate(resource_type, jsondict, decoder, times, count=1):
+    """
+    Build the FHIR object for JSON data with the given decoder.
+    """
+    start = time.perf_counter()
+
+    try:
+        if decoder == 'fast':
+            return fast.instantiate(jsondict)
+
+        return FHIRElementFactory.instantiate(resource_type, jsondict)
+    finally:
+        times.add(timing.FHIR, time.perf_counter() - start, count)
+
+
+def _is_ndjson(f_json):
+    """Whether the file holds newline delimited JSON (FHIR Bulk Data)."""
+    name = compression.split_extension(f_json)[0]
+    return name.lower().endswith(NDJSON_EXTENSIONS)
+
+
+def _file_reporter(f_json, report):
+    """
+    :param str f_json: Path to the FHIR file.
+    :param report: Function called with the number of entries and the number
+        of bytes read so far.
+    :return: Function to call with the number of entries and the number of
+        characters read so far.  Characters stand for bytes in uncompressed
+        files; no bytes are reported for compressed ones.
+    """
+    try:
+        compressed = compression.detect(f_json) is not None
+    except OSError:
+        compressed = True
+
+    nbytes = 0 if compressed else _file_size(f_json)
+
+    def update(num_entries, num_chars):
+        report(num_entries, min(num_chars, nbytes))
+
+    return update
+
+
+def _parse_file(f_json, decoder='strict', times=None, report=None):
+    """
+    Parse a single FHIR file into our models.
+
+    Compressed files are decompressed as they are read (see
+    :mod:`clarkproc.engine.compression`).
+
+    This runs in worker processes when ingesting in parallel, so it only
+    returns plain (picklable) objects and doesn't touch any shared state.
+
+    :param str f_json: Path to the FHIR file.
+    :param str decoder: One of :data:`DECODERS`.
+    :param PhaseTimes times: Times to record the parsing phases to.
+    :param report: Function called with the number of entries and bytes read
+        every :data:`PROGRESS_INTERVAL` entries, such as
+        :meth:`IngestProgress.update_file`.  It may raise to stop parsing.
+    :return: Tuple of ``(items, labels)``.  ``items`` holds the parsed model
+        objects and :class:`Message` objects in the order they were
+        encountered so that the caller can replay them deterministically.
+        ``labels`` holds the CLARK label entries found in the file, or
+        ``None`` if there were none.
+    :rtype: tuple(list, list or None)
+    """
+    if times is None:
+        times = PhaseTimes()
+
+    if report is not None:
+        report = _file_reporter(f_json, report)
+
+    start = time.perf_counter()
+
+    try:
+        if _is_ndjson(f_json):
+            return _parse_ndjson(f_json, decoder, times, report)
+
+        return _parse_bundle(f_json, decoder, times, report)
+    finally:
+        # Whatever isn't spent on reading or building objects is spent on
+        # decoding the JSON.
+        elapsed = time.perf_counter() - start
+        nbytes = _file_size(f_json)
+        times.add(timing.JSON, max(0.0, elapsed - sum(
+            times.seconds[p] for p in (timing.IO, timing.FHIR, timing.MODELS))),
+            0, nbytes)
+        times.add(timing.IO, 0.0, 1, nbytes)
+
+
+def _parse_file_timed(f_json, decoder='strict', report=None):
+    """
+    :return: Tuple of the result of :func:`_parse_file`, the times of its
+        phases and its wall time.
+    :rtype: tuple(tuple, PhaseTimes, float)
+    """
+    times = PhaseTimes()
+    start = time.perf_counter()
+    result = _parse_file(f_json, decoder, times, report)
+
+    return result, times, time.perf_counter() - start
+
+
+def _parse_ndjson(f_json, decoder, times, report=None):
+    """
+    Parse a newline delimited JSON file with one FHIR resource per line, as
+    produced by a FHIR Bulk Data export.
+
+    Lines are read and converted one at a time.  Unlike bundles, a bad line
+    only causes that resource to be skipped.
+    """
+    items = []
+    labels = None
+
+    try:
+        with compression.open_text(f_json) as jsonfile:
+            reader = TimedReader(jsonfile, times)
+
+            for line_num, line in enumerate(reader, 1):
+                if report is not None and line_num % PROGRESS_INTERVAL == 0:
+                    report(line_num, reader.chars_read)
+
+                if not line.strip():
+                    continue
+
+                try:
+                    json_results = json.loads(line)
+                except ValueError as e:
+                    items.append(Message(
+                        ERROR, 'invalid_json',
+                        f'Line {line_num}: JSON decoding failed ({e}).'))
+                    continue
+
+                if not isinstance(json_results, dict) or 'resourceType' not in json_results:
+                    items.append(Message(
+                        ERROR, 'missing_resource_type',
+                        f'Line {line_num}: resourceType missing in JSON '
+                        f'data.'))
+                    continue
+
+                if json_results['resourceType'] == 'ClarkLabel':
+                    if labels is None:
+                        labels = []
+                    labels.append(json_results)
+                    continue
+
+                # Try to reconstitute JSON data into a FHIR resource.
+                try:
+                    resource = _instantiate(json_results['resourceType'],
+                                            json_results, decoder, times)
+                except Exception as e:
+                    items.append(Message(
+                        ERROR, 'invalid_fhir',
+                        f'Line {line_num}: FHIR parsing failed ({e}).'))
+                    continue
+
+                _add_resource(resource, items, times)
+    except compression.READ_ERRORS + (ValueError,) as e:
+        items.append(Message(ERROR, 'unreadable_file',
+                             f'Reading file failed ({e}).'))
+
+    return items, labels
+
+
+def _parse_bundle(f_json, decoder, times, report=None):
+    """
+    Parse a JSON file holding a FHIR Bundle.
+
+    Bundle entries are streamed from the file and converted one at a time, so
+    memory use is bounded by the largest resource rather than the file size.
+    The file is still handled as a unit: if any entry fails FHIR validation,
+    none of its resources are kept.
+    """
+    items = []
+    members = {}
+    labels = None
+    errors = []
+
+    try:
+        with compression.open_text(f_json) as jsonfile:
+            reader = TimedReader(jsonfile, times)
+            entries = jsonstream.iter_array(reader, 'entry', members)
+
+            for idx, entry in enumerate(entries):
+                if report is not None and (idx + 1) % PROGRESS_INTERVAL == 0:
+                    report(idx + 1, reader.chars_read)
+
+                if labels is not None:
+                    labels.append(entry)
+                    continue
+
+                if idx == 0 and isinstance(entry, dict) and entry.get('resourceType', None) == 'ClarkLabel':
+                    labels = [entry]
+                    continue
+
+                if decoder == 'fast':
+                    if isinstance(entry, dict) and isinstance(entry.get('resource'), dict):
+                        try:
+                            resource = _instantiate(
+                                None, entry['resource'], decoder, times)
+                        except Exception as e:
+                            errors.append(_entry_error(e, idx))
+                            continue
+
+                        if not errors:
+                            _add_resource(resource, items, times)
+                    continue
+
+                # Try to reconstitute JSON data into FHIR resources.
+                try:
+                    bundle_entry = _instantiate(
+                        'BundleEntry', entry, decoder, times)
+                except Exception as e:
+                    errors.append(_entry_error(e, idx))
+                    continue
+
+                if errors or bundle_entry.resource is None:
+                    # The file is going to be rejected, so only keep
+                    # validating the remaining entries.
+                    continue
+
+                _add_resource(bundle_entry.resource, items, times)
+    except compression.READ_ERRORS + (ValueError,) as e:
+        return [Message(ERROR, 'invalid_json',
+                        f'JSON decoding failed ({e}).')], None
+
+    if 'resourceType' not in members:
+        return [Message(ERROR, 'missing_resource_type',
+                        'resourceType missing in JSON data.')], None
+
+    if labels is not None and members['resourceType'] == 'Bundle':
+        return [], labels
+
+    if decoder == 'fast':
+        if errors:
+            e = FHIRValidationError(errors)
+            return [Message(ERROR, 'invalid_fhir',
+                            f'FHIR parsing failed ({e}).')], None
+
+        if members['resourceType'] != 'Bundle':
+            return [Message(
+                ERROR, 'unsupported_resource_type',
+                'Found resourceType "{}" but only "Bundle" is '
+                'supported.'.format(members['resourceType']))], None
+
+        return items, None
+
+    # Validate everything outside of the entries.
+    try:
+        element = _instantiate(members['resourceType'], members, decoder,
+                               times, count=0)
+    except FHIRValidationError as e:
+        errors = e.errors + errors
+    except Exception as e:
+        return [Message(ERROR, 'invalid_fhir',
+                        f'FHIR parsing failed ({e}).')], None
+
+    if errors:
+        e = FHIRValidationError(errors)
+        return [Message(ERROR, 'invalid_fhir',
+                        f'FHIR parsing failed ({e}).')], None
+
+    if element.resource_type != 'Bundle':
+        return [Message(
+            ERROR, 'unsupported_resource_type',
+            'Found resourceType "{}" but only "Bundle" is '
+            'supported.'.format(element.resource_type))], None
+
+    return items, None
+
+
+def _file_size(f_json):
+    try:
+        return os.path.getsize(f_json)
+    except OSError:
+        return 0
+
+
+def _parse_files(fhir_files, num_workers=1, decoder='strict', report=None):
+    """
+    Parse FHIR files, optionally spreading the work over a pool of processes.
+
+    :param list(str) fhir_files: Paths of the files to parse.
+    :param int num_workers: Number of worker processes.  ``None`` uses one per
+        CPU.  Values less than 2 parse the files serially in this process.
+    :param str decoder: One of :data:`DECODERS`.
+    :param report: Function to report progress within files to, see
+        :func:`_parse_file`.  Only used for files parsed in this process.
+    :return: Iterator over ``(path, result, times, seconds)`` tuples in the
+        same order as ``fhir_files``, as returned by
+        :func:`_parse_file_timed`.
+    """
+    if num_workers is None:
+        num_workers = os.cpu_count() or 1
+
+    num_workers = min(num_workers, len(fhir_files))
+
+    if num_workers < 2:
+        for f_json in fhir_files:
+            yield (f_json,) + _parse_file_timed(f_json, decoder, report)
+        return
+
+    # Results are yielded in submission order, which keeps the outcome
+    # identical to the serial path regardless of which worker finishes first.
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        parse = partial(_parse_file_timed, decoder=decoder)
+        futures = [executor.submit(parse, f_json) for f_json in fhir_files]
+
+        try:
+            for f_json, future in zip(fhir_files, futures):
+                yield (f_json,) + future.result()
+        finally:
+            # If iteration stopped early (e.g. the ingest was cancelled),
+            # don't wait for the remaining files to be parsed.
+            for future in futures:
+                future.cancel()
+
+
+def _load_files(fhir_files, num_workers=1, cache=None, decoder='strict',
+                report=None):
+    """
+    Like :func:`_parse_files`, but reuses results from an ingest cache for
+    files that haven't changed since they were cached and caches the rest.
+
+    :param list(str) fhir_files: Paths of the files to load.
+    :param int num_workers: Number of worker processes used for parsing.
+    :param str decoder: One of :data:`DECODERS`.
+    :param cache: Cache of parse results, or ``None`` to parse every file.
+    :type cache: clarkproc.engine.cache.IngestCache
+    :param report: Function to report progress within files to, see
+        :func:`_parse_file`.
+    """
+    if cache is None:
+        yield from _parse_files(fhir_files, num_workers, decoder, report)
+        return
+
+    cached = {}
+    for f_json in fhir_files:
+        start = time.perf_counter()
+        result = cache.get(f_json, variant=decoder)
+        if result is not None:
+            times = PhaseTimes()
+            seconds = time.perf_counter() - start
+            times.add(timing.CACHE, seconds, 1, _file_size(f_json))
+            cached[f_json] = result, times, seconds
+
+    parsed = _parse_files([f for f in fhir_files if f not in cached],
+                          num_workers, decoder, report)
+
+    try:
+        for f_json in fhir_files:
+            if f_json in cached:
+                yield (f_json,) + cached[f_json]
+                continue
+
+            f_json, result, times, seconds = next(parsed)
+            items, labels = result
+
+            # Files that couldn't be read are retried next time rather than
+            # cached, since the problem may be temporary.  Anything else is
+            # cached, including files without any resources we use.
+            if not any(isinstance(r, Message) and r.category in READ_FAILURES
+                       for r in items):
+                cache.put(f_json, result, variant=decoder)
+
+            yield f_json, result, times, seconds
+    finally:
+        parsed.close()
+        cache.evict()
+
+
+def _finish_timing(timing_report, start):
+    timing_report.total_seconds = time.perf_counter() - start
+    LOGGER.info('Ingest timing: %s', json.dumps(timing_report.to_dict()))
+
+
+def ingest_fhir(paths, num_workers=1, cache=None, decoder='strict',
+                append_to=None, progress=None, note_store=None,
+                timing_report=None, collector=None):
+    """
+    Load FHIR files and link their resources together.
+
+    When appending, patients and resources from the new files are merged into
+    copies of the existing containers and only the new resources are linked.
+    New resources may belong to patients loaded previously, and new labels may
+    apply to them; those patients are copied before anything is linked to
+    them.  The containers passed in are left unchanged, whether or not ingest
+    succeeds, so they can keep being used until the results replace them.
+
+    :param list(str) paths: Paths of the files to load.  Wildcards are
+        expanded.
+    :param int num_workers: Number of worker processes used to parse files.
+        ``None`` uses one per CPU.
+    :param cache: Cache of parse results to reuse and update, if any.
+    :type cache: clarkproc.engine.cache.IngestCache
+    :param str decoder: One of :data:`DECODERS`.
+    :param tuple append_to: ``(patients, labs, vitals, medications)`` returned
+        by a previous call to add the new files to, or ``None`` to start from
+        scratch.
+    :param IngestProgress progress: Object to report progress to.  It is
+        checked for cancellation after each file is parsed, while parsing
+        files in this process, and once resources are linked.
+    :param note_store: Store to move the text of linked notes to, or ``None``
+        to keep it in memory.
+    :type note_store: clarkproc.fhir.notestore.NoteStore
+    :param IngestTiming timing_report: Object to record the time spent in
+        each phase to.  The report is also logged.
+    :param MessageCollector collector: Collector to add problems to.  The
+        returned messages hold the examples it kept.
+    :return: Tuple of ``(messages, patients, labs, vitals, medications)``.
+        Everything but the messages is ``None`` if no patients were loaded.
+        ``patients`` is a :class:`PatientCollection`, and the lab and vital
+        lookup tables carry an :class:`ObservationStore` of all observations.
+    :rtype: tuple
+    :raises IngestCancelled: If ``progress`` was cancelled.
+    """
+    start = time.perf_counter()
+
+    if progress is None:
+        progress = IngestProgress()
+
+    if timing_report is None:
+        timing_report = IngestTiming()
+
+    if collector is None:
+        collector = MessageCollector()
 
-def ingest_fhir(paths):
     fhir_files = []
-    messages = {
-        'general': [],
-        'files': {},
-        'linking': []
-    }
 
     # Iterate over provided paths and glob to expand wildcards.
     for p in paths:
         files = glob(p, recursive=True)
 
         if not files:
-            messages['general'].append(f'ERROR: No files found in path "{p}".')
+            collector.add(GENERAL, Message(
+                ERROR, 'missing_files', f'No files found in path "{p}".'))
         else:
             fhir_files += files
 
     if len(fhir_files) < 1:
-        messages['general'].append(
-            'ERROR: No files found in specified path(s).')
-        return messages, None, None, None, None
+        collector.add(GENERAL, Message(
+            ERROR, 'missing_files', 'No files found in specified path(s).'))
+        return collector.to_messages(), None, None, None, None
+
+    progress.files_total = len(fhir_files)
+    progress.bytes_total = sum(_file_size(f) for f in fhir_files)
 
-    patients = {}
+    if append_to is not None:
+        patients, labs, vitals, medications = (c.copy() for c in append_to)
+    else:
+        patients = PatientCollection()
+        labs = CodedResourceLUT(check_units=True)
+        vitals = CodedResourceLUT(check_units=True)
+        medications = CodedResourceLUT(check_units=False)
+
+    new_patients = {}
 
     lab_list = []
     label_list = []
@@ -47,115 +613,124 @@ def ingest_fhir(paths):
     medication_list = []
     note_list = []
 
-    file_messages = {}
+    # Iterate over the parsed contents of all FHIR files, collecting like
+    # resources so that they can be linked together later.
+    loaded_files = _load_files(fhir_files, num_workers, cache, decoder,
+                               progress.update_file)
 
-    # Iterate over list of all FHIR files to ingest.
-    for f_json in fhir_files:
-        msg_list = []
-        file_messages[f_json] = msg_list
+    try:
+        for f_json, (items, labels), times, seconds in loaded_files:
+            progress.check_cancelled()
 
-        # Try to load JSON data from file.
-        try:
-            with open(f_json, 'r', encoding='utf-8') as jsonfile:
-                json_results = json.load(jsonfile)
-        except Exception as e:
-            msg_list.append(f'ERROR: JSON decoding failed ({e}).')
-            continue
-
-        if 'resourceType' not in json_results:
-            msg_list.append('ERROR: resourceType missing in JSON data.')
-            continue
-
-        if json_results['resourceType'] == 'Bundle' and json_results['entry'][0].get('resourceType', None) == 'ClarkLabel':
-            label_list = json_results['entry']
-            continue
-        # Try to reconstitute JSON data into FHIR resources.
-        try:
-            element = FHIRElementFactory.instantiate(
-                json_results['resourceType'], json_results)
-        except Exception as e:
-            msg_list.append(f'ERROR: FHIR parsing failed ({e}).')
-            continue
-
-        if element.resource_type != 'Bundle':
-            msg_list.append(
-                'ERROR: Found resourceType "{}" but only "Bundle" is '
-                'supported.'.format(element.resource_type))
-            continue
-
-        # Iterate through all resources in the bundle, collecting like resources
-        # so that they can be linked together later.
-        for idx, bundleEntry in enumerate(element.entry):
-            resource = bundleEntry.resource
-
-            # Try to convert the FHIR resource into one of our defined models.
-            try:
-                r = Resource.factory(resource, msg_list)
-            except FHIRError as e:
-                msg_list.append(f'WARN: {e}')
-                continue
+            collector.add_file(f_json)
 
-            if r is None:
-                # Skip over unsupported resource type.
-                continue
+            if labels is not None:
+                label_list = labels
+
+            num_resources = 0
+
+            for r in items:
+                if isinstance(r, Message):
+                    collector.add(FILES, r, f_json)
+                    continue
+
+                num_resources += 1
+
+                if isinstance(r, Patient):
+                    if r.id in patients or r.id in new_patients:
+                        collector.add(FILES, Message(
+                            WARN, 'duplicate_patient',
+                            f'Skipping patient with duplicate id {r.id}.'),
+                            f_json)
+                    else:
+                        new_patients[r.id] = r
+                elif isinstance(r, Lab):
+                    lab_list.append(r)
+                elif isinstance(r, VitalSigns):
+                    vital_list.append(r)
+                elif isinstance(r, MedicationRequest):
+                    medication_list.append(r)
+                elif isinstance(r, DocumentReference):
+                    note_list.append(r)
 
-            if isinstance(r, Patient):
-                if r.id in patients:
-                    msg_list.append(
-                        f'WARN: Skipping patient with duplicate id {r.id}.')
-                else:
-                    patients[r.id] = r
-            elif isinstance(r, Lab):
-                lab_list.append(r)
-            elif isinstance(r, VitalSigns):
-                vital_list.append(r)
-            elif isinstance(r, MedicationRequest):
-                medication_list.append(r)
-            elif isinstance(r, DocumentReference):
-                note_list.append(r)
-
-    messages['files'] = file_messages
-
-    if len(patients) < 1:
-        messages['general'].append(
-            'ERROR: No patients loaded.  At least one patient is required.')
-        return messages, None, None, None, None
-
-    msg_list = []
-
-    labs = CodedResourceLUT(check_units=True)
-    vitals = CodedResourceLUT(check_units=True)
-    medications = CodedResourceLUT(check_units=False)
+            nbytes = _file_size(f_json)
+            timing_report.add_file(f_json, times, seconds, nbytes,
+                                   num_resources,
+                                   cached=times.counts[timing.CACHE] > 0)
+
+            progress.finish_file(num_resources, nbytes)
+    finally:
+        loaded_files.close()
+
+    progress.check_cancelled()
+
+    timing_report.parse_seconds = time.perf_counter() - start
+
+    if len(patients) + len(new_patients) < 1:
+        collector.add(GENERAL, Message(
+            ERROR, 'no_patients',
+            'No patients loaded.  At least one patient is required.'))
+        _finish_timing(timing_report, start)
+        return collector.to_messages(), None, None, None, None
+
+    linking_start = time.perf_counter()
+
+    patients.update(new_patients)
+
+    def add_messages(msg_list):
+        for msg in msg_list:
+            collector.add(LINKING, msg)
+
+    def get_patient(patient_id):
+        """Patient to link to, copied first if it belongs to append_to."""
+        patient = patients[patient_id]
+
+        if append_to is not None and append_to[0].get(patient_id) is patient:
+            patient = patients[patient_id] = patient.copy()
+
+        return patient
 
     def get_patient_id(resource):
         patient_id = re.split('[/:]', resource.ref)[-1]
 
         if patient_id not in patients:
-            msg_list.append('WARN: Discarding {} due to no patient with '
-                            'id {}.'.format(resource.id_str, patient_id))
+            collector.add(LINKING, Message(
+                WARN, 'missing_patient',
+                'Discarding {} due to no patient with id {}.'.format(
+                    resource.id_str, patient_id),
+                getattr(resource, 'code', None)))
             return None
         else:
             return patient_id
 
+    # Observations added to patients, for the column-wise snapshots.
+    added_labs = []
+    added_vitals = []
+
     # Iterate through labs, adding them to the associated patient and storing in
     # the lab LUT.
     for lab in lab_list:
         patient_id = get_patient_id(lab)
 
         if patient_id is not None:
-            patients[patient_id].labs.add(lab)
-            msg_list += labs.add(lab.code, patient_id, lab.unit)
+            patient = get_patient(patient_id)
+            patient.labs.add(lab)
+            added_labs.append((patient, lab))
+            add_messages(labs.add(lab.code, patient.index, lab.unit,
+                                  lab.value))
 
     # Iterate through labels, adding them to the associated patient
     for label in label_list:
         patient_id = re.split('/', label['subject']['reference'])[-1]
         if patient_id not in patients:
-            msg_list.append('WARN: Discarding label due to no patient with '
-                            'id {}.'.format(patient_id))
+            collector.add(LINKING, Message(
+                WARN, 'missing_patient',
+                'Discarding label due to no patient with id {}.'.format(
+                    patient_id)))
             patient_id = None
 
         if patient_id is not None:
-            patients[patient_id].label = label['label']['value']
+            get_patient(patient_id).label = label['label']['value']
 
     # Iterate through vitals, adding them to the associated patient and storing
     # in the vital LUT.
@@ -163,8 +738,11 @@ def ingest_fhir(paths):
         patient_id = get_patient_id(vital)
 
         if patient_id is not None:
-            patients[patient_id].vitals.add(vital)
-            msg_list += vitals.add(vital.code, patient_id, vital.unit)
+            patient = get_patient(patient_id)
+            patient.vitals.add(vital)
+            added_vitals.append((patient, vital))
+            add_messages(vitals.add(vital.code, patient.index, vital.unit,
+                                    vital.value))
 
     # Iterate through medications, adding them to the associated patient and
     # storing in the medication LUT.
@@ -172,17 +750,36 @@ def ingest_fhir(paths):
         patient_id = get_patient_id(medication)
 
         if patient_id is not None:
-            patients[patient_id].medications.add(medication)
-            msg_list += medications.add(medication.code, patient_id)
+            patient = get_patient(patient_id)
+            patient.medications.add(medication)
+            add_messages(medications.add(medication.code, patient.index))
 
     # Iterate through notes, adding them to the associated patient.
     for note in note_list:
         patient_id = get_patient_id(note)
 
         if patient_id is not None:
-            patients[patient_id].notes[note.id] = note
+            if note_store is not None:
+                note.spill(note_store)
+            get_patient(patient_id).notes[note.id] = note
+
+    patients.changed()
+
+    progress.check_cancelled()
+
+    # Snapshot the observations column-wise for summaries and features.  When
+    # appending, only the new observations are added to the snapshot.
+    for lut, attr, added in ((labs, 'labs', added_labs),
+                             (vitals, 'vitals', added_vitals)):
+        if lut.store is not None:
+            lut.store = lut.store.extend(patients, attr, added)
+        else:
+            lut.store = ObservationStore(patients, attr)
 
-    if msg_list:
-        messages['linking'] = msg_list
+    timing_report.phases.add(
+        timing.LINKING, time.perf_counter() - linking_start,
+        len(lab_list) + len(label_list) + len(vital_list) +
+        len(medication_list) + len(note_list))
+    _finish_timing(timing_report, start)
 
-    return messages, patients, labs, vitals, medications
+    return collector.to_messages(), patients, labs, vitals, medications
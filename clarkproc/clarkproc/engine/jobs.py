@@ -0,0 +1,186 @@
+"""
+Background ingest jobs.
+
+Loading a large corpus can take far longer than an HTTP request should, so
+ingest can instead be run on a worker thread.  Jobs are tracked here so that
+their progress can be polled and so that they can be cancelled.
+"""
+from collections import OrderedDict
+import logging
+import threading
+import uuid
+
+from clarkproc.engine.ingest import IngestCancelled, IngestProgress
+
+LOGGER = logging.getLogger(__name__)
+
+# Number of finished jobs to remember so that clients can still collect their
+# results.
+MAX_FINISHED_JOBS = 16
+
+RUNNING = 'running'
+COMPLETED = 'completed'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+_jobs = OrderedDict()
+_lock = threading.Lock()
+# Held while a job applies its results and while jobs are cancelled, so that
+# results are never applied once their job has been cancelled.
+_apply_lock = threading.Lock()
+
+
+class IngestJob:
+    """
+    Ingest running on a worker thread.
+
+    :param str target: Which data set (e.g. train or test) is being loaded.
+    :param callable run: Called on the worker thread with an
+        :class:`IngestProgress`.  It should do the ingest, apply the results
+        and return a JSON serializable result.
+    """
+
+    def __init__(self, target, run):
+        self.id = uuid.uuid4().hex
+        self.target = target
+        self.status = RUNNING
+        self.progress = IngestProgress()
+        self.result = None
+        self.error = None
+
+        self._run = run
+        self._thread = threading.Thread(
+            target=self._work, name=f'ingest-{self.id}', daemon=True)
+
+    def _work(self, reraise=False):
+        try:
+            self.result = self._run(self.progress)
+            self.status = COMPLETED
+        except IngestCancelled:
+            self.status = CANCELLED
+        except Exception as e:
+            LOGGER.exception('Ingest job %s failed.', self.id)
+            self.error = str(e)
+            self.status = FAILED
+
+            if reraise:
+                raise
+        finally:
+            _prune()
+
+    @property
+    def running(self):
+        return self.status == RUNNING
+
+    def cancel(self):
+        """Request that the job stop.  Its status changes once it has."""
+        self.progress.cancel()
+
+    def to_dict(self):
+        return {
+            'job_id': self.id,
+            'status': self.status,
+            'cancel_requested': self.progress.cancelled,
+            'progress': self.progress.to_dict(),
+            'result': self.result,
+            'error': self.error,
+        }
+
+
+def _add(target, run):
+    with _lock:
+        if any(j.running and j.target == target for j in _jobs.values()):
+            return None
+
+        job = IngestJob(target, run)
+        _jobs[job.id] = job
+
+    return job
+
+
+def start(target, run):
+    """
+    Start a new job, unless one is already running for the same target.
+
+    :param str target: Which data set is being loaded.
+    :param callable run: See :class:`IngestJob`.
+    :return: The new job, or ``None`` if one is already running for the target.
+    :rtype: IngestJob
+    """
+    job = _add(target, run)
+
+    if job is not None:
+        job._thread.start()
+
+    return job
+
+
+def run(target, run):
+    """
+    Run a new job on the calling thread, unless one is already running for the
+    same target.  Registering synchronous loads as jobs keeps them from
+    running alongside background ones, and lets them be cancelled too.
+
+    :param str target: Which data set is being loaded.
+    :param callable run: See :class:`IngestJob`.
+    :return: The finished job, or ``None`` if one is already running for the
+        target.
+    :rtype: IngestJob
+    :raises Exception: What ``run`` raised, if the job failed.
+    """
+    job = _add(target, run)
+
+    if job is not None:
+        job._work(reraise=True)
+
+    return job
+
+
+def apply(progress, apply_results):
+    """
+    Apply the results of a job, unless it has been cancelled.
+
+    :param IngestProgress progress: Progress of the job.
+    :param callable apply_results: Called without arguments to apply the
+        results.
+    :return: Value returned by ``apply_results``.
+    :raises IngestCancelled: If the job has been cancelled.
+    """
+    with _apply_lock:
+        progress.check_cancelled()
+        return apply_results()
+
+
+def get(job_id):
+    """
+    :param str job_id: Job identifier.
+    :rtype: IngestJob
+    """
+    return _jobs.get(job_id)
+
+
+def running(target):
+    """
+    :param str target: Which data set is being loaded.
+    :return: Whether a job is running for the target.
+    :rtype: bool
+    """
+    return any(j.running and j.target == target for j in list(_jobs.values()))
+
+
+def cancel_all():
+    """
+    Request that all running jobs stop.  Once this returns, none of them
+    applies its results anymore.
+    """
+    with _apply_lock:
+        for job in list(_jobs.values()):
+            job.cancel()
+
+
+def _prune():
+    with _lock:
+        finished = [job_id for job_id, j in _jobs.items() if not j.running]
+
+        for job_id in finished[:-MAX_FINISHED_JOBS]:
+            del _jobs[job_id]
@@ -0,0 +1,160 @@
+"""
+Incremental reading of large JSON documents.
+
+FHIR bundles can be far larger than the resources they contain, so rather than
+decoding a whole document at once these helpers walk the top-level object and
+decode one array element at a time.  Only the standard library decoder is used;
+memory use is bounded by the largest single value being decoded.
+"""
+import json
+
+CHUNK_SIZE = 1 << 16
+
+_WHITESPACE = ' \t\n\r'
+_DECODER = json.JSONDecoder()
+
+
+class JSONStreamError(ValueError):
+    pass
+
+
+class _StreamBuffer:
+    """Sliding window over a text file used for incremental decoding."""
+
+    def __init__(self, fp, chunk_size=CHUNK_SIZE):
+        self.fp = fp
+        self.chunk_size = chunk_size
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        """
+        Read more data into the buffer, discarding what was already consumed.
+
+        Reads grow with the amount of pending data so that decoding a very
+        large value doesn't rescan the buffer once per chunk.
+
+        :return: ``False`` if the end of the file has been reached.
+        :rtype: bool
+        """
+        if self.eof:
+            return False
+
+        pending = len(self.buf) - self.pos
+        chunk = self.fp.read(max(self.chunk_size, pending))
+
+        if not chunk:
+            self.eof = True
+            return False
+
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+
+        return True
+
+    def peek(self):
+        """
+        Skip whitespace and return the next character without consuming it.
+
+        :return: Next character, or an empty string at the end of the file.
+        :rtype: str
+        """
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in _WHITESPACE:
+                self.pos += 1
+
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+
+            if not self.fill():
+                return ''
+
+    def consume(self, expected):
+        """Consume the next non-whitespace character, which must be one of
+        ``expected``."""
+        c = self.peek()
+
+        if not c or c not in expected:
+            raise JSONStreamError(
+                'Expecting {} but found {}.'.format(
+                    ' or '.join(f'"{e}"' for e in expected),
+                    f'"{c}"' if c else 'end of file'))
+
+        self.pos += 1
+
+        return c
+
+    def decode(self):
+        """Decode the next complete JSON value."""
+        self.peek()
+
+        while True:
+            try:
+                value, end = _DECODER.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError as e:
+                if self.fill():
+                    continue
+                raise JSONStreamError(str(e)) from None
+
+            # Numbers are the only values whose end can't be told from their
+            # own content, so make sure one wasn't cut off by the buffer.
+            if (end == len(self.buf) and isinstance(value, (int, float))
+                    and not isinstance(value, bool) and self.fill()):
+                continue
+
+            self.pos = end
+
+            return value
+
+
+def iter_array(fp, key, members=None, chunk_size=CHUNK_SIZE):
+    """
+    Iterate over the elements of an array in a top-level JSON object.
+
+    :param fp: Text file object positioned at the start of the document.
+    :param str key: Name of the member holding the array to stream.
+    :param dict members: If provided, all other top-level members are decoded
+        and stored here as they are encountered.  It is only complete once the
+        iterator is exhausted.
+    :param int chunk_size: Number of characters to read at a time.
+    :return: Iterator over the decoded array elements.
+    :raises JSONStreamError: If the document is not valid JSON, or if it is
+        not an object.
+    """
+    if members is None:
+        members = {}
+
+    b = _StreamBuffer(fp, chunk_size)
+
+    b.consume('{')
+
+    if b.peek() == '}':
+        b.pos += 1
+    else:
+        while True:
+            if b.peek() != '"':
+                raise JSONStreamError('Expecting property name.')
+
+            name = b.decode()
+            b.consume(':')
+
+            if name == key and b.peek() == '[':
+                b.pos += 1
+
+                if b.peek() == ']':
+                    b.pos += 1
+                else:
+                    while True:
+                        yield b.decode()
+
+                        if b.consume(',]') == ']':
+                            break
+            else:
+                members[name] = b.decode()
+
+            if b.consume(',}') == '}':
+                break
+
+    if b.peek():
+        raise JSONStreamError('Extra data after JSON object.')
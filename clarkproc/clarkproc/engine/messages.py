@@ -0,0 +1,167 @@
+"""
+Collection of the problems found while ingesting FHIR data.
+
+Dirty corpora can produce a message for every single resource.  Rather than
+keeping (and returning) all of them, :class:`MessageCollector` counts messages
+by section, category and code and only keeps the first few examples of each.
+The full detail can optionally be streamed to a log file instead.
+"""
+from collections import OrderedDict
+
+from clarkproc.fhir.models import CodeValue
+
+GENERAL = 'general'
+FILES = 'files'
+LINKING = 'linking'
+
+# Number of examples kept for each kind of message.
+DEFAULT_MAX_EXAMPLES = 10
+
+
+class _MessageGroup:
+    __slots__ = ('count', 'examples')
+
+    def __init__(self):
+        self.count = 0
+        self.examples = []
+
+
+class MessageCollector:
+    """
+    Counts messages and keeps the first examples of each kind.
+
+    Messages are grouped by section (:data:`GENERAL`, :data:`FILES` or
+    :data:`LINKING`), file, level, category and code.
+    """
+
+    def __init__(self, max_examples=DEFAULT_MAX_EXAMPLES, detail_log=None):
+        """
+        :param int max_examples: Number of examples kept per group.
+        :param str detail_log: Path of a file to append every message to, or
+            ``None`` to only keep the examples.  It is opened when the first
+            message is added.
+        """
+        self.max_examples = max_examples
+        self.detail_log = detail_log
+        self.total = 0
+
+        self._groups = OrderedDict()
+        self._general = []
+        self._linking = []
+        self._files = OrderedDict()
+        self._log = None
+
+    def add_file(self, f_json):
+        """
+        Register a file so that it is reported even if it has no messages.
+
+        :param str f_json: Path of the file.
+        """
+        self._files.setdefault(f_json, [])
+
+    def add(self, section, message, f_json=None):
+        """
+        :param str section: :data:`GENERAL`, :data:`FILES` or :data:`LINKING`.
+        :param Message message: Message to add.
+        :param str f_json: File the message concerns, for :data:`FILES`
+            messages.
+        """
+        key = (section, f_json, message.level, message.category, message.code)
+        group = self._groups.get(key)
+
+        if group is None:
+            group = self._groups[key] = _MessageGroup()
+
+        group.count += 1
+        self.total += 1
+
+        if len(group.examples) < self.max_examples:
+            group.examples.append(str(message))
+            self._section_list(section, f_json).append(str(message))
+
+        if self.detail_log is not None:
+            if self._log is None:
+                self._log = open(self.detail_log, 'a', encoding='utf-8')
+
+            self._log.write('{}\t{}\t{}\n'.format(
+                section, f_json or '', message))
+
+    def _section_list(self, section, f_json):
+        if section == GENERAL:
+            return self._general
+
+        if section == LINKING:
+            return self._linking
+
+        return self._files.setdefault(f_json, [])
+
+    @property
+    def suppressed(self):
+        """Number of messages that weren't kept as examples."""
+        return sum(max(0, g.count - self.max_examples)
+                   for g in self._groups.values())
+
+    def close(self):
+        """Close the detail log, if any."""
+        if self._log is not None:
+            self._log.close()
+            self._log = None
+
+    def to_messages(self):
+        """
+        :return: Kept messages in the format ``ingest_fhir`` has always
+            returned: ``general`` and ``linking`` lists and a ``files``
+            mapping of file to list.  Each list ends with a line per group
+            that had messages suppressed.
+        :rtype: dict
+        """
+        messages = {
+            GENERAL: list(self._general),
+            FILES: {f: list(msgs) for f, msgs in self._files.items()},
+            LINKING: list(self._linking),
+        }
+
+        for (section, f_json, level, category, code), group in self._groups.items():
+            n = group.count - self.max_examples
+
+            if n > 0:
+                what = category if code is None else f'{category}, {code.display}'
+                line = f'{level}: {n} more "{what}" messages suppressed.'
+
+                if self.detail_log is not None:
+                    line += f'  See "{self.detail_log}" for all messages.'
+
+                if section == FILES:
+                    messages[FILES][f_json].append(line)
+                else:
+                    messages[section].append(line)
+
+        return messages
+
+    def summary(self):
+        """
+        :return: Message counts by group, most frequent first.
+        :rtype: dict
+        """
+        groups = []
+
+        for (section, f_json, level, category, code), group in self._groups.items():
+            groups.append({
+                'section': section,
+                'file': f_json,
+                'level': level,
+                'category': category,
+                'system': code.system if isinstance(code, CodeValue) else None,
+                'code': code.code if isinstance(code, CodeValue) else None,
+                'count': group.count,
+                'examples': group.examples,
+            })
+
+        groups.sort(key=lambda g: g['count'], reverse=True)
+
+        return {
+            'total': self.total,
+            'suppressed': self.suppressed,
+            'detail_log': self.detail_log,
+            'groups': groups,
+        }
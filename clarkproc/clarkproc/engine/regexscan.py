@@ -0,0 +1,236 @@
+"""
+Counting the matches of many regular expressions in the same texts.
+
+Feature extraction counts the matches of every feature regex in every section
+of every note, but most sections don't contain most features.  A
+:class:`RegexScanner` is built once for a set of regexes.  For each regex it
+works out literal strings, at least one of which must appear in any text the
+regex matches (e.g. ``"cough"`` for ``r"\\bcoughs?\\b"``, or ``"cough"`` or
+``"wheez"`` for ``r"cough|wheez"``).  A text is first searched for these
+literals, and only the regexes whose literals were found (or that have none)
+are then run on it.
+"""
+from collections import OrderedDict
+import re
+import threading
+
+try:
+    # Python 3.11+
+    from re import _constants as sre_constants
+    from re import _parser as sre_parse
+except ImportError:
+    import sre_constants
+    import sre_parse
+
+_LITERAL = sre_constants.LITERAL
+_SUBPATTERN = sre_constants.SUBPATTERN
+_BRANCH = sre_constants.BRANCH
+_REPEATS = tuple(getattr(sre_constants, name) for name in (
+    'MAX_REPEAT', 'MIN_REPEAT', 'POSSESSIVE_REPEAT')
+    if hasattr(sre_constants, name))
+_ATOMIC_GROUP = getattr(sre_constants, 'ATOMIC_GROUP', None)
+
+# Number of compiled regexes kept by a RegexCache by default.
+DEFAULT_CACHE_SIZE = 2048
+
+
+class RegexCache:
+    """
+    Least recently used cache of compiled regexes.
+
+    The ``re`` module only keeps a few hundred compiled patterns, so a large
+    regex library is recompiled over and over when used through the module
+    level functions.  This cache has a configurable size and evicts the least
+    recently used patterns first.  It is safe to use from several threads.
+    """
+
+    def __init__(self, max_size=DEFAULT_CACHE_SIZE):
+        """
+        :param int max_size: Maximum number of compiled regexes kept.
+        """
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._patterns = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._patterns)
+
+    def compile(self, pattern, flags=0):
+        """
+        :param str pattern: Regular expression.
+        :param int flags: ``re`` flags.
+        :return: The compiled regex.
+        :rtype: re.Pattern
+        :raises re.error: If the regex is invalid.
+        :raises TypeError: If the pattern isn't a string.
+        """
+        key = (pattern, flags)
+
+        with self._lock:
+            compiled = self._patterns.get(key)
+
+            if compiled is not None:
+                self._patterns.move_to_end(key)
+                self.hits += 1
+                return compiled
+
+        compiled = re.compile(pattern, flags)
+
+        with self._lock:
+            self.misses += 1
+            self._patterns[key] = compiled
+
+            while len(self._patterns) > self.max_size:
+                self._patterns.popitem(last=False)
+
+        return compiled
+
+
+def _best(requirements):
+    """
+    :return: Of several requirements, the one most likely to rule texts out:
+        the one whose shortest literal is longest.
+    """
+    return max(requirements, key=lambda r: (min(len(l) for l in r), -len(r)))
+
+
+def _requirements(items):
+    """
+    :param items: Parsed (sub)pattern.
+    :return: Requirements of the pattern: tuples of literals, one of which
+        appears in every match.
+    :rtype: list(tuple(str))
+    """
+    requirements = []
+    run = []
+
+    def end_run():
+        if run:
+            requirements.append((''.join(run),))
+            del run[:]
+
+    for op, av in items:
+        if op == _LITERAL:
+            run.append(chr(av))
+            continue
+
+        end_run()
+
+        if op == _SUBPATTERN:
+            add_flags, sub = av[1], av[-1]
+
+            if not add_flags & sre_constants.SRE_FLAG_IGNORECASE:
+                requirements.extend(_requirements(sub))
+        elif op in _REPEATS:
+            min_repeat, _, sub = av
+
+            if min_repeat >= 1:
+                requirements.extend(_requirements(sub))
+        elif op == _ATOMIC_GROUP:
+            requirements.extend(_requirements(av))
+        elif op == _BRANCH:
+            literals = set()
+
+            for alternative in av[1]:
+                alternative_requirements = _requirements(alternative)
+
+                if not alternative_requirements:
+                    break
+
+                literals.update(_best(alternative_requirements))
+            else:
+                requirements.append(tuple(sorted(literals)))
+
+        # Anything else (classes, anchors, lookarounds, backreferences...)
+        # ends the run without requiring anything.
+
+    end_run()
+
+    return requirements
+
+
+def required_literals(regex, flags=None):
+    """
+    :param str regex: Regular expression.
+    :param int flags: Flags of the compiled regex (including inline ones), if
+        already known.
+    :return: Literals one of which appears in any text the regex matches, or
+        ``None`` if no such literals could be found.
+    :rtype: tuple(str)
+    :raises re.error: If the regex is invalid.
+    """
+    if flags is None:
+        flags = re.compile(regex).flags
+
+    if flags & re.IGNORECASE:
+        return None
+
+    requirements = _requirements(sre_parse.parse(regex, flags))
+
+    return _best(requirements) if requirements else None
+
+
+class RegexScanner:
+    """
+    Counts the (non-overlapping) matches of several regexes in texts, like
+    ``len(re.findall(regex, text))`` does for each.
+    """
+
+    def __init__(self, regexes, cache=None):
+        """
+        :param regexes: Regular expressions to count the matches of.
+            Duplicates are only counted once.
+        :type regexes: iterable(str)
+        :param RegexCache cache: Cache to compile the regexes through.
+        :raises re.error: If one of the regexes is invalid.
+        """
+        compile_regex = cache.compile if cache is not None else re.compile
+
+        self.regexes = list(dict.fromkeys(regexes))
+        self._compiled = [compile_regex(r) for r in self.regexes]
+
+        # Regexes that always have to be run, and those to run by literal.
+        self._unfiltered = []
+        self._by_literal = {}
+
+        for i, regex in enumerate(self.regexes):
+            literals = required_literals(regex, self._compiled[i].flags)
+
+            if literals is None:
+                self._unfiltered.append(i)
+            else:
+                for literal in literals:
+                    self._by_literal.setdefault(literal, []).append(i)
+
+    def candidates(self, text):
+        """
+        :param str text: Text to scan.
+        :return: Indices (in :attr:`regexes`) of the regexes that may match
+            the text.
+        :rtype: set(int)
+        """
+        candidates = set(self._unfiltered)
+
+        # Substring search is much faster than running a regex, including an
+        # alternation of all the literals, so each literal is looked for on
+        # its own.
+        for literal, indices in self._by_literal.items():
+            if literal in text:
+                candidates.update(indices)
+
+        return candidates
+
+    def count(self, text):
+        """
+        :param str text: Text to scan.
+        :return: Number of matches of each regex in the text.
+        :rtype: dict
+        """
+        counts = dict.fromkeys(self.regexes, 0)
+
+        for i in self.candidates(text):
+            counts[self.regexes[i]] = len(self._compiled[i].findall(text))
+
+        return counts
@@ -0,0 +1,148 @@
+"""
+Splitting notes into the sections that features are extracted from.
+
+The sections plan of an experiment splits notes at ``section_break`` matches,
+tags the sections whose header matches a tag regex and drops the ignored
+ones.  Users mostly iterate on the feature regexes with the same sections
+plan, so the resulting spans are cached per note in a :class:`SectionCache`,
+keyed by a hash of the plan.
+"""
+from collections import OrderedDict
+import hashlib
+import json
+import re
+import threading
+
+# Number of sections plans whose spans are kept by a SectionCache by default.
+DEFAULT_MAX_PLANS = 4
+
+
+def plan_key(sections_plan):
+    """
+    :param dict sections_plan: Sections part of a feature plan.
+    :return: Hash identifying the plan.
+    :rtype: str
+    """
+    return hashlib.sha1(json.dumps(
+        sections_plan, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class SectionSplitter:
+    """Splits notes according to a sections plan."""
+
+    def __init__(self, sections_plan, compile_regex=re.compile, cache=None):
+        """
+        :param dict sections_plan: Sections part of a feature plan.
+        :param compile_regex: Function to compile the plan's regexes with,
+            e.g. :meth:`clarkproc.engine.regexscan.RegexCache.compile`.
+        :param dict cache: Spans of notes already split with this plan, by
+            note key (see :meth:`SectionCache.get`).
+        """
+        self.plan = sections_plan
+        self.tags = [(compile_regex(tag['regex']), tag.get('ignore', False))
+                     for tag in sections_plan.get('tags', [])]
+        section_break = sections_plan.get('section_break', None)
+        self.section_break = (compile_regex(section_break)
+                              if section_break is not None else None)
+        self.ignore_header = sections_plan.get('ignore_header', False)
+        self.ignore_untagged = sections_plan.get('ignore_untagged', False)
+        self.cache = cache
+
+    def spans(self, note):
+        """
+        :param str note: Text of the note.
+        :return: (start, end) of the sections of the note to extract features
+            from.  A section runs from its header up to the next one; the
+            header is the text before the first.  When several sections have
+            the same header text, or the same tags, only the last one is kept.
+        :rtype: tuple
+        """
+        if self.section_break is not None:
+            breaks = [match.span() for match in self.section_break.finditer(note)]
+        else:
+            breaks = []
+
+        sections = {}
+
+        if breaks:
+            header = (0, breaks[0][0])
+
+            for i, (start, end) in enumerate(breaks):
+                stop = breaks[i + 1][0] if i < len(breaks) - 1 else len(note)
+                sections[note[start:end]] = (start, stop)
+        else:
+            header = (0, len(note))
+
+        # tag sections
+        tagged = {}
+
+        for key, span in sections.items():
+            tagged[tuple(ignore for tag, ignore in self.tags
+                         if tag.match(key))] = span
+
+        # filter sections
+        kept = [
+            span
+            for key, span in tagged.items()
+            if not any(key) and (key or not self.ignore_untagged)
+        ]
+
+        if not self.ignore_header:
+            kept.append(header)
+
+        return tuple(kept)
+
+    def sections(self, note, key=None):
+        """
+        :param str note: Text of the note.
+        :param key: Key of the note in the cache, e.g. (patient id, note id).
+            Not cached if ``None``.
+        :return: Text of the sections to extract features from.
+        :rtype: list(str)
+        """
+        if key is None or self.cache is None:
+            spans = self.spans(note)
+        else:
+            spans = self.cache.get(key)
+
+            if spans is None:
+                spans = self.cache[key] = self.spans(note)
+
+        return [note[start:end] for start, end in spans]
+
+
+class SectionCache:
+    """
+    Spans of the sections of a corpus' notes, for the most recently used
+    sections plans.  The cache must be dropped when notes change.
+    """
+
+    def __init__(self, max_plans=DEFAULT_MAX_PLANS):
+        """
+        :param int max_plans: Number of sections plans to keep spans for.
+        """
+        self.max_plans = max_plans
+        self._plans = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, sections_plan):
+        """
+        :param dict sections_plan: Sections part of a feature plan.
+        :return: Spans of the notes split with the plan so far, by note key,
+            to be filled in by a :class:`SectionSplitter`.
+        :rtype: dict
+        """
+        key = plan_key(sections_plan)
+
+        with self._lock:
+            spans = self._plans.get(key)
+
+            if spans is None:
+                spans = self._plans[key] = {}
+
+                while len(self._plans) > self.max_plans:
+                    self._plans.popitem(last=False)
+            else:
+                self._plans.move_to_end(key)
+
+        return spans
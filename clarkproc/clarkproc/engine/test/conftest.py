@@ -0,0 +1,152 @@
+"""
+Factories of FHIR resources and corpora shared by the engine tests.
+"""
+import base64
+import json
+import random
+
+import pytest
+
+from clarkproc.engine import ingest
+
+CATEGORY_SYSTEM = 'http://hl7.org/fhir/observation-category'
+
+
+def make_patient(patient_id, gender='female'):
+    return {
+        'resourceType': 'Patient',
+        'id': patient_id,
+        'gender': gender,
+        'birthDate': '1970-01-01',
+    }
+
+
+def make_observation(obs_id, patient_id, code, value, date,
+                     category='laboratory', unit='mg/dL'):
+    return {
+        'resourceType': 'Observation',
+        'id': obs_id,
+        'status': 'final',
+        'category': [{'coding': [{'system': CATEGORY_SYSTEM,
+                                  'code': category}]}],
+        'code': {'coding': [{'system': 'http://loinc.org', 'code': code,
+                             'display': f'Code {code}'}]},
+        'subject': {'reference': f'Patient/{patient_id}'},
+        'effectiveDateTime': date,
+        'valueQuantity': {'value': value, 'unit': unit},
+    }
+
+
+def make_medication(med_id, patient_id, code='1049630'):
+    return {
+        'resourceType': 'MedicationRequest',
+        'id': med_id,
+        'status': 'active',
+        'intent': 'order',
+        'subject': {'reference': f'Patient/{patient_id}'},
+        'authoredOn': '2015-01-01',
+        'medicationCodeableConcept': {'coding': [{
+            'system': 'http://www.nlm.nih.gov/research/umls/rxnorm',
+            'code': code,
+        }]},
+    }
+
+
+def make_note(note_id, patient_id, text):
+    return {
+        'resourceType': 'DocumentReference',
+        'id': note_id,
+        'status': 'current',
+        'subject': {'reference': f'Patient/{patient_id}'},
+        'content': [{'attachment': {
+            'contentType': 'text/plain',
+            'data': base64.b64encode(text.encode()).decode(),
+        }}],
+    }
+
+
+def make_bundle(resources):
+    return {
+        'resourceType': 'Bundle',
+        'type': 'collection',
+        'entry': [{'resource': r} for r in resources],
+    }
+
+
+@pytest.fixture
+def corpus(tmp_path):
+    """Write a small corpus spread over several bundle files."""
+    for f in range(4):
+        resources = []
+        for p in range(3):
+            patient_id = f'p{f}_{p}'
+            resources += [
+                make_patient(patient_id, 'male' if p % 2 else 'female'),
+                make_observation(f'o{f}_{p}_0', patient_id, '2160-0', 1.0 + p,
+                                 '2015-01-01T00:00:00Z'),
+                make_observation(f'o{f}_{p}_1', patient_id, '8867-4', 60.0 + f,
+                                 '2016-01-01T00:00:00Z', 'vital-signs',
+                                 '/min'),
+                make_medication(f'm{f}_{p}', patient_id),
+                make_note(f'n{f}_{p}', patient_id, 'cough and fever'),
+            ]
+        # A duplicate patient, an orphaned lab and an invalid observation.
+        resources += [
+            make_patient('p0_0'),
+            make_observation(f'orphan{f}', 'nobody', '2160-0', 1.0,
+                             '2015-01-01T00:00:00Z'),
+            dict(make_observation(f'bad{f}', 'p0_0', '2160-0', 1.0,
+                                  '2015-01-01T00:00:00Z'), status='draft'),
+        ]
+        (tmp_path / f'bundle{f}.json').write_text(
+            json.dumps(make_bundle(resources)))
+
+    (tmp_path / 'broken.json').write_text('{"resourceType": ')
+
+    return str(tmp_path / '*.json')
+
+
+def write_bundle(path, resources):
+    """
+    :param pathlib.Path path: Path of the file to write.
+    :param list resources: Resources to write as a Bundle.
+    :return: The path, as a string.
+    :rtype: str
+    """
+    path.write_text(json.dumps(make_bundle(resources)))
+    return str(path)
+
+
+NOTE_WORDS = ['HPI:', 'PLAN:', 'cough', 'fever', 'denies', 'mg']
+NOTE_PLAN = {
+    'sections': {'section_break': r'(?m)^[A-Z]+:',
+                 'tags': [{'regex': 'PLAN', 'ignore': True}]},
+    'features': [{'regex': r'\bcough'}, {'regex': 'fever|denies'},
+                 {'regex': 'mg'}, {'regex': 'absent'}],
+}
+
+
+def load_notes(tmp_path, num_patients, num_notes, with_notes=None,
+               max_lines=10, seed=0, note_store=None):
+    """
+    Load patients with random notes made of :data:`NOTE_WORDS`.
+
+    :param int with_notes: Number of patients (the first ones) the notes are
+        spread over.  ``None`` spreads them over all patients.
+    :param int max_lines: Notes have fewer lines than this.
+    :return: The loaded patients.
+    :rtype: clarkproc.fhir.containers.PatientCollection
+    """
+    rng = random.Random(seed)
+    resources = [make_patient(f'p{p}') for p in range(num_patients)]
+
+    for n in range(num_notes):
+        text = '\n'.join(rng.choice(NOTE_WORDS)
+                         for _ in range(rng.randrange(max_lines)))
+        patient = rng.randrange(with_notes or num_patients)
+        resources.append(make_note(f'n{n}', f'p{patient}', text))
+
+    path = write_bundle(tmp_path / 'notes.json', resources)
+    _, patients, *_ = ingest.ingest_fhir([path], note_store=note_store)
+
+    return patients
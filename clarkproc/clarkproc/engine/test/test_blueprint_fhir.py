@@ -0,0 +1,293 @@
+import threading
+import time
+
+import pytest
+
+from clarkproc import blueprint_fhir, state
+from clarkproc.engine import jobs
+from clarkproc.server_setup import app
+
+from conftest import make_note, make_observation, make_patient, write_bundle
+
+""" You can run these tests by doing (from python base directory):
+
+    python -m pytest clarkproc/engine/test/test_blueprint_fhir.py
+"""
+
+
+@pytest.fixture
+def client():
+    state.reset()
+    yield app.test_client()
+    state.reset()
+
+
+@pytest.mark.parametrize('num_workers', [True, False, 0, 'two'])
+def test_load_rejects_invalid_num_workers(client, tmp_path, num_workers):
+    path = write_bundle(tmp_path / 'b.json', [make_patient('p0')])
+
+    r = client.post('/fhir/load', json={'paths': [path], 'use_cache': False,
+                                        'num_workers': num_workers})
+
+    assert r.status_code == 400
+    assert state.train.patients is None
+
+
+@pytest.mark.parametrize('options', [
+    {'max_messages': True},
+    {'max_messages': False},
+    {'max_messages': -1},
+    {'message_log': 1},
+    {'message_log': ['log.txt']},
+    {'message_log': ''},
+    {'message_log': 'missing/log.txt'},
+    {'message_log': '.'},
+])
+def test_load_rejects_invalid_message_options(client, tmp_path, options):
+    path = write_bundle(tmp_path / 'b.json', [make_patient('p0')])
+    if isinstance(options.get('message_log'), str) and options['message_log']:
+        options = {'message_log': str(tmp_path / options['message_log'])}
+
+    r = client.post('/fhir/load', json={'paths': [path], 'use_cache': False,
+                                        **options})
+
+    assert r.status_code == 400
+    assert state.train.patients is None
+
+
+def test_message_log_created_on_first_message(client, tmp_path):
+    log = tmp_path / 'log.txt'
+    clean = write_bundle(tmp_path / 'a.json', [make_patient('p0')])
+    load = {'paths': [clean], 'use_cache': False, 'message_log': str(log)}
+
+    r = client.post('/fhir/load', json=load)
+    assert r.status_code == 200
+    assert not log.exists()
+
+    load['paths'].append(str(tmp_path / 'missing.json'))
+    r = client.post('/fhir/load', json=load)
+    assert r.status_code == 200
+    assert 'missing.json' in log.read_text()
+
+
+def wait_for_job(client, job_id):
+    for _ in range(500):
+        job = client.get(f'/fhir/load_jobs/{job_id}').get_json()
+
+        if job['status'] != 'running':
+            return job
+
+        time.sleep(0.01)
+
+    raise AssertionError(f'Job {job_id} did not finish.')
+
+
+def test_cancelled_append_leaves_state_unchanged(client, tmp_path,
+                                                 monkeypatch):
+    first = write_bundle(tmp_path / 'a.json', [
+        make_patient('p1'), make_note('n1', 'p1', 'cough')])
+    second = write_bundle(tmp_path / 'b.json', [
+        make_patient('p2'), make_note('n2', 'p2', 'cough')])
+    coverage = {'features': [{'regex': 'cough'}]}
+
+    r = client.post('/fhir/load', json={'paths': [first], 'use_cache': False})
+    assert r.status_code == 200
+    assert client.post('/coverage', json=coverage).get_json() == {'cough': 1}
+
+    loaded = state.train.patients
+    ingested = threading.Event()
+    resume = threading.Event()
+    run_load = blueprint_fhir.run_load
+
+    def blocking_run_load(options):
+        result = run_load(options)
+        ingested.set()
+        resume.wait(5)
+        return result
+
+    monkeypatch.setattr(blueprint_fhir, 'run_load', blocking_run_load)
+
+    load = {'paths': [second], 'use_cache': False, 'append': True}
+    job_id = client.post('/fhir/load_jobs', json=load).get_json()['job_id']
+
+    # The appended data isn't visible while the job runs...
+    assert ingested.wait(5)
+    assert state.train.patients is loaded
+    assert list(loaded) == ['p1']
+
+    # ...nor once it has been cancelled.
+    client.post(f'/fhir/load_jobs/{job_id}/cancel')
+    resume.set()
+
+    assert wait_for_job(client, job_id)['status'] == 'cancelled'
+    assert list(state.train.patients) == ['p1']
+    assert client.post('/coverage', json=coverage).get_json() == {'cough': 1}
+
+    job_id = client.post('/fhir/load_jobs', json=load).get_json()['job_id']
+
+    assert wait_for_job(client, job_id)['status'] == 'completed'
+    assert list(state.train.patients) == ['p1', 'p2']
+    assert client.post('/coverage', json=coverage).get_json() == {'cough': 2}
+
+
+def test_sync_load_excludes_jobs(client, tmp_path, monkeypatch):
+    path = write_bundle(tmp_path / 'a.json', [make_patient('p1')])
+    load = {'paths': [path], 'use_cache': False}
+    ingested = threading.Event()
+    resume = threading.Event()
+    run_load = blueprint_fhir.run_load
+
+    def blocking_run_load(options):
+        result = run_load(options)
+        ingested.set()
+        resume.wait(5)
+        return result
+
+    monkeypatch.setattr(blueprint_fhir, 'run_load', blocking_run_load)
+    responses = []
+    thread = threading.Thread(target=lambda: responses.append(
+        app.test_client().post('/fhir/load', json=load)))
+    thread.start()
+
+    assert ingested.wait(5)
+    assert client.post('/fhir/load_jobs', json=load).status_code == 409
+    assert client.post('/fhir/load', json=load).status_code == 409
+
+    # Cancelling (as /reset does) keeps the results from being applied.
+    jobs.cancel_all()
+    resume.set()
+    thread.join(5)
+
+    assert responses[0].status_code == 409
+    assert state.train.patients is None
+
+
+def test_cancel_waits_for_apply(client, tmp_path, monkeypatch):
+    path = write_bundle(tmp_path / 'a.json', [make_patient('p1')])
+    applying = threading.Event()
+    resume = threading.Event()
+    apply_load = blueprint_fhir.apply_load
+
+    def blocking_apply_load(*args):
+        applying.set()
+        resume.wait(5)
+        return apply_load(*args)
+
+    monkeypatch.setattr(blueprint_fhir, 'apply_load', blocking_apply_load)
+    r = client.post('/fhir/load_jobs', json={'paths': [path],
+                                             'use_cache': False})
+    job_id = r.get_json()['job_id']
+    assert applying.wait(5)
+
+    cancelled = threading.Event()
+    thread = threading.Thread(target=lambda: (jobs.cancel_all(),
+                                              cancelled.set()))
+    thread.start()
+
+    # Results being applied are applied in full before cancel_all returns,
+    # so that a reset that follows clears them.
+    assert not cancelled.wait(0.1)
+    resume.set()
+    thread.join(5)
+
+    assert cancelled.is_set()
+    assert wait_for_job(client, job_id)['status'] == 'completed'
+    assert list(state.train.patients) == ['p1']
+
+
+@pytest.fixture
+def patient_list(client, tmp_path):
+    """Load patients p0 to p9, where patient i has i % 4 labs."""
+    resources = []
+
+    for i in range(10):
+        resources.append(make_patient(f'p{i}', ['female', 'male'][i % 2]))
+        resources += [
+            make_observation(f'o{i}-{j}', f'p{i}', str(j), 1.0,
+                             '2015-01-01T00:00:00Z')
+            for j in range(i % 4)]
+
+    path = write_bundle(tmp_path / 'a.json', resources)
+    r = client.post('/fhir/load', json={'paths': [path], 'use_cache': False})
+    assert r.status_code == 200
+
+    return client
+
+
+def get_pages(client, query):
+    ids = []
+    cursor = ''
+
+    while cursor is not None:
+        page = client.get(f'/fhir/patient_list?{query}{cursor}').get_json()
+        ids.append([row['id'] for row in page['data']])
+        cursor = (f'&cursor={page["next_cursor"]}'
+                  if page['next_cursor'] is not None else None)
+
+    return ids
+
+
+def test_patient_list_ignores_unknown_parameters(patient_list):
+    full = patient_list.get('/fhir/patient_list').get_json()
+
+    assert [p['id'] for p in full] == [f'p{i}' for i in range(10)]
+    assert patient_list.get('/fhir/patient_list?_=123').get_json() == full
+
+    page = patient_list.get('/fhir/patient_list?limit=2&_=123').get_json()
+    assert page['total'] == 10
+
+
+def test_patient_list_paging(patient_list):
+    assert get_pages(patient_list, 'limit=4') == [
+        ['p0', 'p1', 'p2', 'p3'], ['p4', 'p5', 'p6', 'p7'], ['p8', 'p9']]
+
+
+def test_patient_list_sort_and_filter(patient_list):
+    # Ties keep the order patients were loaded in.
+    assert get_pages(patient_list, 'sort=num_labs&order=desc&limit=3') == [
+        ['p3', 'p7', 'p2'], ['p6', 'p1', 'p5'], ['p9', 'p0', 'p4'], ['p8']]
+
+    page = patient_list.get('/fhir/patient_list?gender=male&num_labs=1'
+                            '&fields=id,num_labs').get_json()
+    assert page == {'data': [{'id': 'p1', 'num_labs': 1},
+                             {'id': 'p5', 'num_labs': 1},
+                             {'id': 'p9', 'num_labs': 1}],
+                    'next_cursor': None, 'total': 3}
+
+
+def test_patient_list_cursor_survives_append(patient_list, tmp_path):
+    first = patient_list.get('/fhir/patient_list?sort=id&limit=3').get_json()
+    assert [row['id'] for row in first['data']] == ['p0', 'p1', 'p2']
+
+    # p10 and p11 sort before p2, but don't shift the pages that follow.
+    path = write_bundle(tmp_path / 'b.json', [make_patient('p10'),
+                                              make_patient('p11')])
+    r = patient_list.post('/fhir/load', json={'paths': [path], 'append': True,
+                                              'use_cache': False})
+    assert r.status_code == 200
+
+    second = patient_list.get('/fhir/patient_list?sort=id&limit=3'
+                              f'&cursor={first["next_cursor"]}').get_json()
+    assert [row['id'] for row in second['data']] == ['p3', 'p4', 'p5']
+    assert second['total'] == 12
+
+
+@pytest.mark.parametrize('query', [
+    'cursor=garbage',
+    'cursor=bnVsbA==',
+    'limit=0',
+    'limit=x',
+    'sort=nope',
+    'order=up',
+    'fields=id,nope',
+    'num_labs=x',
+])
+def test_patient_list_invalid_options(patient_list, query):
+    assert patient_list.get(f'/fhir/patient_list?{query}').status_code == 400
+
+
+def test_patient_list_cursor_of_other_sort(patient_list):
+    page = patient_list.get('/fhir/patient_list?sort=id&limit=3').get_json()
+
+    r = patient_list.get(f'/fhir/patient_list?cursor={page["next_cursor"]}')
+    assert r.status_code == 400
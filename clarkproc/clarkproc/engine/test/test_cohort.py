@@ -0,0 +1,122 @@
+import random
+import sys
+
+import pytest
+
+from clarkproc.engine import cohort, ingest
+from clarkproc.fhir.containers import CodedResourceItem
+
+from conftest import (make_medication, make_observation, make_patient,
+                      write_bundle)
+
+""" You can run these tests by doing (from python base directory):
+
+    python -m pytest clarkproc/engine/test/test_cohort.py
+"""
+
+LOINC = 'http://loinc.org'
+RXNORM = 'http://www.nlm.nih.gov/research/umls/rxnorm'
+
+
+@pytest.fixture
+def loaded(tmp_path):
+    rng = random.Random(0)
+    resources = [make_patient(f'p{p}') for p in range(40)]
+    codes = {}
+
+    for i in range(300):
+        patient_id = f'p{rng.randrange(35)}'
+        if rng.random() < 0.3:
+            code = rng.choice(['m1', 'm2'])
+            resources.append(make_medication(f'm{i}', patient_id, code))
+        else:
+            code = rng.choice(['1', '2', '3'])
+            resources.append(make_observation(
+                f'o{i}', patient_id, code, 1.0, '2015-01-01T00:00:00Z'))
+        codes.setdefault(code, []).append(patient_id)
+
+    path = write_bundle(tmp_path / 'bundle.json', resources)
+    _, patients, labs, vitals, medications = ingest.ingest_fhir([path])
+
+    return patients, labs, vitals, medications, codes
+
+
+def lab(code):
+    return {'type': 'labs', 'system': LOINC, 'code': code}
+
+
+def med(code):
+    return {'type': 'medications', 'system': RXNORM, 'code': code}
+
+
+def test_patient_index_storage():
+    # A rare code costs a few bytes, however high the patient's index.
+    item = CodedResourceItem(None, 199999)
+    assert sys.getsizeof(item._patients) < 100
+    assert item.patients == 1 << 199999
+
+    # Common codes switch to a bitmap, with the same results.
+    rng = random.Random(0)
+    added = [199999]
+    sizes = []
+
+    for _ in range(20000):
+        added.append(rng.randrange(200000))
+        item.add_id(added[-1])
+        sizes.append(sys.getsizeof(item._patients))
+
+    expected = 0
+    for i in sorted(set(added)):
+        expected |= 1 << i
+
+    assert item.patients == expected
+    assert item.num_ids() == len(added)
+    assert item.num_unique_ids() == len(set(added))
+    assert max(sizes) < 2 * 200000 // 8
+    assert isinstance(item._patients, bytearray)
+
+
+def test_summary_counts(loaded):
+    patients, labs, _, medications, codes = loaded
+
+    entries = labs.to_dict()['data'] + medications.to_dict()['data']
+    assert len(entries) == len(codes)
+
+    for entry in entries:
+        assert entry['total_count'] == len(codes[entry['code']])
+        assert entry['unique_count'] == len(set(codes[entry['code']]))
+
+
+def test_queries(loaded):
+    patients, labs, vitals, medications, codes = loaded
+    luts = {'labs': labs, 'vitals': vitals, 'medications': medications}
+    everyone = set(patients)
+    with_code = {c: set(ids) for c, ids in codes.items()}
+
+    def query(expression):
+        bitmap = cohort.evaluate(expression, luts, len(patients))
+        return {patients.ids[i] for i in cohort.indices(bitmap)}
+
+    assert query(lab('1')) == with_code['1']
+    assert query(lab('unknown')) == set()
+    assert query({'and': [lab('1'), {'not': lab('2')}, med('m1')]}) == (
+        with_code['1'] - with_code['2']) & with_code['m1']
+    assert query({'or': [lab('3'), med('m2')]}) == (
+        with_code['3'] | with_code['m2'])
+    assert query({'not': {'or': [lab('1'), lab('2'), lab('3')]}}) == (
+        everyone - with_code['1'] - with_code['2'] - with_code['3'])
+
+
+@pytest.mark.parametrize('expression', [
+    None,
+    {'and': []},
+    {'and': [lab('1')], 'or': [lab('2')]},
+    {'type': 'notes', 'system': LOINC, 'code': '1'},
+    {'type': 'labs', 'code': '1'},
+])
+def test_invalid_queries(loaded, expression):
+    patients, labs, vitals, medications, _ = loaded
+    luts = {'labs': labs, 'vitals': vitals, 'medications': medications}
+
+    with pytest.raises(ValueError):
+        cohort.evaluate(expression, luts, len(patients))
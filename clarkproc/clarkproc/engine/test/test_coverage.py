@@ -0,0 +1,92 @@
+import numpy as np
+
+from clarkproc import blueprint_ml
+from clarkproc.blueprint_ml import (cached_note_feature_matrix,
+                                    note_feature_matrix, notes_to_features)
+from clarkproc.engine.coverage import MatchCountCache
+from clarkproc.engine.sections import SectionCache
+
+from conftest import NOTE_PLAN as PLAN, load_notes
+
+""" You can run these tests by doing (from python base directory):
+
+    python -m pytest clarkproc/engine/test/test_coverage.py
+"""
+
+
+def test_feature_matrix(tmp_path):
+    patients = load_notes(tmp_path, 20, 60, with_notes=18)
+
+    regexes = [feature['regex'] for feature in PLAN['features']]
+    section_cache = SectionCache()
+
+    for _ in range(2):
+        matrix = note_feature_matrix(patients, PLAN, regexes,
+                                     section_cache=section_cache)
+
+        assert matrix.shape == (len(patients), len(regexes))
+
+        for row, patient in enumerate(patients.values()):
+            notes = [note.data for note in patient.notes.values()]
+            expected = notes_to_features(notes, PLAN)
+
+            assert matrix[row].tolist() == [expected[r] for r in regexes]
+
+    assert matrix.sum() > 0
+
+
+def test_match_count_cache():
+    # An entry takes 8 bytes (an index and a count) per patient with matches.
+    cache = MatchCountCache(max_bytes=24)
+    sections = PLAN['sections']
+    a, b, c = (np.array(counts, dtype=np.int32)
+               for counts in ([0, 1, 0], [2, 0, 0], [0, 0, 3]))
+
+    cache.put(sections, {'a': a, 'b': b})
+    found = cache.get(sections, ['a', 'b', 'c'])
+
+    assert set(found) == {'a', 'b'}
+    assert found['a'].tolist() == a.tolist()
+    assert found['b'].tolist() == b.tolist()
+    assert cache.get({}, ['a', 'b']) == {}
+    assert cache.nbytes == 16
+
+    # Regexes without matches take no space.
+    cache.put(sections, {'z': np.zeros(3, dtype=np.int32)})
+    assert cache.nbytes == 16
+    assert cache.get(sections, ['z'])['z'].tolist() == [0, 0, 0]
+
+    # "a" was used last, so "b" is evicted first.
+    cache.get(sections, ['a'])
+    cache.put({}, {'a': c})
+    cache.put(sections, {'c': c})
+
+    assert len(cache) == 4
+    assert cache.nbytes == 24
+    assert set(cache.get(sections, ['a', 'b', 'c'])) == {'a', 'c'}
+    assert cache.get({}, ['a'])['a'].tolist() == c.tolist()
+
+
+def test_cached_feature_matrix(tmp_path, monkeypatch):
+    patients = load_notes(tmp_path, 10, 30, seed=1)
+
+    regexes = [feature['regex'] for feature in PLAN['features']]
+    expected = note_feature_matrix(patients, PLAN, regexes)
+    cache = MatchCountCache()
+
+    counted = []
+    count = blueprint_ml.note_feature_matrix
+    monkeypatch.setattr(
+        blueprint_ml, 'note_feature_matrix',
+        lambda patients, plan, regexes, *args: counted.append(regexes)
+        or count(patients, plan, regexes, *args))
+
+    matrix = cached_note_feature_matrix(patients, PLAN, regexes[1:3],
+                                        coverage_cache=cache)
+    assert (matrix == expected[:, 1:3]).all()
+
+    # Only the regexes that weren't cached are counted.
+    matrix = cached_note_feature_matrix(patients, PLAN, regexes,
+                                        coverage_cache=cache)
+    assert (matrix == expected).all()
+    assert counted == [regexes[1:3], [regexes[0], regexes[3]]]
@@ -0,0 +1,79 @@
+import pytest
+
+from clarkproc.blueprint_ml import note_feature_matrix
+from clarkproc.engine import featurize
+from clarkproc.engine.featurize import NotePool
+from clarkproc.engine.sections import SectionCache
+from clarkproc.fhir.notestore import NoteStore
+
+from conftest import NOTE_PLAN as PLAN, load_notes
+
+""" You can run these tests by doing (from python base directory):
+
+    python -m pytest clarkproc/engine/test/test_featurize.py
+"""
+
+
+@pytest.fixture(scope='module')
+def pool():
+    pool = NotePool(2)
+    yield pool
+    pool.shutdown()
+
+
+def load_corpus(tmp_path, note_store=None):
+    return load_notes(tmp_path, 40, 150, with_notes=35, max_lines=20,
+                      note_store=note_store)
+
+
+def test_parallel_matches_serial(tmp_path, pool, monkeypatch):
+    monkeypatch.setattr(featurize, 'MIN_PARALLEL_NOTES', 0)
+    patients = load_corpus(tmp_path)
+
+    regexes = [feature['regex'] for feature in PLAN['features']]
+    expected = note_feature_matrix(patients, PLAN, regexes)
+    section_cache = SectionCache()
+
+    assert len(list(pool._shards([(0, 'k', 'text'), (1, 'k', '')]))) == 2
+
+    for _ in range(2):
+        matrix = note_feature_matrix(patients, PLAN, regexes,
+                                     section_cache=section_cache, pool=pool)
+
+        assert (matrix == expected).all()
+        # Spans computed by the workers were added to the cache.
+        assert len(section_cache.get(PLAN['sections'])) == 150
+
+    assert expected.sum() > 0
+
+
+def test_parallel_reads_note_store(tmp_path, pool, monkeypatch):
+    monkeypatch.setattr(featurize, 'MIN_PARALLEL_NOTES', 0)
+    store = NoteStore(str(tmp_path / 'notes'))
+    patients = load_corpus(tmp_path, store)
+
+    regexes = [feature['regex'] for feature in PLAN['features']]
+    expected = note_feature_matrix(patients, PLAN, regexes)
+    shards = []
+    executor = pool._get_executor()
+    submit = executor.submit
+    monkeypatch.setattr(executor, 'submit', lambda fn, *args: (
+        shards.append(args) or submit(fn, *args)))
+
+    matrix = note_feature_matrix(patients, PLAN, regexes, pool=pool)
+
+    assert (matrix == expected).all()
+    # Shards carry the location of the notes, not their text.
+    assert shards
+    assert all(isinstance(text, tuple)
+               for _, _, _, notes, _, _ in shards for _, _, text in notes)
+
+    # The workers are kept for other regexes and other note stores.
+    matrix = note_feature_matrix(patients, PLAN, regexes[:2], pool=pool)
+    assert pool._executor is executor
+    assert (matrix == expected[:, :2]).all()
+
+    other = load_corpus(tmp_path, NoteStore(str(tmp_path / 'other')))
+    matrix = note_feature_matrix(other, PLAN, regexes, pool=pool)
+    assert pool._executor is executor
+    assert (matrix == expected).all()
@@ -0,0 +1,627 @@
+import bz2
+import gzip
+import json
+import logging
+import lzma
+import os
+import pickle
+
+import pytest
+
+from clarkproc.engine import ingest
+from clarkproc.engine.cache import CACHE_VERSION, IngestCache
+from clarkproc.engine.messages import MessageCollector
+from clarkproc.engine.timing import IngestTiming
+from clarkproc.fhir.containers import MedicationContainer, ObservationContainer
+from clarkproc.fhir.errors import Message
+from clarkproc.fhir.models import (CodeValue, DocumentReference, Lab,
+                                   MedicationRequest, Patient, VitalSigns)
+from clarkproc.fhir.notestore import NoteStore
+from clarkproc.fhir.store import ObservationStore
+
+from conftest import make_bundle, make_note, make_observation, make_patient
+
+""" You can run these tests by doing (from python base directory):
+
+    python -m pytest clarkproc/engine/test/test_ingest.py
+"""
+
+def summarize(result):
+    messages, patients, labs, vitals, medications = result
+    return (
+        messages,
+        {pid: p.to_dict() for pid, p in patients.items()},
+        labs.to_dict(),
+        vitals.to_dict(),
+        medications.to_dict(),
+    )
+
+
+def test_serial_ingest(corpus):
+    messages, patients, labs, vitals, medications = ingest.ingest_fhir(
+        [corpus])
+
+    assert len(patients) == 12
+    assert labs.total_count == 12
+    assert vitals.total_count == 12
+    assert medications.total_count == 12
+    assert len(patients['p1_2'].notes) == 1
+    assert len(messages['linking']) == 4
+    assert any(m.startswith('ERROR: JSON decoding failed')
+               for m in messages['files'][corpus.replace('*', 'broken')])
+
+
+def test_parallel_ingest_matches_serial(corpus):
+    serial = summarize(ingest.ingest_fhir([corpus]))
+    parallel = summarize(ingest.ingest_fhir([corpus], num_workers=3))
+
+    assert parallel == serial
+
+
+def test_missing_files(tmp_path):
+    messages, patients, *_ = ingest.ingest_fhir(
+        [str(tmp_path / 'missing*.json')], num_workers=2)
+
+    assert patients is None
+    assert messages['general'][-1].startswith('ERROR: No files found')
+
+
+def test_invalid_entry_rejects_file(tmp_path):
+    bad = make_observation('o1', 'p1', '2160-0', 1.0, '2015-01-01T00:00:00Z')
+    bad['unknownField'] = 1
+    (tmp_path / 'a.json').write_text(json.dumps(make_bundle([
+        make_patient('p1'), bad])))
+    (tmp_path / 'b.json').write_text(json.dumps(make_bundle([
+        make_patient('p2')])))
+
+    messages, patients, *_ = ingest.ingest_fhir([str(tmp_path / '*.json')])
+
+    assert list(patients) == ['p2']
+    [msg] = messages['files'][str(tmp_path / 'a.json')]
+    assert msg.startswith('ERROR: FHIR parsing failed')
+    assert 'entry.1' in msg
+
+
+def test_non_bundle_rejected(tmp_path):
+    (tmp_path / 'a.json').write_text(json.dumps(make_patient('p1')))
+
+    messages, patients, *_ = ingest.ingest_fhir([str(tmp_path / '*.json')])
+
+    assert patients is None
+    assert messages['files'][str(tmp_path / 'a.json')] == [
+        'ERROR: Found resourceType "Patient" but only "Bundle" is supported.']
+
+
+def test_labels(tmp_path):
+    (tmp_path / 'a.json').write_text(json.dumps(make_bundle([
+        make_patient('p1'), make_patient('p2')])))
+    (tmp_path / 'labels.json').write_text(json.dumps({
+        'resourceType': 'Bundle',
+        'entry': [
+            {'resourceType': 'ClarkLabel',
+             'subject': {'reference': f'Patient/{p}'},
+             'label': {'value': label}}
+            for p, label in [('p1', 'yes'), ('p2', 'no'), ('p3', 'no')]
+        ],
+    }))
+
+    messages, patients, *_ = ingest.ingest_fhir([str(tmp_path / '*.json')])
+
+    assert patients['p1'].label == 'yes'
+    assert patients['p2'].label == 'no'
+    assert len(messages['linking']) == 1
+
+
+def test_ndjson(tmp_path):
+    patients_file = tmp_path / 'export' / 'Patient.ndjson'
+    patients_file.parent.mkdir()
+    patients_file.write_text('\n'.join(
+        json.dumps(make_patient(f'p{i}')) for i in range(3)) + '\n\n')
+    (tmp_path / 'export' / 'Observation.ndjson').write_text('\n'.join([
+        json.dumps(make_observation('o1', 'p1', '2160-0', 1.0,
+                                    '2015-01-01T00:00:00Z')),
+        '{"resourceType": "Observation", ',
+        json.dumps(dict(make_observation('o2', 'p2', '2160-0', 1.0,
+                                         '2015-01-01T00:00:00Z'),
+                        unknownField=1)),
+        json.dumps(make_observation('o3', 'p9', '2160-0', 1.0,
+                                    '2015-01-01T00:00:00Z')),
+    ]))
+
+    messages, patients, labs, *_ = ingest.ingest_fhir(
+        [str(tmp_path / 'export' / '*.ndjson')], num_workers=2)
+
+    assert list(patients) == ['p0', 'p1', 'p2']
+    assert patients['p1'].labs.total_count == 1
+    assert labs.total_count == 1
+    obs_messages = messages['files'][str(tmp_path / 'export' /
+                                         'Observation.ndjson')]
+    assert obs_messages[0].startswith('ERROR: Line 2: JSON decoding failed')
+    assert obs_messages[1].startswith('ERROR: Line 3: FHIR parsing failed')
+    assert len(messages['linking']) == 1
+
+
+def test_cache(tmp_path, corpus, monkeypatch):
+    cache = IngestCache(str(tmp_path / 'cache'))
+    expected = summarize(ingest.ingest_fhir([corpus]))
+
+    assert summarize(ingest.ingest_fhir([corpus], cache=cache)) == expected
+
+    # Every file that parsed is now served from the cache.
+    parsed = []
+    parse_file = ingest._parse_file
+    monkeypatch.setattr(ingest, '_parse_file',
+                        lambda f, *args: parsed.append(f) or parse_file(f, *args))
+
+    assert summarize(ingest.ingest_fhir([corpus], cache=cache)) == expected
+    assert parsed == [corpus.replace('*', 'broken')]
+
+    # Changing a file invalidates its entry.
+    changed = corpus.replace('*', 'bundle0')
+    with open(changed, 'a') as f:
+        f.write('\n')
+    parsed.clear()
+
+    ingest.ingest_fhir([corpus], cache=cache)
+    assert sorted(parsed) == sorted([changed, corpus.replace('*', 'broken')])
+
+
+def test_cache_empty_result(tmp_path, monkeypatch):
+    cache = IngestCache(str(tmp_path / 'cache'))
+    path = tmp_path / 'b.json'
+    path.write_text(json.dumps(make_bundle([
+        {'resourceType': 'Organization', 'id': 'o1'}])))
+
+    ingest.ingest_fhir([str(path)], cache=cache)
+
+    # The file holds nothing we use, but isn't parsed again.
+    monkeypatch.setattr(ingest, '_parse_file', None)
+    messages, patients, *_ = ingest.ingest_fhir([str(path)], cache=cache)
+
+    assert patients is None
+    assert messages['files'][str(path)] == []
+
+
+def test_cache_eviction(tmp_path, corpus):
+    cache = IngestCache(str(tmp_path / 'cache'), max_bytes=0)
+
+    ingest.ingest_fhir([corpus], cache=cache)
+
+    assert not list((tmp_path / 'cache').iterdir())
+
+
+def test_cache_content_hash(tmp_path, corpus):
+    cache = IngestCache(str(tmp_path / 'cache'), use_hash=True)
+    path = corpus.replace('*', 'bundle1')
+
+    ingest.ingest_fhir([path], cache=cache)
+    os.utime(path, ns=(0, 0))
+
+    assert cache.get(path, variant='strict') is not None
+
+
+# The attributes of the classes pickled in the ingest cache, as of
+# CACHE_VERSION.  Unpickling restores slots by name, so an entry written before
+# an attribute was added loads without error and fails later on.  When this
+# test fails, bump CACHE_VERSION and record the new attributes here.
+CACHED_SHAPES = (3, {
+    'CodeValue': ('code', 'system', '_display', '_hash', '__weakref__'),
+    'Patient': ('id', 'index', 'label', 'labs', 'vitals', 'medications',
+                'notes', 'gender', 'birthDate', 'maritalStatus', 'race',
+                'ethnicity', '_json', '_json_summary'),
+    'Lab': ('id', 'ref', 'status', 'effectiveDateTime', 'code', 'value',
+            'unit'),
+    'VitalSigns': ('id', 'ref', 'status', 'effectiveDateTime', 'code',
+                   'value', 'unit'),
+    'MedicationRequest': ('id', 'ref', 'status', 'intent', 'authoredOn',
+                          'code'),
+    'DocumentReference': ('id', 'ref', 'status', 'indexed', 'type', '_data',
+                          '_store', '_offset', '_length'),
+    'ObservationContainer': ('data', 'total_count'),
+    'MedicationContainer': ('data', 'total_count'),
+    'Message': ('level', 'category', 'text', 'code'),
+})
+
+
+def test_cache_version_tracks_model_shapes():
+    def shape(cls):
+        if hasattr(cls, '_fields'):
+            return cls._fields
+        return tuple(slot for c in reversed(cls.__mro__)
+                     for slot in c.__dict__.get('__slots__', ()))
+
+    shapes = {cls.__name__: shape(cls)
+              for cls in (CodeValue, Patient, Lab, VitalSigns,
+                          MedicationRequest, DocumentReference,
+                          ObservationContainer, MedicationContainer, Message)}
+
+    assert (CACHE_VERSION, shapes) == CACHED_SHAPES
+
+
+def test_fast_decoder_matches_strict(corpus):
+    strict = summarize(ingest.ingest_fhir([corpus]))
+    fast = summarize(ingest.ingest_fhir([corpus], decoder='fast',
+                                        num_workers=2))
+
+    assert fast == strict
+
+
+@pytest.mark.parametrize('field, value, strict_rejects', [
+    ('value', 'high', True),
+    ('date', 20150101, True),
+    # An unparseable date string is valid JSON for the strict decoder.
+    ('date', '2015-13-01T00:00:00Z', False),
+    ('code', 2160, True),
+    ('coding', {'code': '2160-0'}, True),
+])
+def test_malformed_values(tmp_path, field, value, strict_rejects):
+    bad = make_observation('o1', 'p1', '2160-0', 1.0, '2015-01-01T00:00:00Z')
+    if field == 'value':
+        bad['valueQuantity']['value'] = value
+    elif field == 'date':
+        bad['effectiveDateTime'] = value
+    elif field == 'code':
+        bad['code']['coding'][0]['code'] = value
+    else:
+        bad['code']['coding'] = value
+    good = make_observation('o2', 'p1', '2160-0', 2.0, '2015-01-02T00:00:00Z')
+    path = tmp_path / 'a.json'
+    path.write_text(json.dumps(make_bundle([make_patient('p1'), bad, good])))
+    (tmp_path / 'b.json').write_text(json.dumps(make_bundle([
+        make_patient('p2')])))
+
+    code = CodeValue('2160-0', 'http://loinc.org')
+
+    for decoder in ingest.DECODERS:
+        messages, patients, *_ = ingest.ingest_fhir(
+            [str(tmp_path / '*.json')], decoder=decoder)
+        [msg] = messages['files'][str(path)]
+
+        if decoder == 'strict' and strict_rejects:
+            # The strict decoder rejects the whole file.
+            assert list(patients) == ['p2']
+            assert msg.startswith('ERROR: FHIR parsing failed')
+        else:
+            # Only the malformed resource is skipped.
+            assert sorted(patients) == ['p1', 'p2']
+            assert [o.id for o in patients['p1'].labs[code].data] == ['o2']
+            assert msg.startswith('WARN: ')
+
+
+@pytest.mark.parametrize('resource_type', [['Patient'], {'a': 1}, None, 1])
+def test_malformed_resource_type(tmp_path, resource_type):
+    path = tmp_path / 'a.json'
+    path.write_text(json.dumps(make_bundle([
+        make_patient('p1'), {'resourceType': resource_type, 'id': 'x'}])))
+    (tmp_path / 'b.json').write_text(json.dumps(make_bundle([
+        make_patient('p2')])))
+
+    for decoder in ingest.DECODERS:
+        messages, patients, *_ = ingest.ingest_fhir(
+            [str(tmp_path / '*.json')], decoder=decoder)
+        [msg] = messages['files'][str(path)]
+
+        # Both decoders reject the whole file.
+        assert list(patients) == ['p2']
+        assert msg.startswith('ERROR: FHIR parsing failed')
+
+
+def test_append(corpus):
+    full = summarize(ingest.ingest_fhir([corpus]))
+
+    first = ingest.ingest_fhir([corpus.replace('*', 'bundle[01]')])
+    before = summarize(first)
+    appended = ingest.ingest_fhir(
+        [corpus.replace('*', 'bundle[23]'), corpus.replace('*', 'broken')],
+        append_to=first[1:])
+
+    assert summarize(appended)[1:] == full[1:]
+
+    # The data appended to is left unchanged.
+    assert appended[1] is not first[1]
+    assert summarize(first) == before
+
+
+def test_demographics_summary(corpus):
+    first = ingest.ingest_fhir([corpus.replace('*', 'bundle[01]')])
+    patients = first[1]
+    before = patients.summary()
+
+    assert before['count'] == 6
+    assert before['properties']['gender']['histogram'] == {
+        'female': 4, 'male': 2}
+    assert patients.summary() is before
+
+    appended = ingest.ingest_fhir([corpus.replace('*', 'bundle[23]')],
+                                  append_to=first[1:])
+    full = ingest.ingest_fhir([corpus])[1]
+
+    assert appended[1].summary() == full.summary()
+    assert full.summary()['properties']['gender'] == {
+        'display': 'Gender',
+        'type': 'categorical',
+        'percentDefined': 100.0,
+        'num_categories': 2,
+        'histogram': {'female': 8, 'male': 4},
+    }
+
+
+def test_append_links_to_existing_patients(tmp_path):
+    (tmp_path / 'a.json').write_text(json.dumps(make_bundle([
+        make_patient('p1')])))
+    (tmp_path / 'b.json').write_text(json.dumps(make_bundle([
+        make_patient('p1'),
+        make_observation('o1', 'p1', '2160-0', 1.0, '2015-01-01T00:00:00Z'),
+        make_note('n1', 'p1', 'text'),
+    ])))
+
+    first = ingest.ingest_fhir([str(tmp_path / 'a.json')])
+    messages, patients, labs, *_ = ingest.ingest_fhir(
+        [str(tmp_path / 'b.json')], append_to=first[1:])
+
+    assert messages['files'][str(tmp_path / 'b.json')] == [
+        'WARN: Skipping patient with duplicate id p1.']
+    assert patients['p1'].labs.total_count == 1
+    assert labs.total_count == 1
+    assert list(patients['p1'].notes) == ['n1']
+
+
+def test_patient_json_cache(tmp_path):
+    (tmp_path / 'a.json').write_text(json.dumps(make_bundle([
+        make_patient('p1')])))
+    (tmp_path / 'b.json').write_text(json.dumps(make_bundle([
+        make_observation('o1', 'p1', '2160-0', 1.0, '2015-01-01T00:00:00Z'),
+    ])))
+
+    first = ingest.ingest_fhir([str(tmp_path / 'a.json')])
+    patient = first[1]['p1']
+    summary = patient.to_json_summary()
+    full = patient.to_json()
+
+    assert json.loads(summary) == patient.to_dict_summary()
+    assert json.loads(full) == patient.to_dict()
+    assert patient.to_json_summary() is summary
+    assert patient.to_json() is full
+
+    patient.label = 'yes'
+    assert json.loads(patient.to_json())['label'] == 'yes'
+
+    _, patients, labs, vitals, _ = ingest.ingest_fhir(
+        [str(tmp_path / 'b.json')], append_to=first[1:])
+    appended = patients['p1']
+
+    assert json.loads(appended.to_json_summary())['num_labs'] == 1
+    assert json.loads(appended.to_json(labs.store, vitals.store)) == (
+        appended.to_dict())
+    assert json.loads(patient.to_json_summary())['num_labs'] == 0
+
+    # Summaries read from another store aren't the ones cached, even if the
+    # patient's counts are the same.
+    store = ObservationStore(patients, 'labs')
+    store.patient_summary = lambda patient_idx: {'rebuilt': True}
+    assert json.loads(appended.to_json(store, vitals.store))['labs'] == {
+        'rebuilt': True}
+
+
+def test_patient_sort_indexes(tmp_path):
+    resources = [make_patient(f'p{i}') for i in range(5)]
+    resources[3]['gender'] = None
+    for i, p in enumerate([1, 1, 4, 2]):
+        resources.append(make_observation(f'o{i}', f'p{p}', str(i), 1.0,
+                                          '2015-01-01T00:00:00Z'))
+    (tmp_path / 'a.json').write_text(json.dumps(make_bundle(resources)))
+    (tmp_path / 'b.json').write_text(json.dumps(make_bundle([
+        make_observation('o9', 'p0', '9', 1.0, '2015-01-01T00:00:00Z'),
+        make_observation('o10', 'p0', '10', 1.0, '2015-01-01T00:00:00Z'),
+        make_observation('o11', 'p0', '11', 1.0, '2015-01-01T00:00:00Z'),
+    ])))
+
+    first = ingest.ingest_fhir([str(tmp_path / 'a.json')])
+    patients = first[1]
+
+    assert patients.summary_column('num_labs').tolist() == [0, 2, 1, 0, 1]
+    assert patients.sort_index('num_labs').tolist() == [0, 3, 2, 4, 1]
+    assert patients.sort_index('num_labs', True).tolist() == [1, 2, 4, 0, 3]
+    assert patients.sort_index('gender').tolist()[-1] == 3
+    assert patients.sort_index('gender', True).tolist()[-1] == 3
+
+    # Linking resources to existing patients invalidates the indexes.
+    appended = ingest.ingest_fhir([str(tmp_path / 'b.json')],
+                                  append_to=first[1:])[1]
+
+    assert appended.sort_index('num_labs', True).tolist() == [0, 1, 2, 4, 3]
+    assert patients.sort_index('num_labs', True).tolist() == [1, 2, 4, 0, 3]
+
+
+def test_progress(corpus):
+    progress = ingest.IngestProgress()
+    ingest.ingest_fhir([corpus], num_workers=2, progress=progress)
+
+    assert progress.files_done == progress.files_total == 5
+    assert progress.bytes_read == progress.bytes_total > 0
+    assert progress.resources_parsed == 68
+
+
+def test_cancel(corpus):
+    progress = ingest.IngestProgress()
+    progress.cancel()
+
+    with pytest.raises(ingest.IngestCancelled):
+        ingest.ingest_fhir([corpus], num_workers=2, progress=progress)
+
+    assert progress.files_done == 0
+
+
+@pytest.mark.parametrize('name', ['big.json', 'big.ndjson'])
+def test_progress_within_file(tmp_path, name):
+    resources = [make_patient(f'p{p}') for p in range(6000)]
+    path = tmp_path / name
+    if name.endswith('.ndjson'):
+        path.write_text('\n'.join(json.dumps(r) for r in resources))
+    else:
+        path.write_text(json.dumps(make_bundle(resources)))
+
+    class CancellingProgress(ingest.IngestProgress):
+        updates = []
+
+        def update_file(self, num_entries, num_bytes):
+            self.updates.append((num_entries, num_bytes, self.to_dict()))
+            if len(self.updates) == 2:
+                self.cancel()
+            super().update_file(num_entries, num_bytes)
+
+    progress = CancellingProgress()
+
+    with pytest.raises(ingest.IngestCancelled):
+        ingest.ingest_fhir([str(path)], progress=progress)
+
+    # The single file was cancelled while it was being parsed.
+    assert [u[0] for u in progress.updates] == [1000, 2000]
+    assert 0 < progress.updates[0][1] < progress.updates[1][1] < path.stat().st_size
+    assert progress.files_done == 0
+    assert progress.to_dict()['resources_parsed'] == 2000
+
+
+@pytest.mark.parametrize('ext', ['.gz', '.bz2', '.xz', '.zst'])
+def test_compressed(tmp_path, corpus, ext):
+    if ext == '.zst':
+        zstandard = pytest.importorskip('zstandard')
+        compress = zstandard.ZstdCompressor().compress
+    else:
+        compress = {'.gz': gzip.compress, '.bz2': bz2.compress,
+                    '.xz': lzma.compress}[ext]
+
+    plain_files = [str(tmp_path / f'bundle{f}.json') for f in range(4)]
+    files = []
+    for f in plain_files:
+        with open(f, 'rb') as fin, open(f + ext, 'wb') as fout:
+            fout.write(compress(fin.read()))
+        files.append(f + ext)
+    # NDJSON detected by magic number rather than extension.
+    ndjson = tmp_path / 'Patient.ndjson'
+    ndjson.write_bytes(compress(json.dumps(make_patient('extra')).encode()))
+
+    plain = summarize(ingest.ingest_fhir(plain_files))
+    messages, patients, *rest = summarize(ingest.ingest_fhir(
+        files + [str(ndjson)]))
+
+    assert [messages['files'][f] for f in files] == [
+        plain[0]['files'][f] for f in plain_files]
+    assert messages['files'][str(ndjson)] == []
+    assert patients.pop('extra')
+    assert (patients, *rest) == plain[1:]
+
+
+def test_corrupt_compressed_file(tmp_path):
+    path = tmp_path / 'bundle.json.gz'
+    path.write_bytes(gzip.compress(b'{"resourceType": "Bundle"}')[:-6])
+
+    messages, patients, *_ = ingest.ingest_fhir([str(path)])
+
+    [msg] = messages['files'][str(path)]
+    assert msg.startswith('ERROR: JSON decoding failed')
+
+
+def test_note_store(tmp_path, corpus):
+    store = NoteStore(str(tmp_path / 'notes'))
+
+    in_memory = summarize(ingest.ingest_fhir([corpus]))
+    result = ingest.ingest_fhir([corpus], note_store=store)
+
+    assert summarize(result) == in_memory
+    assert store.size == len('cough and fever') * 12
+
+    note = result[1]['p1_2'].notes['n1_2']
+    assert note._data is None
+    assert note.data == 'cough and fever'
+    assert pickle.loads(pickle.dumps(note)).data == 'cough and fever'
+
+    # Other processes read notes from the backing file by location.
+    store.flush()
+    with open(store.path, 'rb') as f:
+        f.seek(note.location[1])
+        assert f.read(note.location[2]) == b'cough and fever'
+
+    store.close()
+    assert not os.path.exists(store.path)
+
+
+def test_timing(tmp_path, corpus, caplog):
+    cache = IngestCache(str(tmp_path / 'cache'))
+    ingest.ingest_fhir([corpus], cache=cache)
+
+    timing_report = IngestTiming(slowest_files=2)
+    with caplog.at_level(logging.INFO, logger=ingest.__name__):
+        ingest.ingest_fhir([corpus, str(tmp_path / 'bundle0.json')],
+                           cache=cache, timing_report=timing_report)
+
+    d = timing_report.to_dict()
+    assert d['num_files'] == 6
+    assert d['resources'] == 68 + 17
+    # Only broken.json isn't cached.
+    assert d['phases']['cache']['count'] == 5
+    assert d['phases']['io']['count'] == 1
+    assert d['phases']['models']['count'] == 0
+    assert d['phases']['linking']['count'] == 5 * 13
+    assert len(d['slowest_files']) == 2
+    assert d['slowest_files'][0]['seconds'] >= d['slowest_files'][1]['seconds']
+    assert d['total_seconds'] >= d['parse_seconds']
+    assert 'Ingest timing' in caplog.text
+
+
+def test_message_collector(tmp_path):
+    resources = [make_patient('p0')]
+    for i in range(5):
+        resources += [
+            make_observation(f'orphan{i}', 'nobody', '2160-0', 1.0,
+                             '2015-01-01T00:00:00Z'),
+            dict(make_observation(f'bad{i}', 'p0', '2160-0', 1.0,
+                                  '2015-01-01T00:00:00Z'), status='draft'),
+            make_observation(f'unit{i}', 'p0', '2160-0', 1.0,
+                             '2015-01-01T00:00:00Z', unit=f'u{i}'),
+        ]
+    path = tmp_path / 'bundle.json'
+    path.write_text(json.dumps(make_bundle(resources)))
+    log = tmp_path / 'messages.log'
+
+    collector = MessageCollector(max_examples=2, detail_log=str(log))
+    messages, patients, *_ = ingest.ingest_fhir([str(path)],
+                                                collector=collector)
+    collector.close()
+
+    assert messages['files'][str(path)] == [
+        'WARN: Observation id "bad0" has "draft" status.  Only "final" items '
+        'are supported.',
+        'WARN: Observation id "bad1" has "draft" status.  Only "final" items '
+        'are supported.',
+        'WARN: 3 more "unsupported_format" messages suppressed.  '
+        f'See "{log}" for all messages.',
+    ]
+    assert len(messages['linking']) == 6
+    assert messages['linking'][-2].startswith('WARN: 3 more "missing_patient')
+    assert messages['linking'][-1].startswith('WARN: 2 more "units_mismatch')
+
+    summary = collector.summary()
+    assert summary['total'] == 14
+    assert summary['suppressed'] == 8
+    assert [(g['category'], g['code'], g['count'])
+            for g in summary['groups']] == [
+        ('unsupported_format', None, 5),
+        ('missing_patient', '2160-0', 5),
+        ('units_mismatch', '2160-0', 4),
+    ]
+    assert len(log.read_text().splitlines()) == 14
+
+
+def test_code_values_interned(corpus):
+    _, patients, labs, *_ = ingest.ingest_fhir([corpus], num_workers=2)
+
+    codes = [obs.code
+             for p in patients.values()
+             for _, agg in p.labs
+             for obs in agg.data]
+    assert len(codes) == 12
+    assert all(c is codes[0] for c in codes)
+    assert next(iter(labs.data)) is codes[0]
+    assert pickle.loads(pickle.dumps(codes[0])) is codes[0]
+    assert CodeValue('2160-0', 'http://loinc.org') == codes[0]
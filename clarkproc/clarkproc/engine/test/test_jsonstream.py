@@ -0,0 +1,54 @@
+import io
+import json
+
+import pytest
+
+from clarkproc.engine import jsonstream
+
+DOCUMENT = {
+    'resourceType': 'Bundle',
+    'total': 12345,
+    'entry': [
+        {'resource': {'id': 'a', 'value': 1.5e10, 'flag': True}},
+        {'resource': {'id': 'bé"}', 'items': [1, [2, {}], None]}},
+        12,
+    ],
+    'meta': {'nested': {'entry': []}},
+    'after': -0.25,
+}
+
+
+@pytest.mark.parametrize('chunk_size', [1, 2, 3, 7, 64, 1 << 16])
+@pytest.mark.parametrize('indent', [None, 2])
+def test_iter_array_matches_json_load(chunk_size, indent):
+    text = json.dumps(DOCUMENT, indent=indent)
+    members = {}
+
+    entries = list(jsonstream.iter_array(io.StringIO(text), 'entry', members,
+                                         chunk_size=chunk_size))
+
+    expected = dict(DOCUMENT)
+    assert entries == expected.pop('entry')
+    assert members == expected
+
+
+def test_iter_array_empty():
+    members = {}
+    assert list(jsonstream.iter_array(io.StringIO('{"entry": [], "a": 1}'),
+                                      'entry', members)) == []
+    assert members == {'a': 1}
+    assert list(jsonstream.iter_array(io.StringIO(' {} '), 'entry')) == []
+
+
+@pytest.mark.parametrize('text', [
+    '',
+    '[1, 2]',
+    '{"entry": [1, 2}',
+    '{"entry": [1, 2]',
+    '{"entry": [{"a": 1} {"b": 2}]}',
+    '{"a": 1} {}',
+    '{a: 1}',
+])
+def test_iter_array_invalid(text):
+    with pytest.raises(jsonstream.JSONStreamError):
+        list(jsonstream.iter_array(io.StringIO(text), 'entry', chunk_size=2))
@@ -0,0 +1,84 @@
+import random
+import re
+
+import pytest
+
+from clarkproc.engine.regexscan import (RegexCache, RegexScanner,
+                                        required_literals)
+
+""" You can run these tests by doing (from python base directory):
+
+    python -m pytest clarkproc/engine/test/test_regexscan.py
+"""
+
+REGEXES = [
+    'cough', r'\bcoughs?\b', 'fever|febrile', 'ab', 'abc', 'bc', 'b', 'c+a',
+    '(?i)COUGH', '(?i:fe)ver', 'x*', r'\d+ mg', '(no|denies) (cough|fever)',
+    'a(?=b)', '(?<!a)bc', r'(\w)\1', 'fe[vw]er', '[abc]{2,}', 'b{0,2}c',
+    'ab|c', '(ab)+c', 'not present', '',
+]
+
+
+@pytest.mark.parametrize('regex, expected', [
+    ('cough', ('cough',)),
+    (r'\bcoughs?\b', ('cough',)),
+    # The parser factors out common prefixes.
+    ('fever|febrile', ('brile', 'ver')),
+    ('(no|denies) (cough|fever)', ('cough', 'fever')),
+    (r'\d+ mg', (' mg',)),
+    ('(ab)+c', ('ab',)),
+    ('(?i)COUGH', None),
+    ('(?i:fe)ver', ('ver',)),
+    ('x*', None),
+    ('fe[vw]er', ('fe',)),
+    ('a|b*', None),
+])
+def test_required_literals(regex, expected):
+    assert required_literals(regex) == expected
+
+
+def test_counts_match_findall():
+    rng = random.Random(0)
+    words = ['cough', 'coughs', 'Cough', 'fever', 'febrile', 'few', 'abc',
+             'bcab', 'aab', 'cca', '12 mg', 'no cough', 'denies fever', ' ',
+             ' ', '\n', 'x', 'ferer', 'fewer']
+    scanner = RegexScanner(REGEXES + ['cough'])
+
+    assert scanner.regexes == REGEXES
+
+    for _ in range(300):
+        text = ''.join(rng.choice(words) for _ in range(rng.randrange(30)))
+
+        assert scanner.count(text) == {
+            regex: len(re.findall(regex, text)) for regex in REGEXES}
+
+
+def test_sections_skip_regexes():
+    scanner = RegexScanner(['cough', 'fever|chills', 'x*'])
+
+    assert scanner.candidates('no complaints') == {2}
+    assert scanner.candidates('chills, cough') == {0, 1, 2}
+
+
+def test_invalid_regex():
+    with pytest.raises(re.error):
+        RegexScanner(['cough', '(unbalanced'])
+
+
+def test_regex_cache():
+    cache = RegexCache(max_size=2)
+    a = cache.compile('a')
+
+    assert cache.compile('a') is a
+    cache.compile('b')
+    cache.compile('a')
+    cache.compile('c')
+
+    # 'b' was the least recently used.
+    assert len(cache) == 2
+    assert cache.compile('a') is a
+    assert (cache.hits, cache.misses) == (3, 3)
+    assert cache.compile('a', re.IGNORECASE) is not a
+
+    with pytest.raises(re.error):
+        cache.compile('(')
@@ -0,0 +1,112 @@
+import random
+import re
+
+import pytest
+
+from clarkproc.blueprint_ml import notes_to_features, section_splitter
+from clarkproc.engine.regexscan import RegexCache
+from clarkproc.engine.sections import SectionCache, SectionSplitter, plan_key
+
+""" You can run these tests by doing (from python base directory):
+
+    python -m pytest clarkproc/engine/test/test_sections.py
+"""
+
+HEADERS = ['HPI:', 'PLAN:', 'MEDS:', 'FAMILY HISTORY:', 'OTHER:']
+WORDS = ['cough', 'fever', 'denies', 'the', 'mg', 'pain']
+
+
+def split(note, plan):
+    """Split a note the way features were extracted before sections were
+    cached."""
+    tags = [(re.compile(t['regex']), t.get('ignore', False))
+            for t in plan.get('tags', [])]
+    breaks = ([m.span() for m in re.finditer(plan['section_break'], note)]
+              if 'section_break' in plan else [])
+    if breaks:
+        header = note[:breaks[0][0]]
+        sections = dict(
+            (note[b[0]:b[1]],
+             note[b[0]:breaks[i + 1][0]] if i < len(breaks) - 1 else note[b[0]:])
+            for i, b in enumerate(breaks))
+    else:
+        header = note
+        sections = {}
+    sections = {tuple(ignore for tag, ignore in tags if tag.match(key)): value
+                for key, value in sections.items()}
+    sections = [value for key, value in sections.items()
+                if not any(key) and (key or not plan.get('ignore_untagged'))]
+    if not plan.get('ignore_header'):
+        sections.append(header)
+    return sections
+
+
+def make_note(rng):
+    parts = []
+    for _ in range(rng.randrange(8)):
+        parts.append(rng.choice(HEADERS + WORDS))
+    return '\n'.join(parts)
+
+
+PLANS = [
+    {},
+    {'section_break': r'^[A-Z ]+:', 'ignore_header': True},
+    {'section_break': r'(?m)^[A-Z ]+:',
+     'tags': [{'regex': 'HPI'}, {'regex': 'PLAN', 'ignore': True},
+              {'regex': '.*HISTORY', 'ignore': True}]},
+    {'section_break': r'(?m)^[A-Z ]+:', 'ignore_untagged': True,
+     'ignore_header': True,
+     'tags': [{'regex': 'HPI'}, {'regex': 'MEDS'}]},
+]
+
+
+@pytest.mark.parametrize('plan', PLANS)
+def test_sections_match_uncached_split(plan):
+    rng = random.Random(0)
+    cache = SectionCache()
+    notes = [make_note(rng) for _ in range(200)]
+
+    for _ in range(2):
+        splitter = SectionSplitter(plan, cache=cache.get(plan))
+
+        for i, note in enumerate(notes):
+            assert splitter.sections(note, ('p', i)) == split(note, plan)
+
+    assert len(cache.get(plan)) == len(notes)
+
+
+def test_cached_features():
+    rng = random.Random(1)
+    notes = [make_note(rng) for _ in range(50)]
+    keys = [('p', i) for i in range(len(notes))]
+    plan = {'sections': PLANS[2],
+            'features': [{'regex': w} for w in WORDS]}
+    regex_cache = RegexCache()
+    section_cache = SectionCache()
+
+    expected = notes_to_features(notes, plan)
+    splitter = section_splitter(plan, regex_cache, section_cache)
+
+    assert notes_to_features(notes, plan, splitter=splitter,
+                             note_keys=keys) == expected
+
+    # Spans are now looked up rather than computed again.
+    splitter = section_splitter(plan, regex_cache, section_cache)
+    splitter.spans = None
+
+    assert notes_to_features(notes, plan, splitter=splitter,
+                             note_keys=keys) == expected
+
+
+def test_plan_lru():
+    cache = SectionCache(max_plans=2)
+
+    spans = cache.get(PLANS[1])
+    spans['note'] = ()
+    cache.get(PLANS[2])
+    assert cache.get(dict(reversed(list(PLANS[1].items())))) is spans
+    cache.get(PLANS[3])
+
+    assert cache.get(PLANS[1]) is spans
+    assert cache.get(PLANS[2]) == {}
+    assert plan_key(PLANS[1]) != plan_key(PLANS[2])
@@ -0,0 +1,127 @@
+import random
+
+import numpy as np
+import pytest
+
+from clarkproc.fhir.stats import (SKETCH_CAPACITY, SKETCH_COMPRESSION,
+                                  RunningMoments, RunningStats, quantile)
+
+""" You can run these tests by doing (from python base directory):
+
+    python -m pytest clarkproc/engine/test/test_stats.py
+"""
+
+
+def make_stats(values):
+    stats = RunningStats()
+    for v in values:
+        stats.add(v)
+    return stats
+
+
+@pytest.mark.parametrize('n', [1, 2, 7, 2 * SKETCH_CAPACITY])
+def test_exact(n):
+    rng = random.Random(n)
+    values = [rng.choice([1, 2.5, 3, rng.random() * 100]) for _ in range(n)]
+    stats = make_stats(values)
+
+    assert stats.count == n
+    assert stats.mean == pytest.approx(np.mean(values))
+    if n > 1:
+        assert stats.std == pytest.approx(np.std(values, ddof=1))
+    else:
+        assert stats.std is None
+    for q in (0, 0.1, 0.5, 0.9, 1):
+        assert stats.quantile(q) == pytest.approx(np.quantile(values, q))
+
+
+def test_empty():
+    assert RunningStats().to_dict() == {
+        'mean': None, 'std': None, 'median': None, 'p90': None}
+
+
+@pytest.mark.parametrize('n', [0, 1, 2, 7, 10 * SKETCH_CAPACITY])
+def test_moments_and_exact_quantile(n):
+    rng = random.Random(n)
+    values = [rng.lognormvariate(0, 1) for _ in range(n)]
+    moments = RunningMoments()
+    for v in values:
+        moments.add(v)
+
+    # Only the moments are kept, whatever the number of values.
+    assert not hasattr(moments, '__dict__')
+    assert moments.to_dict() == {
+        'mean': make_stats(values).mean if n else None,
+        'std': make_stats(values).std}
+
+    for q in (0, 0.1, 0.5, 0.9, 1):
+        expected = np.quantile(values, q) if n else None
+        assert quantile(sorted(values), q) == pytest.approx(expected)
+
+
+def test_merge():
+    rng = random.Random(0)
+    parts = [[rng.gauss(10, 3) for _ in range(rng.randrange(0, 20))]
+             for _ in range(10)]
+    values = [v for part in parts for v in part]
+
+    stats = RunningStats()
+    for part in parts:
+        stats.merge(make_stats(part))
+
+    assert stats.count == len(values)
+    assert stats.mean == pytest.approx(np.mean(values))
+    assert stats.std == pytest.approx(np.std(values, ddof=1))
+    assert stats.quantile(0.5) == pytest.approx(np.median(values), rel=0.05)
+
+
+def test_sketch_is_bounded():
+    rng = random.Random(1)
+    values = [rng.random() for _ in range(5000)]
+    stats = make_stats(values)
+
+    assert len(stats._values) <= SKETCH_COMPRESSION + 1
+    assert stats.mean == pytest.approx(0.5, abs=0.02)
+    for q in (0.1, 0.5, 0.9):
+        assert stats.quantile(q) == pytest.approx(np.quantile(values, q),
+                                                  abs=0.03)
+
+
+def skewed(rng):
+    return rng.lognormvariate(0, 1.5)
+
+
+def bimodal(rng):
+    return rng.gauss(2, 1) if rng.random() < 0.5 else rng.gauss(100, 1)
+
+
+def exponential(rng):
+    return rng.expovariate(1)
+
+
+@pytest.mark.parametrize('distribution', [skewed, bimodal, exponential])
+@pytest.mark.parametrize('merged', [False, True])
+def test_sketch_accuracy(distribution, merged):
+    rng = random.Random(2)
+    values = [distribution(rng) for _ in range(10000)]
+
+    if merged:
+        stats = RunningStats()
+        for i in range(0, len(values), 271):
+            stats.merge(make_stats(values[i:i + 271]))
+    else:
+        stats = make_stats(values)
+
+    values = np.sort(values)
+
+    for q in (0.01, 0.1, 0.5, 0.9, 0.99):
+        estimate = stats.quantile(q)
+        rank = np.searchsorted(values, estimate, 'right') / len(values)
+
+        # The estimate is within 2% of the right position in the values...
+        assert rank == pytest.approx(q, abs=0.02)
+
+        # ...and, away from the tails and the gap between the modes, close to
+        # the right value.
+        if q in (0.1, 0.5, 0.9) and not (distribution is bimodal and q == 0.5):
+            assert estimate == pytest.approx(np.quantile(values, q), rel=0.1)
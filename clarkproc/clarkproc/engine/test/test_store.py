@@ -0,0 +1,254 @@
+import random
+
+import numpy as np
+import pytest
+
+from clarkproc.blueprint_ml import fhir_to_dataframe, reference_time
+from clarkproc.engine import ingest
+from clarkproc.fhir.models import CodeValue
+from clarkproc.fhir.store import (STATS_FEATURES, WINDOW_FEATURES,
+                                  ObservationStore, to_timestamp)
+
+from conftest import (make_medication, make_observation, make_patient,
+                      write_bundle)
+
+""" You can run these tests by doing (from python base directory):
+
+    python -m pytest clarkproc/engine/test/test_store.py
+"""
+
+
+@pytest.fixture
+def loaded(tmp_path):
+    """Load a corpus with plenty of ties in dates and values."""
+    rng = random.Random(0)
+    resources = [make_patient(f'p{p}') for p in range(30)]
+
+    for o in range(600):
+        obs = make_observation(
+            f'o{o}', f'p{rng.randrange(25)}', rng.choice(['1', '2', '3']),
+            rng.choice([1, 2, 2.5, 3.0, 4]),
+            '2015-01-0{}T0{}:00:00{}'.format(rng.randint(1, 3),
+                                             rng.randint(0, 2),
+                                             rng.choice(['Z', '+01:00'])),
+            category=rng.choice(['laboratory', 'vital-signs']))
+        # Vary the display so that containers key codes by differing objects.
+        obs['code']['coding'][0]['display'] = rng.choice(['A', 'B'])
+        resources.append(obs)
+
+    path = write_bundle(tmp_path / 'bundle.json', resources)
+
+    return ingest.ingest_fhir([path])
+
+
+def test_summaries_match_containers(loaded):
+    _, patients, labs, vitals, _ = loaded
+
+    assert len(labs.store) + len(vitals.store) == 600
+
+    for p in patients.values():
+        assert p.to_dict(labs.store, vitals.store) == p.to_dict()
+
+
+def test_details_match_containers(loaded):
+    _, patients, labs, vitals, _ = loaded
+
+    for p in patients.values():
+        for container, store in ((p.labs, labs.store), (p.vitals, vitals.store)):
+            for code in ('1', '2', '3', '4'):
+                code = CodeValue(code, 'http://loinc.org')
+                aggregator = container[code]
+                expected = aggregator.data if aggregator is not None else None
+
+                assert store.details(p.index, code) == expected
+
+
+def test_features_match_containers(loaded):
+    _, patients, labs, vitals, _ = loaded
+    features = ['min', 'max', 'newest', 'oldest', 'mean', 'std', 'median',
+                'p90']
+    lab_codes, vital_codes = ('1', '2', '4'), ('3',)
+    plan = {
+        'structured_data': {
+            'labs': {f'(http://loinc.org, {c})': {'features': features}
+                     for c in lab_codes},
+            'vitals': {f'(http://loinc.org, {c})': {'features': features}
+                       for c in vital_codes},
+            'meds': {},
+        },
+        'unstructured_data': {'features': []},
+    }
+
+    df = fhir_to_dataframe(patients, plan, labs.store, vitals.store)
+
+    assert df.equals(fhir_to_dataframe(patients, plan))
+
+    for p in patients.values():
+        for container, codes in ((p.labs, lab_codes), (p.vitals, vital_codes)):
+            for c in codes:
+                aggregator = container[CodeValue(c, 'http://loinc.org')]
+
+                for name in features:
+                    value = df[f'(http://loinc.org, {c}) {name}'][p.id]
+
+                    expected = (aggregator.to_dict()[name]
+                                if aggregator is not None else None)
+
+                    if expected is None:
+                        assert value is None or np.isnan(value)
+                    else:
+                        assert value == expected
+
+    assert (df['(http://loinc.org, 4) max'].values == None).all()
+
+
+def test_extend_matches_rebuild(tmp_path):
+    rng = random.Random(1)
+    paths = []
+
+    for f, (patients, codes) in enumerate(((range(20), '123'),
+                                           (range(15, 30), '2345'))):
+        resources = [make_patient(f'p{p}') for p in patients if p < 20 or f]
+
+        for o in range(300):
+            obs = make_observation(
+                f'o{f}-{o}', f'p{rng.choice(patients)}', rng.choice(codes),
+                rng.choice([1, 2, 2.5, 3.0, 4]),
+                f'2015-01-0{rng.randint(1, 3)}T00:00:00Z',
+                category=rng.choice(['laboratory', 'vital-signs']))
+            obs['code']['coding'][0]['display'] = rng.choice(['A', 'B'])
+            resources.append(obs)
+
+        paths.append(write_bundle(tmp_path / f'bundle{f}.json', resources))
+
+    _, *loaded = ingest.ingest_fhir(paths[:1])
+    old_store = loaded[1].store
+    old_seq = old_store.seq.copy()
+    _, patients, labs, vitals, medications = ingest.ingest_fhir(
+        paths[1:], append_to=loaded)
+
+    assert old_store is not labs.store
+    assert (old_store.seq == old_seq).all()
+
+    # Statistics by code are kept by the lookup tables as values are added.
+    _, _, *full = ingest.ingest_fhir(paths)
+    assert [lut.to_dict() for lut in full] == [
+        lut.to_dict() for lut in (labs, vitals, medications)]
+
+    for store, attr in ((labs.store, 'labs'), (vitals.store, 'vitals')):
+        rebuilt = ObservationStore(patients, attr)
+
+        # Only seq differs, in numbering rather than in order.
+        for name in ('patient', 'code', 'time', 'value', 'objects',
+                     'group_key', 'group_start', 'group_min', 'group_max',
+                     'group_newest', 'group_oldest', 'group_mean',
+                     'group_std', 'group_median', 'group_p90'):
+            assert np.array_equal(getattr(store, name), getattr(rebuilt, name),
+                                  equal_nan=name.startswith('group_'))
+
+        for p in patients.values():
+            assert (store.patient_summary(p.index)
+                    == rebuilt.patient_summary(p.index))
+
+            for code in rebuilt.codes:
+                aggregator = getattr(p, attr)[code]
+                expected = aggregator.data if aggregator is not None else None
+
+                assert store.details(p.index, code) == expected
+
+        for label in rebuilt.label_index:
+            for name in ('count', 'newest') + STATS_FEATURES:
+                assert np.array_equal(store.feature(label, name),
+                                      rebuilt.feature(label, name))
+
+
+def expected_window_feature(aggregator, name, start, end):
+    """Compute a windowed feature by scanning the aggregator's observations."""
+    window = [o for o in (aggregator.data if aggregator is not None else [])
+              if start <= to_timestamp(o.effectiveDateTime) <= end]
+
+    if name == 'count':
+        return len(window)
+    if name == 'boolean':
+        return bool(window)
+    if not window:
+        return None
+
+    values = [o.value for o in window]
+    if name == 'min':
+        return min(values)
+    if name == 'max':
+        return max(values)
+    if name == 'mean':
+        return pytest.approx(sum(values) / len(values))
+
+    times = [to_timestamp(o.effectiveDateTime) for o in window]
+    when = max(times) if name == 'newest' else min(times)
+    return values[times.index(when)]
+
+
+@pytest.mark.parametrize('reference, days', [
+    ('2015-01-02T01:00:00Z', 1),
+    ('2015-01-02', 1),
+    ('2015-01-03T00:30:00+01:00', 2),
+    ('2014-12-31', 30),
+])
+def test_window_features(loaded, reference, days):
+    _, patients, labs, *_ = loaded
+    end = reference_time(reference)
+    start = end - days * 24 * 60 * 60 * 10**6 + 1
+
+    for c in ('1', '2', '3', '4'):
+        code = CodeValue(c, 'http://loinc.org')
+
+        for name in WINDOW_FEATURES:
+            column = labs.store.window_feature(f'(http://loinc.org, {c})',
+                                               name, start, end)
+
+            for p in patients.values():
+                assert column[p.index] == expected_window_feature(
+                    p.labs[code], name, start, end)
+
+
+def test_window_plan(tmp_path):
+    resources = [make_patient('p0'), make_patient('p1')]
+    for i, date in enumerate(['2014-01-01', '2015-10-01', '2015-12-31',
+                              '2016-01-01']):
+        med = make_medication(f'm{i}', 'p0')
+        med['authoredOn'] = date
+        resources.append(med)
+        resources.append(make_observation(f'o{i}', 'p0', '1', i,
+                                           date + 'T12:00:00Z'))
+
+    path = write_bundle(tmp_path / 'bundle.json', resources)
+    _, patients, labs, *_ = ingest.ingest_fhir([path])
+
+    rxnorm = '(http://www.nlm.nih.gov/research/umls/rxnorm, 1049630)'
+    plan = {
+        'structured_data': {
+            'reference_date': '2015-12-31',
+            'labs': {'(http://loinc.org, 1)': {
+                'features': ['max'],
+                'windows': [{'days': 365, 'features': ['mean', 'count']}]}},
+            'meds': {rxnorm: {
+                'features': ['count'],
+                'windows': [{'days': 1, 'features': ['count', 'boolean']},
+                            {'days': 365, 'features': ['count']}]}},
+        },
+        'unstructured_data': {'features': []},
+    }
+
+    df = fhir_to_dataframe(patients, plan, labs.store)
+
+    assert df.equals(fhir_to_dataframe(patients, plan))
+    assert df['(http://loinc.org, 1) max']['p0'] == 3
+    assert df['(http://loinc.org, 1) mean 365d']['p0'] == 1.5
+    assert df['(http://loinc.org, 1) count 365d'].tolist() == [2, 0]
+    assert df[f'{rxnorm} count'].tolist() == [4, 0]
+    assert df[f'{rxnorm} count 1d'].tolist() == [1, 0]
+    assert df[f'{rxnorm} boolean 1d'].tolist() == [True, False]
+    assert df[f'{rxnorm} count 365d'].tolist() == [2, 0]
+
+    plan['structured_data']['meds'][rxnorm]['windows'][0]['days'] = 0
+    with pytest.raises(ValueError):
+        fhir_to_dataframe(patients, plan)
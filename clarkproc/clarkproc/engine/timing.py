@@ -0,0 +1,156 @@
+"""
+Timing of the phases of an ingest.
+
+Loading a corpus goes through several phases: reading (and decompressing) the
+files, decoding their JSON, building ``fhir.resources`` objects, converting
+those into our models and finally linking resources to their patients.  The
+time spent in each is recorded so that slow loads can be diagnosed.
+"""
+import time
+
+CACHE = 'cache'
+IO = 'io'
+JSON = 'json'
+FHIR = 'fhir'
+MODELS = 'models'
+LINKING = 'linking'
+
+# Phases in the order they happen.
+PHASES = (CACHE, IO, JSON, FHIR, MODELS, LINKING)
+
+# Number of files reported in the slowest files list.
+SLOWEST_FILES = 10
+
+
+class PhaseTimes:
+    """
+    Seconds, item counts and bytes accumulated per phase.
+
+    Files parsed in worker processes each return one of these, so it only
+    holds plain (picklable) data.
+    """
+
+    def __init__(self):
+        self.seconds = dict.fromkeys(PHASES, 0.0)
+        self.counts = dict.fromkeys(PHASES, 0)
+        self.bytes = dict.fromkeys(PHASES, 0)
+
+    def add(self, phase, seconds, count=0, nbytes=0):
+        self.seconds[phase] += seconds
+        self.counts[phase] += count
+        self.bytes[phase] += nbytes
+
+    def merge(self, other):
+        """
+        :param PhaseTimes other: Times to add to these.
+        """
+        for phase in PHASES:
+            self.add(phase, other.seconds[phase], other.counts[phase],
+                     other.bytes[phase])
+
+    def to_dict(self):
+        return {
+            phase: {
+                'seconds': round(self.seconds[phase], 6),
+                'count': self.counts[phase],
+                'bytes': self.bytes[phase],
+            }
+            for phase in PHASES
+        }
+
+
+class TimedReader:
+    """
+    Wraps a file object and records the time spent reading from it in the
+    :data:`IO` phase, and the amount read in :attr:`chars_read`.
+    """
+
+    def __init__(self, fp, times):
+        """
+        :param fp: File object to read from.
+        :param PhaseTimes times: Times to record to.
+        """
+        self._fp = fp
+        self._times = times
+        self.chars_read = 0
+
+    def read(self, size=-1):
+        start = time.perf_counter()
+        data = self._fp.read(size)
+        self._times.add(IO, time.perf_counter() - start)
+        self.chars_read += len(data)
+        return data
+
+    def readline(self, size=-1):
+        start = time.perf_counter()
+        line = self._fp.readline(size)
+        self._times.add(IO, time.perf_counter() - start)
+        self.chars_read += len(line)
+        return line
+
+    def __iter__(self):
+        return iter(self.readline, '')
+
+
+class IngestTiming:
+    """
+    Timing report of an ingest.
+
+    Per phase times are summed over all files.  When files are parsed in
+    parallel they therefore add up the time spent by every worker and may
+    exceed the wall time of the ingest as a whole.
+    """
+
+    def __init__(self, slowest_files=SLOWEST_FILES):
+        """
+        :param int slowest_files: Number of files to list in the report.
+        """
+        self.slowest_files = slowest_files
+        self.phases = PhaseTimes()
+        self.files = []
+        self.parse_seconds = 0.0
+        self.total_seconds = 0.0
+
+    def add_file(self, path, times, seconds, nbytes, resources, cached=False):
+        """
+        Record the parsing of one file.
+
+        :param str path: Path of the file.
+        :param PhaseTimes times: Times of the file's phases.
+        :param float seconds: Wall time spent parsing (or loading from cache)
+            the file.
+        :param int nbytes: Size of the file.
+        :param int resources: Number of resources parsed from the file.
+        :param bool cached: Whether the results came from the ingest cache.
+        """
+        self.phases.merge(times)
+        self.files.append({
+            'path': path,
+            'seconds': round(seconds, 6),
+            'bytes': nbytes,
+            'resources': resources,
+            'cached': cached,
+        })
+
+    def to_dict(self):
+        num_bytes = sum(f['bytes'] for f in self.files)
+        num_resources = sum(f['resources'] for f in self.files)
+
+        def per_second(n):
+            if self.total_seconds <= 0:
+                return None
+            return round(n / self.total_seconds, 1)
+
+        return {
+            'total_seconds': round(self.total_seconds, 6),
+            'parse_seconds': round(self.parse_seconds, 6),
+            'num_files': len(self.files),
+            'bytes': num_bytes,
+            'resources': num_resources,
+            'bytes_per_second': per_second(num_bytes),
+            'resources_per_second': per_second(num_resources),
+            'phases': self.phases.to_dict(),
+            'slowest_files': sorted(
+                self.files, key=lambda f: f['seconds'],
+                reverse=True)[:self.slowest_files],
+        }
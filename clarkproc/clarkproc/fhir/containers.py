@@ -1,8 +1,17 @@
 from abc import ABC
-from collections import defaultdict
+from array import array
+from bisect import bisect_left, bisect_right, insort
+from collections import Counter, defaultdict
+import copy
 from datetime import datetime, timezone
 from operator import itemgetter
 
+import numpy as np
+
+from clarkproc.fhir.errors import WARN, Message
+from clarkproc.fhir.stats import RunningMoments, RunningStats, quantile
+from clarkproc.fhir.store import to_timestamp
+
 
 class ResourceAggregator(ABC):
     """
@@ -10,12 +19,26 @@ class ResourceAggregator(ABC):
     of aggregate statistics for those resources.
     """
 
+    # There is an aggregator per patient and code, so slots are used to keep
+    # their memory footprint down.
+    __slots__ = ('data',)
+
     def __init__(self):
         self.data = []
 
     def add(self, val):
         self.data.append(val)
 
+    def copy(self):
+        """
+        :return: Aggregator that resources can be added to without changing
+            this one.
+        """
+        other = copy.copy(self)
+        other.data = list(self.data)
+
+        return other
+
     @property
     def count(self):
         return len(self.data)
@@ -36,18 +59,56 @@ class MedicationAggregator(ResourceAggregator):
     Data structure for holding a collection of like medications and keeping
     track of aggregate statistics for those medications.
     """
-    pass
+
+    __slots__ = ('times',)
+
+    def __init__(self):
+        super().__init__()
+
+        # authoredOn of the medications (see fhir.store.to_timestamp), kept
+        # sorted so that windowed counts are binary searches.
+        self.times = []
+
+    def add(self, med):
+        super().add(med)
+
+        if med.authoredOn is not None:
+            insort(self.times, to_timestamp(med.authoredOn))
+
+    def copy(self):
+        other = super().copy()
+        other.times = list(self.times)
+
+        return other
+
+    def count_between(self, start, end):
+        """
+        :param int start: Start of the window, see
+            :func:`clarkproc.fhir.store.to_timestamp`.
+        :param int end: End of the window (inclusive).
+        :return: Number of medications authored within the window.
+            Medications without an authoredOn date are never counted.
+        :rtype: int
+        """
+        return bisect_right(self.times, end) - bisect_left(self.times, start)
 
 
 class ObservationAggregator(ResourceAggregator):
     """
     Data structure for holding a collection of like observations and keeping
-    track of min, max, newest, and oldest values in the collection.
+    track of min, max, newest, and oldest values in the collection, as well as
+    their running mean and variance (see
+    :class:`clarkproc.fhir.stats.RunningMoments`).  Quantiles are computed
+    from the observations when needed.
     """
 
+    __slots__ = ('minVal', 'maxVal', 'newest', 'oldest', 'stats')
+
     def __init__(self):
         super().__init__()
 
+        self.stats = RunningMoments()
+
         self.minVal = float('inf')
         self.maxVal = -float('inf')
         self.newest = (datetime.min.replace(tzinfo=timezone.utc), None)
@@ -61,6 +122,7 @@ class ObservationAggregator(ResourceAggregator):
 
         self.minVal = min(self.minVal, val)
         self.maxVal = max(self.maxVal, val)
+        self.stats.add(val)
 
         if date > self.newest[0]:
             self.newest = (date, val)
@@ -68,6 +130,12 @@ class ObservationAggregator(ResourceAggregator):
         if date < self.oldest[0]:
             self.oldest = (date, val)
 
+    def copy(self):
+        other = super().copy()
+        other.stats = self.stats.copy()
+
+        return other
+
     def to_dict(self):
         d = super().to_dict()
         d.update({
@@ -76,6 +144,13 @@ class ObservationAggregator(ResourceAggregator):
             'newest': self.newest[1],
             'oldest': self.oldest[1],
         })
+        d.update(self.stats.to_dict())
+
+        values = sorted(obs.value for obs in self.data)
+        d.update({
+            'median': quantile(values, 0.5),
+            'p90': quantile(values, 0.9),
+        })
 
         return d
 
@@ -83,6 +158,8 @@ class ObservationAggregator(ResourceAggregator):
 class ResourceContainer(ABC):
     aggregator_cls = None
 
+    __slots__ = ('data', 'total_count')
+
     def __init__(self):
         self.data = defaultdict(self.aggregator_cls)
         self.total_count = 0
@@ -99,6 +176,17 @@ class ResourceContainer(ABC):
         self.data[resource.code].add(resource)
         self.total_count += 1
 
+    def copy(self):
+        """
+        :return: Container that resources can be added to without changing
+            this one.
+        """
+        other = self.__class__()
+        other.data.update((k, v.copy()) for k, v in self.data.items())
+        other.total_count = self.total_count
+
+        return other
+
     @property
     def unique_count(self):
         return len(self.data.keys())
@@ -128,16 +216,42 @@ class ResourceContainer(ABC):
 class MedicationContainer(ResourceContainer):
     aggregator_cls = MedicationAggregator
 
+    __slots__ = ()
+
 
 class ObservationContainer(ResourceContainer):
     aggregator_cls = ObservationAggregator
 
+    __slots__ = ()
+
 
 class CodedResourceItem:
-    def __init__(self, display, id_val, units=None):
+    """
+    Summary of the resources with one code.
+
+    The patients with the code are kept by patient index (see
+    :attr:`clarkproc.fhir.models.Patient.index`) to support cohort queries,
+    whatever the number of resources.  Most codes are rare, so they start out
+    as a sorted array of indices, and switch to a bitmap of one bit per
+    patient once that is smaller.
+
+    The values of observations are summarized in :attr:`stats`, over all
+    patients, with a quantile sketch of bounded size.
+    """
+
+    __slots__ = ('_display', '_displays_set', '_units', '_units_set',
+                 '_count', '_unique_count', '_patients', 'stats')
+
+    def __init__(self, display, patient_idx, units=None):
         self.display = display
-        self._ids = [id_val]
+        self._count = 0
+        self._unique_count = 0
+        # Sorted array of patient indices, or a bytearray bitmap.
+        self._patients = array('i')
         self.units = units
+        # Statistics of the resources' values, once one has a value.
+        self.stats = None
+        self.add_id(patient_idx)
 
     @property
     def display(self):
@@ -157,8 +271,79 @@ class CodedResourceItem:
         self._units = u
         self._units_set = {u} if u is not None else set()
 
-    def add_id(self, id_val):
-        self._ids.append(id_val)
+    def add_id(self, patient_idx):
+        """
+        :param int patient_idx: Index of the patient a resource with the code
+            belongs to.
+        """
+        self._count += 1
+        patients = self._patients
+
+        if isinstance(patients, array):
+            i = bisect_left(patients, patient_idx)
+
+            if i < len(patients) and patients[i] == patient_idx:
+                return
+
+            patients.insert(i, patient_idx)
+            self._unique_count += 1
+
+            if len(patients) * patients.itemsize > (patients[-1] >> 3) + 1:
+                self._patients = self._to_bitmap(patients)
+
+            return
+
+        byte, mask = patient_idx >> 3, 1 << (patient_idx & 7)
+
+        if byte >= len(patients):
+            patients.extend(bytes(byte + 1 - len(patients)))
+
+        if not patients[byte] & mask:
+            patients[byte] |= mask
+            self._unique_count += 1
+
+    @staticmethod
+    def _to_bitmap(indices):
+        """
+        :param array indices: Sorted patient indices.
+        :rtype: bytearray
+        """
+        bitmap = bytearray((indices[-1] >> 3) + 1 if indices else 0)
+
+        for i in indices:
+            bitmap[i >> 3] |= 1 << (i & 7)
+
+        return bitmap
+
+    @property
+    def patients(self):
+        """
+        Bitmap of the patients with the code: bit ``i`` is set if the patient
+        with index ``i`` has it.
+
+        :rtype: int
+        """
+        patients = self._patients
+
+        if isinstance(patients, array):
+            patients = self._to_bitmap(patients)
+
+        return int.from_bytes(patients, 'little')
+
+    def copy(self):
+        """
+        :return: Summary that resources can be added to without changing this
+            one.
+        :rtype: CodedResourceItem
+        """
+        other = copy.copy(self)
+        other._displays_set = set(self._displays_set)
+        other._units_set = set(self._units_set)
+        other._patients = self._patients[:]
+        if self.stats is not None:
+            other.stats = self.stats.copy()
+
+        return other
 
     def check_display(self, display_val):
         """
@@ -193,29 +378,76 @@ class CodedResourceItem:
             return False
 
     def num_ids(self):
-        return len(self._ids)
+        return self._count
 
     def num_unique_ids(self):
-        return len(set(self._ids))
+        return self._unique_count
 
 
 class CodedResourceLUT:
+    __slots__ = ('check_units', 'data', 'total_count', 'store', '_shared')
+
     def __init__(self, check_units):
         self.check_units = check_units
         self.data = {}
         self.total_count = 0
+        # Columnar copy of the observations, if built
+        # (see clarkproc.fhir.store.ObservationStore).
+        self.store = None
+        # Codes whose entries are shared with the table this one was copied
+        # from, and have to be copied before they change.
+        self._shared = set()
 
     def __len__(self):
         return len(self.data.keys())
 
-    def add(self, code, id_val, units=None):
+    def copy(self):
+        """
+        :return: Table that resources can be added to without changing this
+            one.  Entries are only copied once they change.
+        :rtype: CodedResourceLUT
+        """
+        other = CodedResourceLUT(self.check_units)
+        other.data = dict(self.data)
+        other.total_count = self.total_count
+        other.store = self.store
+        other._shared = set(self.data)
+
+        return other
+
+    def patients(self, code):
+        """
+        :param CodeValue code: Code of interest.
+        :return: Bitmap of the patients with the code, see
+            :attr:`CodedResourceItem.patients`.
+        :rtype: int
+        """
+        entry = self.data.get(code)
+
+        return entry.patients if entry is not None else 0
+
+    def add(self, code, patient_idx, units=None, value=None):
+        """
+        :param CodeValue code: Code of the resource.
+        :param int patient_idx: Index of the patient the resource belongs to.
+        :param str units: Units of the resource's value.
+        :param value: Value of the resource, added to the code's statistics.
+        :type value: int or float
+        :return: Messages about inconsistencies with the code's previous
+            resources.
+        :rtype: list(Message)
+        """
         msg = []
         entry = self.data.get(code)
 
         if entry is None:
-            self.data[code] = CodedResourceItem(
-                code.display, id_val, units if self.check_units else None)
+            entry = self.data[code] = CodedResourceItem(
+                code.display, patient_idx, units if self.check_units else None)
         else:
+            if code in self._shared:
+                entry = self.data[code] = entry.copy()
+                self._shared.discard(code)
+
             if code.display is not None:
                 existing_display = entry.display
 
@@ -223,12 +455,14 @@ class CodedResourceLUT:
                     # Update stored display to reflect an actual value.
                     entry.display = code.display
                 elif not entry.check_display(code.display):
-                    msg.append(
-                        'WARN: Mismatch in system/code pair display.  ({}, {}) '
+                    msg.append(Message(
+                        WARN, 'display_mismatch',
+                        'Mismatch in system/code pair display.  ({}, {}) '
                         'defined with display "{}", but additional record '
                         'encountered with display "{}".'.format(
                             code.system, code.code, existing_display,
-                            code.display))
+                            code.display),
+                        code))
 
             if self.check_units and units is not None:
                 existing_units = entry.units
@@ -237,13 +471,20 @@ class CodedResourceLUT:
                     # Update stored units to reflect an actual value.
                     entry.units = units
                 elif not entry.check_units(units):
-                    msg.append(
-                        'WARN: Mismatch in system/code pair units.  ({}, {}) '
+                    msg.append(Message(
+                        WARN, 'units_mismatch',
+                        'Mismatch in system/code pair units.  ({}, {}) '
                         'defined with units "{}", but additional record '
                         'encountered with units "{}".'.format(
-                            code.system, code.code, existing_units, code.units))
+                            code.system, code.code, existing_units, units),
+                        code))
 
-            entry.add_id(id_val)
+            entry.add_id(patient_idx)
+
+        if value is not None:
+            if entry.stats is None:
+                entry.stats = RunningStats()
+            entry.stats.add(value)
 
         self.total_count += 1
 
@@ -264,9 +505,232 @@ class CodedResourceLUT:
                 'unique_count': v.num_unique_ids(),
             }
 
+            if v.stats is not None:
+                entry_d.update(v.stats.to_dict())
+
             entries.append(entry_d)
 
         entries.sort(key=itemgetter('unique_count', 'total_count'),
                      reverse=True)
 
         return d
+
+
+class PatientCollection(dict):
+    """
+    Patients by id.
+
+    Patients are numbered in the order they are added, which is the order they
+    are iterated in, so that columnar data can refer to them by position (see
+    :attr:`clarkproc.fhir.models.Patient.index`).  Patients can't be removed.
+
+    Histograms of the patients' demographics are kept up to date as patients
+    are added, and the summary built from them is cached until the collection
+    changes.
+    """
+
+    # Demographic properties summarized, with their display names.
+    DEMOGRAPHICS = (
+        ('gender', 'Gender'),
+        ('marital_status', 'Marital Status'),
+        ('race', 'Race'),
+        ('ethnicity', 'Ethnicity'),
+    )
+
+    # Fields of Patient.to_dict_summary, which patient lists can be sorted and
+    # filtered on.
+    SUMMARY_FIELDS = ('id', 'gender', 'birthDate', 'maritalStatus', 'race',
+                      'ethnicity', 'num_labs', 'num_vitals', 'num_medications',
+                      'num_notes')
+
+    def __init__(self):
+        super().__init__()
+        self.ids = []
+        self.histograms = {name: Counter() for name, _ in self.DEMOGRAPHICS}
+        self.changed()
+
+    def changed(self):
+        """
+        Drop the cached summary, columns and sort indexes.  Called whenever
+        patients are added, and must be called once resources have been
+        linked to patients.
+        """
+        self._summary = None
+        self._columns = None
+        self._sort_indexes = {}
+
+    @staticmethod
+    def _demographics(patient):
+        """
+        :return: Demographic property names and values of the patient that
+            are counted in the histograms.
+        :rtype: list(tuple)
+        """
+        values = []
+
+        if patient.gender is not None:
+            values.append(('gender', patient.gender))
+
+        for name, attr in (('marital_status', 'maritalStatus'),
+                           ('race', 'race'),
+                           ('ethnicity', 'ethnicity')):
+            code = getattr(patient, attr)
+
+            if code is not None:
+                values.append((name, code.display))
+
+        return values
+
+    def __setitem__(self, patient_id, patient):
+        existing = self.get(patient_id)
+
+        if existing is None:
+            patient.index = len(self.ids)
+            self.ids.append(patient_id)
+        else:
+            patient.index = existing.index
+
+            for name, value in self._demographics(existing):
+                self.histograms[name][value] -= 1
+
+                if not self.histograms[name][value]:
+                    del self.histograms[name][value]
+
+        for name, value in self._demographics(patient):
+            self.histograms[name][value] += 1
+
+        self.changed()
+
+        super().__setitem__(patient_id, patient)
+
+    def update(self, other):
+        for patient_id, patient in other.items():
+            self[patient_id] = patient
+
+    def copy(self):
+        """
+        :return: Collection of the same patients that patients can be added to
+            (or replaced in) without changing this one.
+        :rtype: PatientCollection
+        """
+        other = PatientCollection()
+        dict.update(other, self)
+        other.ids = list(self.ids)
+        other.histograms = {name: Counter(histogram)
+                            for name, histogram in self.histograms.items()}
+
+        return other
+
+    def summary(self):
+        """
+        :return: Number of patients and histogram of each demographic
+            property.
+        :rtype: dict
+        """
+        if self._summary is None:
+            count = len(self)
+            properties = {}
+
+            for name, display in self.DEMOGRAPHICS:
+                histogram = dict(self.histograms[name])
+                properties[name] = {
+                    'display': display,
+                    'type': 'categorical',
+                    'percentDefined': (sum(histogram.values()) / count * 100.0
+                                       if count else 0.0),
+                    'num_categories': len(histogram),
+                    'histogram': histogram,
+                }
+
+            self._summary = {'count': count, 'properties': properties}
+
+        return self._summary
+
+    def summary_column(self, field):
+        """
+        :param str field: One of :attr:`SUMMARY_FIELDS`.
+        :return: Value of the field of every patient's summary, by patient
+            index.
+        :rtype: numpy.ndarray
+        """
+        if self._columns is None:
+            summaries = [p.to_dict_summary() for p in self.values()]
+            self._columns = {}
+
+            for name in self.SUMMARY_FIELDS:
+                column = np.empty(len(summaries), dtype=object)
+                column[:] = [d[name] for d in summaries]
+                self._columns[name] = column
+
+        return self._columns[field]
+
+    def sort_index(self, field, descending=False):
+        """
+        :param str field: One of :attr:`SUMMARY_FIELDS`.
+        :param bool descending: Whether to sort in descending order.
+        :return: Patient indices sorted by the field, missing values last.
+            Ties keep the order patients were added in.
+        :rtype: numpy.ndarray
+        """
+        index = self._sort_indexes.get((field, descending))
+
+        if index is None:
+            column = self.summary_column(field)
+            index = np.array(
+                sorted(range(len(column)),
+                       key=lambda i: self.sort_key(column[i], descending),
+                       reverse=descending),
+                dtype=np.int64)
+            self._sort_indexes[field, descending] = index
+
+        return index
+
+    @staticmethod
+    def sort_key(value, descending=False):
+        """
+        :param value: Value of a summary field.
+        :param bool descending: Whether to sort in descending order.
+        :return: Key :meth:`sort_index` sorts the value by.
+        """
+        missing = value is None
+        return (missing != descending, '' if missing else value)
+
+    def position_after(self, order, field, descending, value, patient_idx):
+        """
+        Find where a page that follows a given patient starts, even if
+        patients were added or changed since that patient was returned.
+
+        :param numpy.ndarray order: Patient indices as returned by
+            :meth:`sort_index` (or by index if ``field`` is ``None``), or a
+            subset of them in the same order.
+        :param str field: Field the patients are sorted by, or ``None``.
+        :param bool descending: Whether they are sorted in descending order.
+        :param value: Value of the field for the patient.
+        :param int patient_idx: Index of the patient.
+        :return: Position in ``order`` of the first patient sorted after the
+            given one.
+        :rtype: int
+        """
+        if field is None:
+            return int(np.searchsorted(order, patient_idx, 'right'))
+
+        column = self.summary_column(field)
+        key = self.sort_key(value, descending)
+        lo, hi = 0, len(order)
+
+        while lo < hi:
+            mid = (lo + hi) // 2
+            i = int(order[mid])
+            k = self.sort_key(column[i], descending)
+
+            if k == key:
+                after = i > patient_idx
+            else:
+                after = (k < key) if descending else (k > key)
+
+            if after:
+                hi = mid
+            else:
+                lo = mid + 1
+
+        return lo
@@ -1,10 +1,40 @@
+from collections import namedtuple
+
+ERROR = 'ERROR'
+WARN = 'WARN'
+
+
 class FHIRError(Exception):
-    pass
+    # Used to group like problems when they are reported.
+    category = 'invalid_resource'
 
 
 class FHIRMissingField(FHIRError):
-    pass
+    category = 'missing_field'
 
 
 class FHIRUnsupportedFormat(FHIRError):
-    pass
+    category = 'unsupported_format'
+
+
+class FHIRInvalidValue(FHIRError):
+    category = 'invalid_value'
+
+
+class Message(namedtuple('Message', ['level', 'category', 'text', 'code'])):
+    """
+    A problem found while ingesting FHIR data.
+
+    :param str level: :data:`ERROR` or :data:`WARN`.
+    :param str category: Kind of problem, used to group like messages.
+    :param str text: Human readable description.
+    :param CodeValue code: Code the problem concerns, if any.  Messages are
+        grouped by code as well as by category.
+    """
+    __slots__ = ()
+
+    def __new__(cls, level, category, text, code=None):
+        return super().__new__(cls, level, category, text, code)
+
+    def __str__(self):
+        return f'{self.level}: {self.text}'
@@ -0,0 +1,206 @@
+"""
+Fast decoding of FHIR JSON without building ``fhir.resources`` objects.
+
+``FHIRElementFactory.instantiate`` validates every element of a resource and
+builds a full object graph for it, while our models only read a handful of
+fields.  :class:`FastElement` instead wraps the raw JSON dictionary and builds
+elements lazily, only for the attributes that are actually accessed.
+
+Attribute access mirrors the ``fhir.resources`` classes: the same property
+names are defined, missing values are ``None``, undefined properties raise
+``AttributeError``, dates are :class:`FHIRDate` instances and nested elements
+are wrapped in turn.  The model constructors therefore behave (and report
+problems) exactly as they do for fully instantiated resources.  What is lost
+is up front validation: malformed resources are not rejected as a whole.
+Instead, the values the models read (attributes, and elements returned by
+``as_json()`` such as codings) are type checked as they are accessed, and a
+:class:`FHIRInvalidValue` is raised for the resource if one is malformed.
+"""
+from fhir.resources.fhirabstractbase import FHIRAbstractBase
+from fhir.resources.fhirdate import FHIRDate
+from fhir.resources.fhirelementfactory import FHIRElementFactory
+
+from clarkproc.fhir.errors import FHIRInvalidValue
+
+_properties_cache = {}
+_resource_class_cache = {}
+
+
+def _properties(element_cls):
+    """
+    :param type element_cls: ``fhir.resources`` element class.
+    :return: Mapping of property name to ``(json_name, type, is_list)``.
+    :rtype: dict
+    """
+    props = _properties_cache.get(element_cls)
+
+    if props is None:
+        props = {
+            name: (js_name, typ, is_list)
+            for name, js_name, typ, _, is_list, _, _
+            in element_cls().elementProperties()
+        }
+        _properties_cache[element_cls] = props
+
+    return props
+
+
+def _resource_class(resource_type):
+    """
+    :param str resource_type: FHIR resource type name.
+    :return: ``fhir.resources`` class used for the resource type.
+    :rtype: type
+    :raises FHIRInvalidValue: If the resource type isn't a string.
+    """
+    if not isinstance(resource_type, str):
+        raise FHIRInvalidValue(
+            f'Wrong type {type(resource_type).__name__} for "resourceType", '
+            f'expecting str.')
+
+    cls = _resource_class_cache.get(resource_type)
+
+    if cls is None:
+        cls = type(FHIRElementFactory.instantiate(resource_type, None))
+        _resource_class_cache[resource_type] = cls
+
+    return cls
+
+
+def _invalid(element_cls, name, value, expected):
+    return FHIRInvalidValue(
+        f'Wrong type {type(value).__name__} for property "{name}" on '
+        f'"{element_cls.__name__}", expecting {expected}.')
+
+
+def _check(value, typ, element_cls, name):
+    """
+    Check the type of a primitive value like ``fhir.resources`` does.
+
+    :raises FHIRInvalidValue: If the value doesn't have the type.
+    """
+    if typ is int or typ is float:
+        valid = isinstance(value, (int, float))
+    else:
+        valid = isinstance(value, typ)
+
+    if not valid:
+        raise _invalid(element_cls, name, value, typ.__name__)
+
+
+def _wrap(value, typ, element_cls, name):
+    """
+    :param value: Raw JSON value of a property.
+    :param type typ: Type of the property.
+    :param type element_cls: Class of the element the property belongs to.
+    :param str name: Name of the property.
+    :return: The value as ``fhir.resources`` would hold it.
+    :raises FHIRInvalidValue: If the value doesn't fit the property.
+    """
+    if issubclass(typ, FHIRDate):
+        if not isinstance(value, str):
+            raise _invalid(element_cls, name, value, 'a date string')
+
+        date = typ(value)
+
+        if date.date is None:
+            raise FHIRInvalidValue(
+                f'Invalid date "{value}" for property "{name}" on '
+                f'"{element_cls.__name__}".')
+
+        return date
+
+    if issubclass(typ, FHIRAbstractBase):
+        if not isinstance(value, dict):
+            raise _invalid(element_cls, name, value, 'an object')
+
+        return FastElement(value, typ)
+
+    _check(value, typ, element_cls, name)
+
+    return value
+
+
+def _validate(jsondict, element_cls):
+    """
+    Type check the known properties of an element's JSON, recursively.
+
+    :raises FHIRInvalidValue: If a property is malformed.
+    """
+    props = _properties(element_cls)
+
+    for js_name, value in jsondict.items():
+        prop = props.get(js_name)
+
+        if prop is None or value is None:
+            continue
+
+        _, typ, is_list = prop
+
+        if is_list != isinstance(value, list):
+            raise _invalid(element_cls, js_name, value,
+                           'a list' if is_list else 'a single value')
+
+        for v in (value if is_list else [value]):
+            if issubclass(typ, FHIRAbstractBase):
+                if not isinstance(v, dict):
+                    raise _invalid(element_cls, js_name, v, 'an object')
+                _validate(v, typ)
+            else:
+                _wrap(v, typ, element_cls, js_name)
+
+
+class FastElement:
+    """Read only, lazily decoded view of a FHIR element's JSON."""
+
+    __slots__ = ('_json', '_cls', '_props')
+
+    def __init__(self, jsondict, element_cls):
+        """
+        :param dict jsondict: Raw JSON for the element.
+        :param type element_cls: ``fhir.resources`` class of the element.
+        """
+        self._json = jsondict
+        self._cls = element_cls
+        self._props = _properties(element_cls)
+
+    def __getattr__(self, name):
+        try:
+            js_name, typ, is_list = self._props[name]
+        except KeyError:
+            if name == 'resource_type':
+                return self._json.get('resourceType')
+            raise AttributeError(
+                f'"{self._cls.__name__}" has no attribute "{name}"') from None
+
+        value = self._json.get(js_name)
+
+        if value is None:
+            return None
+
+        if is_list != isinstance(value, list):
+            raise _invalid(self._cls, name, value,
+                           'a list' if is_list else 'a single value')
+
+        if is_list:
+            return [_wrap(v, typ, self._cls, name) for v in value]
+
+        return _wrap(value, typ, self._cls, name)
+
+    def as_json(self):
+        """
+        :return: The element's JSON, once type checked.
+        :raises FHIRInvalidValue: If a property is malformed.
+        """
+        _validate(self._json, self._cls)
+        return self._json
+
+
+def instantiate(jsondict):
+    """
+    Fast stand-in for ``FHIRElementFactory.instantiate`` on a resource.
+
+    :param dict jsondict: Raw JSON for the resource, including
+        ``resourceType``.
+    :rtype: FastElement
+    """
+    return FastElement(jsondict, _resource_class(jsondict.get('resourceType')))
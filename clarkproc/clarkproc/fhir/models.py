@@ -1,27 +1,70 @@
 from abc import ABC, abstractmethod
 from base64 import b64decode
+import copy
 import datetime
+import json
+import sys
+import weakref
 
 from clarkproc.fhir.containers import ObservationContainer, MedicationContainer
 from clarkproc.fhir.errors import *
 
 
+def _intern(value):
+    """
+    Intern strings that repeat across many resources (statuses, units, patient
+    references) so that each distinct value is only stored once.
+    """
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+def _dump_json(d):
+    """
+    :return: Compact JSON, with sorted keys like ``flask.jsonify``.
+    :rtype: bytes
+    """
+    return json.dumps(d, sort_keys=True, separators=(',', ':')).encode('utf-8')
+
+
 class CodeValue:
     """
     Data structure for holding key components of FHIR Coding resource.
     Reference: http://hl7.org/fhir/STU3/datatypes.html#Coding
+
+    Instances are interned: a corpus only has a few thousand distinct codings,
+    so every resource with the same system, code and display shares a single
+    (immutable) object.  This also holds for instances that are unpickled,
+    e.g. when parse results are returned from worker processes or read from
+    the ingest cache.
     """
 
-    def __init__(self, code=None, system=None, display=None, **kwargs):
+    __slots__ = ('code', 'system', '_display', '_hash', '__weakref__')
+
+    # Weak so that codings are freed once no loaded resources refer to them.
+    _interned = weakref.WeakValueDictionary()
+
+    def __new__(cls, code=None, system=None, display=None, **kwargs):
         if code is None:
             raise FHIRMissingField('Missing Coding code.')
 
         if system is None:
             raise FHIRMissingField('Missing Coding system.')
 
-        self.code = code
-        self.system = system
-        self._display = display
+        key = (system, code, display)
+        self = cls._interned.get(key)
+
+        if self is None:
+            self = super().__new__(cls)
+            self.code = code
+            self.system = system
+            self._display = display
+            self._hash = hash((system, code))
+            cls._interned[key] = self
+
+        return self
+
+    def __reduce__(self):
+        return CodeValue, (self.code, self.system, self._display)
 
     @property
     def display(self):
@@ -38,9 +81,11 @@ class CodeValue:
         return self.system, self.code
 
     def __hash__(self):
-        return hash(self.__key)
+        return self._hash
 
     def __eq__(self, other):
+        if self is other:
+            return True
         if isinstance(other, CodeValue):
             return self.__key == other.__key
         return NotImplemented
@@ -55,6 +100,10 @@ _resource_registry = {}
 class Resource(ABC):
     RESOURCE_TYPE = None
 
+    # Models are created for every resource in a corpus, so they use slots
+    # rather than a __dict__ to keep their memory footprint down.
+    __slots__ = ('id',)
+
     def __init_subclass__(cls, bypass_resource_registration=False, **kwargs):
         super().__init_subclass__(**kwargs)
 
@@ -106,11 +155,22 @@ class Resource(ABC):
 class Patient(Resource):
     RESOURCE_TYPE = 'Patient'
 
+    __slots__ = ('index', 'label', 'labs', 'vitals', 'medications', 'notes',
+                 'gender', 'birthDate', 'maritalStatus', 'race', 'ethnicity',
+                 '_json', '_json_summary')
+
     def __init__(self, fhir_patient, msg_list=None):
         super().__init__(fhir_patient)
 
+        # Position of the patient in its corpus, once it has been added to one
+        # (see clarkproc.fhir.containers.PatientCollection).
+        self.index = None
         self.label = None
 
+        # Serialized to_dict and to_dict_summary, as (fingerprint, JSON) pairs.
+        self._json = None
+        self._json_summary = None
+
         # id isn't required in the FHIR spec, but we are going to require it for
         # our purposes.
         if not isinstance(fhir_patient.id, str):
@@ -130,7 +190,7 @@ class Patient(Resource):
         self.medications = MedicationContainer()
         self.notes = {}
 
-        self.gender = fhir_patient.gender
+        self.gender = _intern(fhir_patient.gender)
 
         try:
             self.birthDate = fhir_patient.birthDate.date
@@ -165,8 +225,28 @@ class Patient(Resource):
                 msg_list.append('{} includes a link, but patient linking is '
                                 'not supported.'.format(self.id_str))
 
-    def to_dict(self):
-        # TODO Consider memoizing this.
+    def copy(self):
+        """
+        :return: Patient that resources can be linked to without changing
+            this one.
+        :rtype: Patient
+        """
+        other = copy.copy(self)
+        other.labs = self.labs.copy()
+        other.vitals = self.vitals.copy()
+        other.medications = self.medications.copy()
+        other.notes = dict(self.notes)
+
+        return other
+
+    def to_dict(self, lab_store=None, vital_store=None):
+        """
+        :param lab_store: Columnar store of the corpus' labs to summarize the
+            patient's labs from, rather than walking its lab container.
+        :type lab_store: clarkproc.fhir.store.ObservationStore
+        :param vital_store: Same as ``lab_store``, for vitals.
+        :type vital_store: clarkproc.fhir.store.ObservationStore
+        """
         d = super().to_dict()
         d.update({
             'gender': self.gender,
@@ -174,8 +254,10 @@ class Patient(Resource):
             'maritalStatus': self.maritalStatus.display if self.maritalStatus is not None else 'unspecified',
             'race': self.race.display if self.race is not None else 'unspecified',
             'ethnicity': self.ethnicity.display if self.ethnicity is not None else 'unspecified',
-            'labs': self.labs.to_dict(),
-            'vitals': self.vitals.to_dict(),
+            'labs': (lab_store.patient_summary(self.index)
+                     if lab_store is not None else self.labs.to_dict()),
+            'vitals': (vital_store.patient_summary(self.index)
+                       if vital_store is not None else self.vitals.to_dict()),
             'medications': self.medications.to_dict(),
             'note_ids': list(self.notes.keys()),
             'label': self.label,
@@ -184,7 +266,6 @@ class Patient(Resource):
         return d
 
     def to_dict_summary(self):
-        # TODO Consider memoizing this.
         d = super().to_dict()
         d.update({
             'gender': self.gender,
@@ -200,6 +281,45 @@ class Patient(Resource):
 
         return d
 
+    def _fingerprint(self):
+        """
+        Values that change whenever the patient's label changes or resources
+        are linked to it (containers and notes only ever grow).
+        """
+        return (self.label, self.labs.total_count, self.vitals.total_count,
+                self.medications.total_count, len(self.notes))
+
+    def to_json(self, lab_store=None, vital_store=None):
+        """
+        :return: :meth:`to_dict` serialized to JSON.  It is cached until the
+            patient's label or resources change, or it is asked for with
+            other stores.
+        :rtype: bytes
+        """
+        fingerprint = self._fingerprint() + tuple(
+            store.generation if store is not None else None
+            for store in (lab_store, vital_store))
+
+        if self._json is None or self._json[0] != fingerprint:
+            self._json = (fingerprint,
+                          _dump_json(self.to_dict(lab_store, vital_store)))
+
+        return self._json[1]
+
+    def to_json_summary(self):
+        """
+        :return: :meth:`to_dict_summary` serialized to JSON.  It is cached
+            until the patient's label or resources change.
+        :rtype: bytes
+        """
+        fingerprint = self._fingerprint()
+
+        if self._json_summary is None or self._json_summary[0] != fingerprint:
+            self._json_summary = (fingerprint,
+                                  _dump_json(self.to_dict_summary()))
+
+        return self._json_summary[1]
+
     def get_age_in_days(self, reference_date=None):
         """Get patient age relative to a reference date (now)."""
         if reference_date is None:
@@ -222,6 +342,8 @@ class Observation(Resource):
     RESOURCE_TYPE = 'Observation'
     OBSERVATION_CATEGORY = None
 
+    __slots__ = ('ref', 'status', 'effectiveDateTime', 'code', 'value', 'unit')
+
     def __init_subclass__(cls, **kwargs):
         # Bypass registration for subclasses since we only need the Observation
         # base class to be registered.
@@ -243,9 +365,9 @@ class Observation(Resource):
             raise FHIRMissingField('{} is required to have a "subject" '
                                    'defined.'.format(self.id_str))
         else:
-            self.ref = fhir_observation.subject.reference
+            self.ref = _intern(fhir_observation.subject.reference)
 
-        self.status = fhir_observation.status
+        self.status = _intern(fhir_observation.status)
 
         if self.status != 'final':
             raise FHIRUnsupportedFormat(
@@ -258,6 +380,11 @@ class Observation(Resource):
             raise FHIRMissingField(
                 f'{self.id_str} is missing "effectiveDateTime".')
 
+        # FHIRDate leaves the date unset if it can't parse it.
+        if self.effectiveDateTime is None:
+            raise FHIRInvalidValue(
+                f'{self.id_str} has an invalid "effectiveDateTime".')
+
         try:
             self.code = CodeValue(**fhir_observation.code.coding[0].as_json())
         except Exception as e:
@@ -290,7 +417,7 @@ class Observation(Resource):
             msg_list.append(f'{self.id_str} does not define a unit.')
 
         self.value = quant.value
-        self.unit = quant.unit
+        self.unit = _intern(quant.unit)
 
     @classmethod
     def factory(cls, fhir_observation, msg_list=None):
@@ -335,6 +462,8 @@ class Observation(Resource):
 class Lab(Observation):
     OBSERVATION_CATEGORY = 'laboratory'
 
+    __slots__ = ()
+
     def __init__(self, fhir_observation, msg_list=None):
         super().__init__(fhir_observation, msg_list)
 
@@ -342,6 +471,8 @@ class Lab(Observation):
 class VitalSigns(Observation):
     OBSERVATION_CATEGORY = 'vital-signs'
 
+    __slots__ = ()
+
     def __init__(self, fhir_observation, msg_list=None):
         super().__init__(fhir_observation, msg_list)
 
@@ -349,6 +480,8 @@ class VitalSigns(Observation):
 class MedicationRequest(Resource):
     RESOURCE_TYPE = 'MedicationRequest'
 
+    __slots__ = ('ref', 'status', 'intent', 'authoredOn', 'code')
+
     def __init__(self, fhir_medreq, msg_list=None):
         super().__init__(fhir_medreq)
 
@@ -358,11 +491,11 @@ class MedicationRequest(Resource):
             raise FHIRMissingField('{} is required to have a "subject" '
                                    'defined.'.format(self.id_str))
         else:
-            self.ref = fhir_medreq.subject.reference
+            self.ref = _intern(fhir_medreq.subject.reference)
 
         # TODO Do we need these?
-        self.status = fhir_medreq.status
-        self.intent = fhir_medreq.intent
+        self.status = _intern(fhir_medreq.status)
+        self.intent = _intern(fhir_medreq.intent)
 
         try:
             self.authoredOn = fhir_medreq.authoredOn.date
@@ -400,6 +533,9 @@ class MedicationRequest(Resource):
 class DocumentReference(Resource):
     RESOURCE_TYPE = 'DocumentReference'
 
+    __slots__ = ('ref', 'status', 'indexed', 'type', '_data', '_store',
+                 '_offset', '_length')
+
     def __init__(self, fhir_docref, msg_list=None):
         super().__init__(fhir_docref)
 
@@ -409,9 +545,9 @@ class DocumentReference(Resource):
             raise FHIRMissingField('{} is required to have a "subject" '
                                    'defined.'.format(self.id_str))
         else:
-            self.ref = fhir_docref.subject.reference
+            self.ref = _intern(fhir_docref.subject.reference)
 
-        self.status = fhir_docref.status
+        self.status = _intern(fhir_docref.status)
 
         try:
             self.indexed = fhir_docref.indexed.date
@@ -440,12 +576,58 @@ class DocumentReference(Resource):
                 'format.'.format(self.id_str, attachment.contentType))
 
         try:
-            self.data = b64decode(attachment.data).decode()
+            self._data = b64decode(attachment.data).decode()
         except Exception as e:
             raise FHIRError(
                 '{} contains attachment data that could not be '
                 'decoded ({}).'.format(self.id_str, e))
 
+        # Location of the text once it has been moved to a note store.
+        self._store = None
+        self._offset = None
+        self._length = None
+
+    @property
+    def data(self):
+        """Note text, read back from the note store if it was moved there."""
+        if self._store is not None:
+            return self._store.get(self._offset, self._length)
+
+        return self._data
+
+    @property
+    def location(self):
+        """
+        ``(store, offset, length)`` of the note text, or ``None`` if it is kept
+        in memory.
+        """
+        if self._store is None:
+            return None
+
+        return self._store, self._offset, self._length
+
+    def spill(self, store):
+        """
+        Move the note text to a note store so that it isn't kept in memory.
+
+        :param store: Store to write the text to.
+        :type store: clarkproc.fhir.notestore.NoteStore
+        """
+        if self._store is not None:
+            return
+
+        self._offset, self._length = store.put(self._data)
+        self._store = store
+        self._data = None
+
+    def __getstate__(self):
+        # Note stores are tied to this process, so pickle the text itself.
+        slots = {name: getattr(self, name)
+                 for cls in type(self).__mro__
+                 for name in getattr(cls, '__slots__', ())}
+        slots.update(_data=self.data, _store=None, _offset=None, _length=None)
+        return None, slots
+
     def to_dict(self):
         # TODO Consider memoizing this.
         d = super().to_dict()
@@ -0,0 +1,96 @@
+"""
+Disk-backed storage for note text.
+
+Notes make up most of a corpus by size, and keeping all of their decoded text
+in memory dominates the footprint of the server.  A :class:`NoteStore` instead
+appends the text to a temporary file and hands back its location, so that
+:class:`~clarkproc.fhir.models.DocumentReference` objects only need to hold an
+offset and a length and can read their text back when it is needed.  The
+backing file has a name so that other processes (see
+:class:`~clarkproc.engine.featurize.NotePool`) can read notes from it too.
+"""
+import os
+import tempfile
+import threading
+import weakref
+
+
+def _remove(file, path):
+    file.close()
+
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+class NoteStore:
+    """
+    Append-only file of UTF-8 encoded note text.
+
+    The backing file is removed when the store is closed or garbage collected,
+    i.e. once no notes refer to it anymore.
+    """
+
+    def __init__(self, directory=None):
+        """
+        :param str directory: Directory to create the backing file in.  It is
+            created if needed.  ``None`` uses the system's temporary
+            directory.
+        """
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+        fd, self._path = tempfile.mkstemp(prefix='notes-', dir=directory)
+        self._file = os.fdopen(fd, 'w+b')
+        self._remove = weakref.finalize(self, _remove, self._file, self._path)
+        self._size = 0
+        # Serializes seeking and reading/writing on the shared file object.
+        self._lock = threading.Lock()
+
+    @property
+    def size(self):
+        """Number of bytes stored."""
+        return self._size
+
+    @property
+    def path(self):
+        """Path of the backing file."""
+        return self._path
+
+    def flush(self):
+        """Write buffered text to the backing file, for other processes."""
+        with self._lock:
+            self._file.flush()
+
+    def put(self, text):
+        """
+        :param str text: Text to store.
+        :return: Tuple of ``(offset, length)`` to retrieve the text with.
+        :rtype: tuple(int, int)
+        """
+        data = text.encode('utf-8')
+
+        with self._lock:
+            offset = self._size
+            self._file.seek(offset)
+            self._file.write(data)
+            self._size += len(data)
+
+        return offset, len(data)
+
+    def get(self, offset, length):
+        """
+        :param int offset: Offset returned by :meth:`put`.
+        :param int length: Length returned by :meth:`put`.
+        :return: The stored text.
+        :rtype: str
+        """
+        with self._lock:
+            self._file.seek(offset)
+            data = self._file.read(length)
+
+        return data.decode('utf-8')
+
+    def close(self):
+        self._remove()
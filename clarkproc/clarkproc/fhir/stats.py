@@ -0,0 +1,274 @@
+"""
+Running statistics of observation values.
+
+:class:`RunningMoments` is updated one value at a time as observations are
+added, so that the mean and standard deviation of every patient's observations
+are known as soon as ingest finishes, without going over the values again.
+:class:`RunningStats` adds a quantile sketch, of bounded size, for the
+observations of a whole code.  A patient's quantiles are computed exactly
+from the values it already keeps instead (see :func:`quantile`).  Statistics
+of several patients (or files) are combined with :meth:`RunningMoments.merge`.
+"""
+from bisect import bisect_right, insort
+import math
+
+# The quantile sketch keeps up to twice this many centroids.  Quantiles are
+# exact until then.
+SKETCH_CAPACITY = 32
+
+# Compression of the sketch (see RunningStats._compress).  Compressing leaves
+# at most one more centroid than this, fewer than the number that triggers it.
+SKETCH_COMPRESSION = 2 * SKETCH_CAPACITY - 2
+
+
+def _quantile_limit(q):
+    """
+    :param float q: Quantile a centroid starts at.
+    :return: Quantile the centroid may extend to, one unit of the t-digest
+        scale function further.
+    :rtype: float
+    """
+    k = SKETCH_COMPRESSION / (2 * math.pi) * math.asin(2 * q - 1) + 1
+    k = min(k, SKETCH_COMPRESSION / 4)
+
+    return (math.sin(2 * math.pi * k / SKETCH_COMPRESSION) + 1) / 2
+
+
+def quantile(values, q):
+    """
+    :param list values: Values, sorted.
+    :param float q: Quantile to compute, between 0 and 1.
+    :return: The quantile, linearly interpolated between values like
+        :func:`numpy.quantile` does, or ``None`` if there are no values.
+    :rtype: float
+    """
+    if not values:
+        return None
+
+    position = q * (len(values) - 1)
+    lo = int(position)
+    hi = min(lo + 1, len(values) - 1)
+
+    return values[lo] + (position - lo) * (values[hi] - values[lo])
+
+
+class RunningMoments:
+    """Count, mean and variance (Welford's algorithm) of a stream of values."""
+
+    __slots__ = ('count', 'mean', '_m2')
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self._m2 = 0.0
+
+    def add(self, value):
+        """
+        :param value: Value to add.
+        :type value: int or float
+        """
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self._m2 += delta * (value - self.mean)
+
+    def copy(self):
+        """
+        :return: Statistics that values can be added to without changing
+            these.
+        :rtype: RunningMoments
+        """
+        other = type(self).__new__(type(self))
+        other.count = self.count
+        other.mean = self.mean
+        other._m2 = self._m2
+
+        return other
+
+    def merge(self, other):
+        """
+        Add the values summarized by another instance to this one.
+
+        :param RunningMoments other: Statistics to merge.
+        """
+        if other.count == 0:
+            return
+
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self._m2 += other._m2 + delta * delta * self.count * other.count / count
+        self.mean += delta * other.count / count
+        self.count = count
+
+    @property
+    def std(self):
+        """Sample standard deviation, or ``None`` with fewer than 2 values."""
+        if self.count < 2:
+            return None
+        return math.sqrt(self._m2 / (self.count - 1))
+
+    def to_dict(self):
+        return {
+            'mean': self.mean if self.count else None,
+            'std': self.std,
+        }
+
+
+class RunningStats(RunningMoments):
+    """
+    :class:`RunningMoments` and a quantile sketch of a stream of values.
+
+    The sketch is a sorted list of centroids.  Each starts out as a single
+    value; when there are more than twice :data:`SKETCH_CAPACITY`, adjacent
+    centroids are merged into their weighted mean as long as they stay within
+    a size limit that shrinks towards the tails, like in a t-digest.
+    """
+
+    __slots__ = ('_values', '_weights')
+
+    def __init__(self):
+        super().__init__()
+        self._values = []
+        # Weight of every centroid, or None while they all weigh 1.
+        self._weights = None
+
+    def add(self, value):
+        """
+        :param value: Value to add.
+        :type value: int or float
+        """
+        super().add(value)
+
+        if self._weights is None:
+            insort(self._values, value)
+        else:
+            i = bisect_right(self._values, value)
+            self._values.insert(i, value)
+            self._weights.insert(i, 1)
+
+        if len(self._values) > 2 * SKETCH_CAPACITY:
+            self._compress()
+
+    def copy(self):
+        """
+        :return: Statistics that values can be added to without changing
+            these.
+        :rtype: RunningStats
+        """
+        other = super().copy()
+        other._values = list(self._values)
+        other._weights = (list(self._weights) if self._weights is not None
+                          else None)
+
+        return other
+
+    def merge(self, other):
+        """
+        Add the values summarized by another instance to this one.
+
+        :param RunningStats other: Statistics to merge.
+        """
+        if other.count == 0:
+            return
+
+        super().merge(other)
+
+        centroids = sorted(zip(self._values + other._values,
+                               self._centroid_weights() + other._centroid_weights()))
+        self._values = [v for v, _ in centroids]
+        self._weights = [w for _, w in centroids]
+
+        if len(self._values) > 2 * SKETCH_CAPACITY:
+            self._compress()
+
+    def _centroid_weights(self):
+        if self._weights is None:
+            return [1] * len(self._values)
+        return self._weights
+
+    def _compress(self):
+        """
+        Merge adjacent centroids, keeping the weight of each under the limit
+        set by the t-digest scale function ``k(q) = d / (2 pi) asin(2q - 1)``
+        for ``d = SKETCH_COMPRESSION``: a centroid spans at most one unit of
+        ``k``.  Centroids near the tails (where ``k`` is steep) therefore stay
+        small and extreme quantiles stay accurate.  Any two consecutive
+        centroids span more than one unit, so at most
+        ``SKETCH_COMPRESSION + 1`` are left.
+        """
+        values = self._values
+        weights = self._centroid_weights()
+
+        # Merging always from the same end biases the centroids towards it,
+        # so the direction alternates (k is symmetric).
+        reverse = self.count % 2
+        if reverse:
+            values = values[::-1]
+            weights = weights[::-1]
+
+        new_values = [values[0]]
+        new_weights = [weights[0]]
+        # Weight of the centroids before the current one, and the quantile
+        # the current one may extend to.
+        below = 0
+        limit = _quantile_limit(0.0)
+
+        for value, weight in zip(values[1:], weights[1:]):
+            w = new_weights[-1] + weight
+
+            if (below + w) / self.count <= limit:
+                new_values[-1] += (value - new_values[-1]) * weight / w
+                new_weights[-1] = w
+            else:
+                below += new_weights[-1]
+                limit = _quantile_limit(below / self.count)
+                new_values.append(value)
+                new_weights.append(weight)
+
+        if reverse:
+            new_values.reverse()
+            new_weights.reverse()
+
+        self._values = new_values
+        self._weights = new_weights
+
+    def quantile(self, q):
+        """
+        :param float q: Quantile to compute, between 0 and 1.
+        :return: The quantile, linearly interpolated between values like
+            :func:`numpy.quantile` does (exact while the sketch isn't
+            compressed), or ``None`` if there are no values.
+        :rtype: float
+        """
+        if not self._values:
+            return None
+
+        target = q * (self.count - 1)
+        weights = self._centroid_weights()
+        # Position each centroid would have in the sorted values: the middle
+        # of the values it stands for.
+        below = 0
+        prev_center = prev_value = None
+
+        for value, weight in zip(self._values, weights):
+            center = below + (weight - 1) / 2
+
+            if target <= center:
+                if prev_center is None:
+                    return value
+                fraction = (target - prev_center) / (center - prev_center)
+                return prev_value + fraction * (value - prev_value)
+
+            below += weight
+            prev_center, prev_value = center, value
+
+        return prev_value
+
+    def to_dict(self):
+        d = super().to_dict()
+        d.update({
+            'median': self.quantile(0.5),
+            'p90': self.quantile(0.9),
+        })
+
+        return d
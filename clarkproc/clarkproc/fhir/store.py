@@ -0,0 +1,524 @@
+"""
+Columnar storage of the observations of a corpus.
+
+Patients keep their labs and vitals as lists of model objects per code, which
+have to be walked one object at a time to summarize them.  An
+:class:`ObservationStore` instead holds all observations of one kind (labs or
+vitals) in parallel NumPy arrays sorted by code, patient and time, so that the
+statistics of every (code, patient) group are computed with a handful of
+vectorized reductions when the store is built.
+"""
+import datetime
+import itertools
+
+import numpy as np
+
+# Features that can be computed over a time window.
+WINDOW_FEATURES = ('count', 'boolean', 'min', 'max', 'mean', 'newest',
+                   'oldest')
+
+# Features of the values' distribution, kept in the group_* arrays.
+STATS_FEATURES = ('mean', 'std', 'median', 'p90')
+
+# Statistics of each group read from the running moments of the aggregators.
+_GROUP_MOMENTS = (('mean', lambda s: s.mean),
+                  ('std', lambda s: s.std))
+
+# Quantiles of each group, computed from the values.
+_GROUP_QUANTILES = (('median', 0.5), ('p90', 0.9))
+
+# Numbers the stores built, see ObservationStore.generation.
+_generations = itertools.count()
+
+_EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+_MICROSECOND = datetime.timedelta(microseconds=1)
+
+
+def to_timestamp(date):
+    """
+    :param date: Date or date/time.  Naive values are taken to be UTC.
+    :type date: datetime.date or datetime.datetime
+    :return: Microseconds since the Unix epoch.
+    :rtype: int
+    """
+    if not isinstance(date, datetime.datetime):
+        date = datetime.datetime(date.year, date.month, date.day)
+
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=datetime.timezone.utc)
+
+    return (date - _EPOCH) // _MICROSECOND
+
+
+class ObservationStore:
+    """
+    Observations of one kind, stored column-wise.
+
+    The columns (:attr:`patient`, :attr:`code`, :attr:`time`, :attr:`value`
+    and :attr:`seq`) are sorted by code, patient and time.  :attr:`seq` is
+    the position of the observation in the patient's container, which breaks
+    ties the same way the per-patient aggregators do.  :attr:`objects` holds
+    the observations themselves, in the same order, so that details can be
+    returned exactly as they were loaded.
+
+    Per (code, patient) group statistics are precomputed in the ``group_*``
+    arrays, sorted the same way.
+
+    The store is a snapshot; when observations are added, :meth:`extend`
+    builds a new one from it.  Every store gets a new :attr:`generation`
+    number, so that values derived from one can be told apart from those
+    derived from another.
+    """
+
+    def __init__(self, patients, attr):
+        """
+        :param patients: Patients whose observations to store, with
+            :attr:`Patient.index` set.
+        :type patients: clarkproc.fhir.containers.PatientCollection
+        :param str attr: ``'labs'`` or ``'vitals'``.
+        """
+        self.generation = next(_generations)
+        self.num_patients = len(patients)
+        self.codes = []
+        self.code_index = {}
+        # Containers key their aggregators by the first code object they saw,
+        # whose display may differ between patients.
+        self._container_codes = {}
+
+        # Running moments by (code, patient).
+        stats = {}
+
+        patient_col = []
+        code_col = []
+        time_col = []
+        value_col = []
+        objects = []
+
+        for p in patients.values():
+            for code, agg in getattr(p, attr):
+                code_idx = self.code_index.get(code)
+
+                if code_idx is None:
+                    code_idx = self.code_index[code] = len(self.codes)
+                    self.codes.append(code)
+
+                self._container_codes[p.index, code_idx] = code
+                stats[code_idx, p.index] = agg.stats
+
+                for obs in agg.data:
+                    patient_col.append(p.index)
+                    code_col.append(code_idx)
+                    time_col.append(to_timestamp(obs.effectiveDateTime))
+                    value_col.append(obs.value)
+                    objects.append(obs)
+
+        # Codes are also looked up by the "(system, code)" labels used in
+        # feature plans.
+        self.label_index = {f'({c.system}, {c.code})': i
+                            for i, c in enumerate(self.codes)}
+
+        seq = np.arange(len(objects), dtype=np.int64)
+        patient_col = np.array(patient_col, dtype=np.int64)
+        code_col = np.array(code_col, dtype=np.int64)
+        time_col = np.array(time_col, dtype=np.int64)
+        value_col = np.array(value_col, dtype=np.float64)
+
+        order = np.lexsort((seq, time_col, patient_col, code_col))
+
+        self.patient = patient_col[order]
+        self.code = code_col[order]
+        self.time = time_col[order]
+        self.value = value_col[order]
+        self.seq = seq[order]
+        self.objects = np.empty(len(objects), dtype=object)
+        self.objects[:] = objects
+        self.objects = self.objects[order]
+
+        self._group()
+
+        self._group_stats = np.empty(len(self.group_key), dtype=object)
+        self._group_stats[:] = [
+            stats[c, p] for c, p in zip(self.group_code.tolist(),
+                                        self.group_patient.tolist())]
+        for name, value in _GROUP_MOMENTS:
+            setattr(self, f'group_{name}', np.array(
+                [value(s) for s in self._group_stats], dtype=np.float64))
+
+    def extend(self, patients, attr, added):
+        """
+        Build the store of a corpus that observations were added to.
+
+        Only the new observations are read, and the statistics of the groups
+        they fall in are the only ones recomputed, so the cost of an append
+        mostly depends on its size.  The result is the same as building a
+        store over the whole corpus, except that :attr:`seq` numbers the new
+        observations after the existing ones.  This store is left unchanged.
+
+        :param patients: Patients of the corpus, including any new ones.
+        :type patients: clarkproc.fhir.containers.PatientCollection
+        :param str attr: ``'labs'`` or ``'vitals'``.
+        :param list added: ``(patient, observation)`` of each observation
+            added to the patients' containers, in the order they were added.
+        :return: The new store.
+        :rtype: ObservationStore
+        """
+        store = ObservationStore.__new__(ObservationStore)
+        store.generation = next(_generations)
+        store.num_patients = len(patients)
+        store.codes = list(self.codes)
+        store.code_index = dict(self.code_index)
+        store._container_codes = dict(self._container_codes)
+        store.label_index = dict(self.label_index)
+
+        # Running moments of the groups with new observations.
+        stats = {}
+
+        patient_col = []
+        code_col = []
+        time_col = []
+        value_col = []
+        objects = []
+
+        for p, obs in added:
+            code_idx = store.code_index.get(obs.code)
+
+            if code_idx is None:
+                code_idx = store.code_index[obs.code] = len(store.codes)
+                store.codes.append(obs.code)
+                store.label_index[
+                    f'({obs.code.system}, {obs.code.code})'] = code_idx
+
+            if (code_idx, p.index) not in stats:
+                stats[code_idx, p.index] = getattr(p, attr)[obs.code].stats
+                # The code of a new group is the one its container was keyed
+                # by, since the container didn't have the code before.
+                store._container_codes.setdefault((p.index, code_idx),
+                                                  obs.code)
+
+            patient_col.append(p.index)
+            code_col.append(code_idx)
+            time_col.append(to_timestamp(obs.effectiveDateTime))
+            value_col.append(obs.value)
+            objects.append(obs)
+
+        new_objects = np.empty(len(objects), dtype=object)
+        new_objects[:] = objects
+
+        seq = np.concatenate((self.seq, np.arange(
+            len(self), len(self) + len(objects), dtype=np.int64)))
+        patient_col = np.concatenate(
+            (self.patient, np.array(patient_col, dtype=np.int64)))
+        code_col = np.concatenate(
+            (self.code, np.array(code_col, dtype=np.int64)))
+        time_col = np.concatenate(
+            (self.time, np.array(time_col, dtype=np.int64)))
+        value_col = np.concatenate(
+            (self.value, np.array(value_col, dtype=np.float64)))
+        objects = np.concatenate((self.objects, new_objects))
+
+        order = np.lexsort((seq, time_col, patient_col, code_col))
+
+        store.patient = patient_col[order]
+        store.code = code_col[order]
+        store.time = time_col[order]
+        store.value = value_col[order]
+        store.seq = seq[order]
+        store.objects = objects[order]
+
+        store._group()
+
+        # Existing groups keep their statistics, at their new positions.
+        moved = np.searchsorted(
+            store.group_key,
+            self.group_code * max(store.num_patients, 1) + self.group_patient)
+        store._group_stats = np.empty(len(store.group_key), dtype=object)
+        store._group_stats[moved] = self._group_stats
+
+        for name, _ in _GROUP_MOMENTS:
+            values = np.empty(len(store.group_key), dtype=np.float64)
+            values[moved] = getattr(self, f'group_{name}')
+            setattr(store, f'group_{name}', values)
+
+        # The statistics of changed groups are read from the containers.
+        changed = sorted(stats)
+        if changed:
+            code_idx, patient_idx = np.array(changed, dtype=np.int64).T
+            touched = np.searchsorted(
+                store.group_key,
+                code_idx * max(store.num_patients, 1) + patient_idx)
+            store._group_stats[touched] = [stats[k] for k in changed]
+
+            for name, value in _GROUP_MOMENTS:
+                getattr(store, f'group_{name}')[touched] = np.array(
+                    [value(stats[k]) for k in changed], dtype=np.float64)
+
+        return store
+
+    def __len__(self):
+        return len(self.objects)
+
+    def _group(self):
+        n = len(self)
+        key = self.code * max(self.num_patients, 1) + self.patient
+
+        is_start = np.ones(n, dtype=bool)
+        is_start[1:] = key[1:] != key[:-1]
+        starts = np.flatnonzero(is_start)
+        ends = np.append(starts[1:], n)
+        group_id = np.cumsum(is_start) - 1
+
+        self.group_key = key[starts]
+        self.group_code = self.code[starts]
+        self.group_patient = self.patient[starts]
+        self.group_start = starts
+        self.group_end = ends
+        self.group_count = ends - starts
+
+        if n == 0:
+            empty = np.zeros(0, dtype=np.int64)
+            self.group_first_seq = empty
+            self.group_min = self.group_max = empty
+            self.group_newest = self.group_oldest = empty
+            for name, _ in _GROUP_QUANTILES:
+                setattr(self, f'group_{name}', np.zeros(0, dtype=np.float64))
+            self._patient_groups = empty
+            self._run_start = self._time_key = empty
+            self._times = empty
+            return
+
+        # Position of the first observation of each group within the
+        # patient's container, which orders codes the way the container does.
+        self.group_first_seq = np.minimum.reduceat(self.seq, starts)
+
+        # Observations are sorted by time, and by seq within equal times, so
+        # the oldest is the first of the group.  The newest is the first of
+        # the group's last run of equal times, matching the strict comparisons
+        # used by ObservationAggregator.
+        self.group_oldest = starts
+        new_time = is_start.copy()
+        new_time[1:] |= self.time[1:] != self.time[:-1]
+        run_start = np.maximum.accumulate(
+            np.where(new_time, np.arange(n), 0))
+        self.group_newest = run_start[ends - 1]
+        self._run_start = run_start
+
+        # Times ranked among all distinct times and offset by group, so that a
+        # single sorted array can be binary searched for the observations of
+        # every group within a time window.
+        self._times = np.unique(self.time)
+        self._time_key = (group_id * (len(self._times) + 1)
+                          + np.searchsorted(self._times, self.time))
+
+        # Extremes are resolved to indices so that the original values (and
+        # their types) are returned.  Ties keep the first observation added.
+        by_value = np.lexsort((self.seq, self.value, group_id))
+        self.group_min = by_value[starts]
+        by_neg_value = np.lexsort((self.seq, -self.value, group_id))
+        self.group_max = by_neg_value[starts]
+
+        # Quantiles are interpolated between the group's sorted values the
+        # same way clarkproc.fhir.stats.quantile does.
+        sorted_values = self.value[by_value]
+        last = ends - 1
+
+        for name, q in _GROUP_QUANTILES:
+            position = q * (self.group_count - 1)
+            offset = np.floor(position).astype(np.int64)
+            lo = starts + offset
+            hi = np.minimum(lo + 1, last)
+            setattr(self, f'group_{name}', sorted_values[lo] + (
+                position - offset) * (sorted_values[hi] - sorted_values[lo]))
+
+        self._patient_groups = np.argsort(self.group_patient, kind='stable')
+
+    def _find_group(self, patient_idx, code):
+        code_idx = self.code_index.get(code)
+
+        if code_idx is None:
+            return None
+
+        key = code_idx * max(self.num_patients, 1) + patient_idx
+        g = np.searchsorted(self.group_key, key)
+
+        if g == len(self.group_key) or self.group_key[g] != key:
+            return None
+
+        return g
+
+    def details(self, patient_idx, code):
+        """
+        :param int patient_idx: Index of the patient.
+        :param CodeValue code: Code of interest.
+        :return: The patient's observations with the code, in the order they
+            were added, or ``None`` if there are none.
+        :rtype: list
+        """
+        g = self._find_group(patient_idx, code)
+
+        if g is None:
+            return None
+
+        start, end = self.group_start[g], self.group_end[g]
+
+        return list(self.objects[start:end][
+            np.argsort(self.seq[start:end], kind='stable')])
+
+    def _group_dict(self, g):
+        return {
+            'count': int(self.group_count[g]),
+            'boolean': True,
+            'min': self.objects[self.group_min[g]].value,
+            'max': self.objects[self.group_max[g]].value,
+            'newest': self.objects[self.group_newest[g]].value,
+            'oldest': self.objects[self.group_oldest[g]].value,
+            **self._group_stats[g].to_dict(),
+            **{name: float(getattr(self, f'group_{name}')[g])
+               for name, _ in _GROUP_QUANTILES},
+        }
+
+    def patient_summary(self, patient_idx):
+        """
+        :param int patient_idx: Index of the patient.
+        :return: Same as ``ObservationContainer.to_dict`` for the patient.
+        :rtype: dict
+        """
+        lo, hi = np.searchsorted(
+            self.group_patient[self._patient_groups],
+            [patient_idx, patient_idx + 1])
+        groups = sorted(self._patient_groups[lo:hi],
+                        key=lambda g: self.group_first_seq[g])
+
+        entries = []
+
+        for g in groups:
+            code = self._container_codes[patient_idx, self.group_code[g]]
+            entry_d = {
+                'system': code.system,
+                'code': code.code,
+                'display': code.display,
+            }
+            entry_d.update(self._group_dict(g))
+            entries.append(entry_d)
+
+        entries.sort(key=lambda e: e['count'], reverse=True)
+
+        return {'total_count': int(self.group_count[groups].sum()) if groups else 0,
+                'unique_count': len(entries),
+                'data': entries}
+
+    def feature(self, label, name):
+        """
+        :param str label: ``"(system, code)"`` label of the code of interest.
+        :param str name: One of ``count``, ``boolean``, ``min``, ``max``,
+            ``newest``, ``oldest`` or :data:`STATS_FEATURES`.
+        :return: Value of the feature for every patient, by patient index.
+            Patients without observations with the code get the same defaults
+            as in feature extraction (``None`` for values).
+        :rtype: numpy.ndarray
+        """
+        if name == 'count':
+            out = np.zeros(self.num_patients, dtype=np.int64)
+        elif name == 'boolean':
+            out = np.zeros(self.num_patients, dtype=bool)
+        else:
+            out = np.full(self.num_patients, None, dtype=object)
+
+        code_idx = self.label_index.get(label)
+
+        if code_idx is None:
+            return out
+
+        lo, hi = np.searchsorted(self.group_code, [code_idx, code_idx + 1])
+        patients = self.group_patient[lo:hi]
+
+        if name == 'count':
+            out[patients] = self.group_count[lo:hi]
+        elif name == 'boolean':
+            out[patients] = True
+        elif name in STATS_FEATURES:
+            # Missing statistics (std of a single value) are stored as NaN.
+            values = getattr(self, f'group_{name}')[lo:hi]
+            out[patients] = np.where(np.isnan(values), None, values.tolist())
+        else:
+            index = getattr(self, f'group_{name}')[lo:hi]
+            out[patients] = [o.value for o in self.objects[index]]
+
+        return out
+
+    def window_feature(self, label, name, start, end):
+        """
+        Like :meth:`feature`, but only over the observations from ``start`` to
+        ``end`` (inclusive).
+
+        The observations of each group are found by binary search, so the
+        cost depends on the number of patients with the code rather than on
+        the number of observations.
+
+        :param str label: ``"(system, code)"`` label of the code of interest.
+        :param str name: One of :data:`WINDOW_FEATURES`.
+        :param int start: Start of the window, see :func:`to_timestamp`.
+        :param int end: End of the window, see :func:`to_timestamp`.
+        :return: Value of the feature for every patient, by patient index.
+            Values are floats, or ``None`` for patients without observations
+            in the window.
+        :rtype: numpy.ndarray
+        """
+        if name == 'count':
+            out = np.zeros(self.num_patients, dtype=np.int64)
+        elif name == 'boolean':
+            out = np.zeros(self.num_patients, dtype=bool)
+        else:
+            out = np.full(self.num_patients, None, dtype=object)
+
+        code_idx = self.label_index.get(label)
+
+        if code_idx is None:
+            return out
+
+        lo, hi = np.searchsorted(self.group_code, [code_idx, code_idx + 1])
+        patients = self.group_patient[lo:hi]
+
+        # Keys of the window bounds in each group, see _group.
+        offsets = np.arange(lo, hi) * (len(self._times) + 1)
+        rank_start, rank_end = (np.searchsorted(self._times, start, 'left'),
+                                np.searchsorted(self._times, end, 'right'))
+        first = np.searchsorted(self._time_key, offsets + rank_start)
+        stop = np.searchsorted(self._time_key, offsets + rank_end)
+        count = stop - first
+
+        if name == 'count':
+            out[patients] = count
+            return out
+
+        if name == 'boolean':
+            out[patients] = count > 0
+            return out
+
+        found = count > 0
+
+        if not found.any():
+            return out
+
+        first, stop, count = first[found], stop[found], count[found]
+
+        if name == 'oldest':
+            values = self.value[first]
+        elif name == 'newest':
+            values = self.value[np.maximum(self._run_start[stop - 1], first)]
+        else:
+            # reduceat over (first, stop) pairs reduces each window; the
+            # reductions between windows are dropped.  The padding keeps
+            # stop a valid index when a window ends the store.
+            ufunc = {'min': np.minimum, 'max': np.maximum,
+                     'mean': np.add}[name]
+            bounds = np.empty(2 * len(first), dtype=np.int64)
+            bounds[0::2] = first
+            bounds[1::2] = stop
+            values = ufunc.reduceat(np.append(self.value, 0.0), bounds)[0::2]
+
+            if name == 'mean':
+                values = values / count
+
+        out[patients[found]] = values.tolist()
+
+        return out
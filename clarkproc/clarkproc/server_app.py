@@ -1,5 +1,6 @@
 """Entry file for python server."""
 import logging
+import multiprocessing
 import os
 import sys
 
@@ -8,6 +9,8 @@ from flask import request
 import werkzeug
 
 from clarkproc import state
+from clarkproc.blueprint_ml import get_note_pool
+from clarkproc.engine import jobs
 from clarkproc.server_setup import app
 
 
@@ -22,6 +25,11 @@ logging.basicConfig(
 
 LOGGER = logging.getLogger(__name__)
 
+app.config['INGEST_CACHE_DIR'] = os.path.join(APPDIR, 'ingest-cache')
+app.config['NOTE_STORE_DIR'] = os.path.join(APPDIR, 'note-store')
+# Extract note features with one process per CPU.
+app.config['NOTE_WORKERS'] = None
+
 
 @app.route('/ping')
 def startup_ping():
@@ -33,7 +41,14 @@ def startup_ping():
 def reset():
     """Reset state held in server."""
     try:
+        jobs.cancel_all()
         state.reset()
+
+        # Let go of the note stores the workers have open.
+        pool = get_note_pool()
+        if pool is not None:
+            pool.shutdown()
+
         return {"reset": True}, 200
     except:
         return 'Failed to reset.', 500
@@ -63,6 +78,9 @@ def handle_error(ex):
 
 
 if __name__ == '__main__':
+    # Required for process pools to work in the frozen (PyInstaller) server.
+    multiprocessing.freeze_support()
+
     config = sys.argv[1:]
 
     server_host = config[1]
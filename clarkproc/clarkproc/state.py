@@ -20,8 +20,12 @@ test_corpus = None
 last_result = None
 classifier = None
 
-train = AttributeDict(patients=None, labs=None, vitals=None, medications=None)
-test = AttributeDict(patients=None, labs=None, vitals=None, medications=None)
+train = AttributeDict(patients=None, labs=None, vitals=None, medications=None,
+                      note_store=None, section_cache=None,
+                      coverage_cache=None)
+test = AttributeDict(patients=None, labs=None, vitals=None, medications=None,
+                     note_store=None, section_cache=None,
+                     coverage_cache=None)
 
 
 def reset():
@@ -36,11 +40,17 @@ def reset():
     train.labs = None
     train.vitals = None
     train.medications = None
+    train.note_store = None
+    train.section_cache = None
+    train.coverage_cache = None
 
     test.patients = None
     test.labs = None
     test.vitals = None
     test.medications = None
+    test.note_store = None
+    test.section_cache = None
+    test.coverage_cache = None
 
 
 def summary():
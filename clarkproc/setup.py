@@ -12,4 +12,8 @@ setup(
     zip_safe=False,
     license='',
     python_requires='>=3.7',
+    extras_require={
+        # Reading zstd compressed FHIR files.
+        'zstd': ['zstandard'],
+    },
 )